@@ -0,0 +1,7 @@
+# coding=utf-8
+"""
+性能对比脚本。在仓库的根目录下执行，比如：python -m benchmarks.session_pool
+每个脚本都会先检查对比的几种实现给出相同的结果，然后输出耗时。
+"""
+
+__author__ = 'zephyre'
@@ -0,0 +1,56 @@
+# coding=utf-8
+"""
+对比逐个计算（utils.haversine）、向量化计算和GeoIndex的性能。需要numpy
+
+用法：python -m benchmarks.geo_distance [n] [m]
+"""
+import sys
+from random import uniform
+from time import time
+
+from utils import haversine
+from utils.geo import np, haversine_matrix, GeoIndex
+
+__author__ = 'zephyre'
+
+
+def run(n=2000, m=2000, radius=500):
+    """
+    :return: {'scalar': 耗时, 'vectorized': 耗时, 'index_build': 建索引的耗时, 'index_query': 查询的耗时}，单位为秒
+    """
+    assert np is not None, 'numpy is not available'
+
+    lngs1 = [uniform(-180, 180) for _ in xrange(n)]
+    lats1 = [uniform(-80, 80) for _ in xrange(n)]
+    lngs2 = [uniform(-180, 180) for _ in xrange(m)]
+    lats2 = [uniform(-80, 80) for _ in xrange(m)]
+
+    result = {}
+    ts = time()
+    scalar = [[haversine(x1, y1, x2, y2) for x2, y2 in zip(lngs2, lats2)] for x1, y1 in zip(lngs1, lats1)]
+    result['scalar'] = time() - ts
+
+    ts = time()
+    matrix = haversine_matrix(lngs1, lats1, lngs2, lats2)
+    result['vectorized'] = time() - ts
+    assert float(np.abs(matrix - np.asarray(scalar)).max()) < 1e-6
+
+    # 预先导入scikit-learn，不计入建索引的耗时
+    GeoIndex(lngs2[:GeoIndex.min_tree_size], lats2[:GeoIndex.min_tree_size])
+    ts = time()
+    index = GeoIndex(lngs2, lats2)
+    result['index_build'] = time() - ts
+
+    ts = time()
+    found = [index.query_radius(x, y, radius) for x, y in zip(lngs1, lats1)]
+    result['index_query'] = time() - ts
+
+    # 半径查询的结果应该和距离矩阵一致
+    for row, hits in zip(matrix, found):
+        assert sorted(idx for idx, dist in hits) == [idx for idx, dist in enumerate(row) if dist <= radius]
+    return result
+
+
+if __name__ == '__main__':
+    for name, cost in sorted(run(*[int(v) for v in sys.argv[1:3]]).items()):
+        print '%s: %.3fs' % (name, cost)
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+在保存的HTML文件上测试解析的耗时。
+
+用法：
+python -m benchmarks.html_parsing processors.dianping:DianpingMatcher.get_dishes fixture1.html fixture2.html ...
+python -m benchmarks.html_parsing --streaming li 'self::li[@data-id]' fixture1.html fixture2.html ...
+"""
+import os
+import resource
+import sys
+from importlib import import_module
+from time import time
+
+from utils.html import parse_html, select, iter_elements, _xpath_registry
+
+__author__ = 'zephyre'
+
+
+def read(path):
+    with open(path) as f:
+        return f.read().decode('utf-8')
+
+
+def run(extractor, paths, repeat=10):
+    """
+    :param extractor: 解析函数，接受HTML文本作为参数
+    :return: {path: (解析耗时, 解析函数耗时)}，单位为毫秒，取repeat次的平均值
+    """
+    result = {}
+    for path in paths:
+        body = read(path)
+
+        ts = time()
+        for _ in xrange(repeat):
+            parse_html(body)
+        parse_cost = (time() - ts) / repeat * 1000
+
+        # 解析的结果应该是确定的
+        expected = extractor(body)
+        ts = time()
+        for _ in xrange(repeat):
+            assert extractor(body) == expected
+        extract_cost = (time() - ts) / repeat * 1000
+
+        result[path] = (parse_cost, extract_cost)
+    return result
+
+
+def measure(func, *args):
+    """
+    在子进程中执行func，返回(耗时（毫秒）, 子进程的内存峰值（KB）)。每次测量使用独立的进程，峰值互不影响
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        ts = time()
+        func(*args)
+        cost = (time() - ts) * 1000
+        os.write(w, '%f %d' % (cost, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        os._exit(0)
+
+    os.close(w)
+    data = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    cost, peak = data.split()
+    return float(cost), int(peak)
+
+
+def run_streaming(paths, matchers):
+    """
+    对比DOM解析和流式解析在保存的HTML文件上的耗时和内存峰值
+    :return: {path: {'dom': (耗时, 峰值), 'streaming': (耗时, 峰值)}}
+    """
+    def dom(body):
+        tree = parse_html(body)
+        texts = []
+        for name, tag, condition in matchers:
+            for elem in tree.iter(tag):
+                if condition is None or select(elem, condition):
+                    texts.append(''.join(elem.itertext()))
+        return texts
+
+    def streaming(body):
+        return [''.join(elem.itertext()) for name, elem in iter_elements(body, matchers)]
+
+    result = {}
+    for path in paths:
+        body = read(path)
+        # 两种方式应该提取出相同的内容
+        assert dom(body) == streaming(body), path
+        result[path] = {'dom': measure(dom, body), 'streaming': measure(streaming, body)}
+    return result
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--streaming':
+        for path, ret in sorted(run_streaming(sys.argv[4:], [('item', sys.argv[2], sys.argv[3])]).items()):
+            print '%s: DOM %.2fms / %dKB, streaming %.2fms / %dKB' % ((path,) + ret['dom'] + ret['streaming'])
+        sys.exit(0)
+
+    module_name, func_name = sys.argv[1].split(':')
+    func = import_module(module_name)
+    for name in func_name.split('.'):
+        func = getattr(func, name)
+
+    for path, (parse_cost, extract_cost) in sorted(run(func, sys.argv[2:]).items()):
+        print '%s: parse %.2fms, %s %.2fms' % (path, parse_cost, func_name, extract_cost)
+    print 'Compiled XPath expressions: %d' % len(_xpath_registry)
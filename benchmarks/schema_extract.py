@@ -0,0 +1,57 @@
+# coding=utf-8
+"""
+在保存的HTML文件上测试Schema的解析耗时。
+
+用法：python -m benchmarks.schema_extract processors.dianping:COMMENT_SCHEMA fixture1.html ... [--selector XPATH]
+"""
+import argparse
+from importlib import import_module
+from time import time
+
+from utils.html import parse_html, compile_xpath
+
+__author__ = 'zephyre'
+
+
+def run(schema, paths, selector=None, repeat=10):
+    """
+    :param selector: 如果指定，则对选出的每个节点提取记录（比如评论列表）；否则对整个页面提取一条记录
+    :return: {path: (解析耗时, 提取耗时, 记录数)}，单位为毫秒，取repeat次的平均值
+    """
+    result = {}
+    for path in paths:
+        with open(path) as f:
+            body = f.read().decode('utf-8')
+
+        ts = time()
+        for _ in xrange(repeat):
+            tree = parse_html(body)
+        parse_cost = (time() - ts) / repeat * 1000
+
+        records = []
+        ts = time()
+        for _ in xrange(repeat):
+            records = schema.extract_all(tree, selector) if selector else [schema.extract(tree)]
+        extract_cost = (time() - ts) / repeat * 1000
+
+        # 每个选出的节点对应一条记录
+        if selector:
+            assert len(records) == len(compile_xpath(selector)(tree)), path
+
+        result[path] = (parse_cost, extract_cost, len(records))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('schema')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--selector')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    module_name, schema_name = args.schema.split(':')
+    target = getattr(import_module(module_name), schema_name)
+
+    for path, (parse_cost, extract_cost, cnt) in sorted(run(target, args.paths, args.selector, args.repeat).items()):
+        print '%s: parse %.2fms, extract %.2fms (%d records)' % (path, parse_cost, extract_cost, cnt)
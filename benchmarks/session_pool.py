@@ -0,0 +1,43 @@
+# coding=utf-8
+"""
+在本地的stub服务器上，对比使用SessionPool和每次新建Session（池的大小为0）时的吞吐量、延迟和TCP连接数。
+
+用法：python -m benchmarks.session_pool [请求数]
+"""
+import sys
+from time import time
+
+from tests import serve_stub
+from tests.test_session_pool import OkHandler
+
+__author__ = 'zephyre'
+
+
+def run(count=500):
+    """
+    :return: {'pooled': (请求数/秒, 平均延迟（毫秒）, 连接数), 'per-call': (...)}
+    """
+    from core import RequestHelper, SessionPool
+
+    result = {}
+    for name, pool_size in (('pooled', 64), ('per-call', 0)):
+        server, url = serve_stub(OkHandler)
+        helper = RequestHelper()
+        helper.session_pool = SessionPool(max_size=pool_size)
+
+        ts = time()
+        for idx in xrange(count):
+            assert helper.request('GET', '%s/item/%d' % (url, idx), retry=1).text == 'ok'
+        cost = time() - ts
+
+        result[name] = (count / cost, cost / count * 1000, server.connections)
+        server.shutdown()
+        server.server_close()
+
+    assert result['pooled'][2] < result['per-call'][2]
+    return result
+
+
+if __name__ == '__main__':
+    for name, (rate, latency, connections) in sorted(run(*[int(v) for v in sys.argv[1:2]]).items()):
+        print '%s: %.1f requests/s, avg latency %.2fms, %d connections' % (name, rate, latency, connections)
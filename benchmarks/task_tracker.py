@@ -0,0 +1,53 @@
+# coding=utf-8
+"""
+在本地的redis-server上，对比逐个读写（每个task一次EXISTS和一次SET）和批量读写（track_many/update）的吞吐量。
+redis-server的地址参见tests.REDIS_HOST等（会清空测试数据库）。
+
+用法：python -m benchmarks.task_tracker [任务数]
+"""
+import sys
+from time import time
+
+from tests import get_test_redis
+from tests.test_task_tracker import Task
+
+__author__ = 'zephyre'
+
+
+def run(count=2000):
+    """
+    :return: {'per-task': 任务数/秒, 'batched': 任务数/秒}
+    """
+    from core import RedisTaskTracker
+
+    cli = get_test_redis()
+    tasks = [Task('benchmark:task:%d' % idx) for idx in xrange(count)]
+
+    result = {}
+    for name in ('per-task', 'batched'):
+        cli.redis.flushdb()
+        tracker = RedisTaskTracker(redis_cli=cli, expire=600, batch_size=200)
+
+        ts = time()
+        if name == 'per-task':
+            for task in tasks:
+                if not cli.exists(task.task_key):
+                    cli.set(task.task_key, 1, expire=tracker.expire)
+        else:
+            for idx in xrange(0, count, tracker.batch_size):
+                batch = tasks[idx:idx + tracker.batch_size]
+                for task, bypass in zip(batch, tracker.track_many(batch)):
+                    if not bypass:
+                        tracker.update(task)
+            tracker.flush()
+        cost = time() - ts
+
+        assert all(tracker.track_many(tasks))
+        result[name] = count / cost
+    cli.redis.flushdb()
+    return result
+
+
+if __name__ == '__main__':
+    for name, rate in sorted(run(*[int(v) for v in sys.argv[1:2]]).items()):
+        print '%s: %.1f tasks/s' % (name, rate)
@@ -1,6 +1,7 @@
 # coding=utf-8
 import logging
 import re
+from time import time
 
 from gevent.lock import BoundedSemaphore
 
@@ -114,6 +115,9 @@ class BaseTaskTracker(object):
     记录某个任务是否被执行
     """
 
+    # track_many的批量大小
+    batch_size = 100
+
     def track(self, task):
         """
         如果task可以bypass，则返回True
@@ -131,15 +135,47 @@ class BaseTaskTracker(object):
         """
         raise NotImplementedError
 
+    def track_many(self, tasks):
+        """
+        批量检查task是否可以bypass
+        :param tasks:
+        :return: 和tasks一一对应的bool列表
+        """
+        return [self.track(task) for task in tasks]
+
+    def flush(self):
+        """
+        将缓冲的tracking信息写入存储
+        """
+        pass
+
+    def flush_expired(self):
+        """
+        如果缓冲的tracking信息已经超过flush_interval，则写入存储。由processor定期调用
+        """
+        pass
+
 
 class RedisTaskTracker(BaseTaskTracker):
     """
     使用Redis作为TaskTracker
     """
 
-    def __init__(self):
-        self.__redis = RedisClient('task-tracker')
-        self.expire = dhaulagiri_settings['task_tracker']['expire']
+    def __init__(self, redis_cli=None, expire=None, batch_size=None, flush_interval=None):
+        section = dhaulagiri_settings.get('task_tracker', {})
+
+        self.__redis = redis_cli or RedisClient('task-tracker')
+        self.expire = expire if expire is not None else section.get('expire')
+        # 批量操作的大小
+        self.batch_size = batch_size or section.get('batch_size', 200)
+        # 缓冲的tracking信息最多保留多久（秒）
+        self.flush_interval = flush_interval or section.get('flush_interval', 5)
+
+        # 等待写入的task key
+        self._completed = []
+        # 缓冲区中最早的task key的加入时间
+        self._ts = None
+        self._lock = BoundedSemaphore(1)
 
     def track(self, task):
         r = self.__redis
@@ -149,11 +185,42 @@ class RedisTaskTracker(BaseTaskTracker):
         else:
             return r.exists(task_key)
 
+    def track_many(self, tasks):
+        keys = [getattr(task, 'task_key', None) for task in tasks]
+        pipe = self.__redis.pipeline()
+        for key in keys:
+            if key:
+                pipe.exists(key)
+        results = iter(pipe.execute())
+        return [bool(next(results)) if key else False for key in keys]
+
     def update(self, task):
-        r = self.__redis
         task_key = getattr(task, 'task_key', None)
         if task_key:
-            r.set(task_key, True, self.expire)
+            if not self._completed:
+                self._ts = time()
+            self._completed.append(task_key)
+            if len(self._completed) >= self.batch_size:
+                self.flush()
+
+    def flush_expired(self):
+        if self._completed and time() - self._ts >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        try:
+            self._lock.acquire()
+            keys = self._completed
+            self._completed = []
+            self._ts = None
+            if not keys:
+                return
+            pipe = self.__redis.pipeline()
+            for key in keys:
+                pipe.set(key, 1, ex=int(self.expire) if self.expire else None)
+            pipe.execute()
+        finally:
+            self._lock.release()
 
 
 class RedisClient(object):
@@ -162,15 +229,20 @@ class RedisClient(object):
 
     redis = property(_get_redis)
 
-    def __init__(self, profile):
-        try:
-            redis_config = filter(lambda v: v['profile'] == profile, dhaulagiri_settings['redis'])[0]
-        except IndexError:
-            raise ValueError('Invalid redis profile: %s' % profile)
+    def __init__(self, profile=None, host='127.0.0.1', port=6379, db_no=0):
+        """
+        :param profile: 配置文件中的redis profile。如果为None，则直接使用host, port和db_no
+        """
+        if profile is not None:
+            try:
+                redis_config = filter(lambda v: v['profile'] == profile, dhaulagiri_settings['redis'])[0]
+            except IndexError:
+                raise ValueError('Invalid redis profile: %s' % profile)
+            host, port, db_no = redis_config['host'], redis_config['port'], redis_config['db_no']
 
-        self.host = redis_config['host']
-        self.port = redis_config['port']
-        self.db_no = redis_config['db_no']
+        self.host = host
+        self.port = port
+        self.db_no = db_no
 
         import redis
 
@@ -180,13 +252,17 @@ class RedisClient(object):
         return self._redis.get(key)
 
     def set(self, key, value, expire=None):
-        self._redis.set(key, value)
-        if expire:
-            self._redis.expire(key, expire)
+        self._redis.set(key, value, ex=int(expire) if expire else None)
 
     def exists(self, key):
         return self._redis.exists(key)
 
+    def pipeline(self):
+        """
+        获得一个非事务的pipeline，用于批量操作
+        """
+        return self._redis.pipeline(transaction=False)
+
     def get_cache(self, key, retrieve_func=None, expire=None, refresh=False):
         """
         获得缓存内容
@@ -198,9 +274,7 @@ class RedisClient(object):
         """
         if (not self._redis.exists(key) or refresh) and retrieve_func:
             value = retrieve_func()
-            self._redis.set(key, value)
-            if expire:
-                self._redis.expire(key, expire)
+            self.set(key, value, expire)
             return value
         else:
             return self._redis.get(key)
@@ -367,9 +441,100 @@ class ProcessorEngine(LoggerMixin):
         self.log('Cleaning up engine...')
 
 
+class SessionPool(object):
+    """
+    长连接的requests.Session池。Session按照(proxy, host, tag)进行分组，从而可以复用TCP/TLS连接。
+    池中最多保留max_size个空闲Session，超出时按照LRU的顺序关闭。
+    """
+
+    def __init__(self, max_size=64):
+        from collections import OrderedDict
+
+        self.max_size = max_size
+        # key => [session, ...]
+        self._idle = {}
+        # 空闲Session的LRU顺序：id(session) => key
+        self._lru = OrderedDict()
+        self._lock = BoundedSemaphore(1)
+
+    @classmethod
+    def from_settings(cls, settings):
+        section = settings.get('request', {}) if settings else {}
+        return cls(max_size=section.get('session_pool_size', 64))
+
+    @staticmethod
+    def build_key(url, proxies=None, tag=None):
+        from urlparse import urlparse
+
+        ret = urlparse(url)
+        proxy_sig = tuple(sorted(proxies.items())) if proxies else None
+        return proxy_sig, '%s://%s' % (ret.scheme, ret.netloc), tag
+
+    def acquire(self, key):
+        """
+        获得一个Session。如果没有空闲的Session，则新建一个
+        """
+        from requests import Session
+
+        try:
+            self._lock.acquire()
+            session_list = self._idle.get(key)
+            if session_list:
+                session = session_list.pop()
+                self._lru.pop(id(session), None)
+                return session
+        finally:
+            self._lock.release()
+
+        return Session()
+
+    def release(self, key, session):
+        """
+        将Session归还到池中
+        """
+        # 避免cookie在不同的请求之间泄露
+        session.cookies.clear()
+
+        evicted = []
+        try:
+            self._lock.acquire()
+            self._idle.setdefault(key, []).append(session)
+            self._lru[id(session)] = key
+
+            while len(self._lru) > self.max_size:
+                sid, old_key = self._lru.popitem(last=False)
+                session_list = self._idle[old_key]
+                for idx, s in enumerate(session_list):
+                    if id(s) == sid:
+                        evicted.append(session_list.pop(idx))
+                        break
+                if not session_list:
+                    self._idle.pop(old_key)
+        finally:
+            self._lock.release()
+
+        for s in evicted:
+            s.close()
+
+    @staticmethod
+    def discard(session):
+        """
+        出错的Session不再放回池中
+        """
+        session.close()
+
+
 class RequestHelper(object):
     def __init__(self, engine=None):
         self._engine = engine
+        self.session_pool = SessionPool.from_settings(dhaulagiri_settings)
+
+        # Single-flight：相同的GET请求同时只发送一次，其它调用者等待并共享结果
+        self.single_flight = dhaulagiri_settings.get('request', {}).get('single_flight', True)
+        # key => AsyncResult
+        self._in_flight = {}
+        self.flights = 0
+        self.coalesced = 0
 
     @classmethod
     def from_engine(cls, engine):
@@ -409,7 +574,7 @@ class RequestHelper(object):
 
         """
 
-        from requests import Request, Session
+        from requests import Request
 
         mw_manager = getattr(self._engine, 'middleware_manager', {})
         if mw_manager and 'download' in mw_manager.mw_dict:
@@ -418,7 +583,8 @@ class RequestHelper(object):
             mw_list = []
 
         for idx in xrange(retry):
-            session = Session()
+            # Middleware可以直接提供一个session，也可以通过session_tag，指定使用池中的某一类session
+            session = None
             session_args = {'timeout': timeout, 'allow_redirects': allow_redirects, 'proxies': proxies}
 
             try:
@@ -434,9 +600,17 @@ class RequestHelper(object):
                     if not pass_next:
                         break
 
+                session_tag = session_args.pop('session_tag', None)
+                pool_key = None
+                if session is None:
+                    pool_key = self.session_pool.build_key(prepped.url, session_args.get('proxies'), session_tag)
+                    session = self.session_pool.acquire(pool_key)
+
                 try:
                     response = session.send(prepped, **session_args)
                 except IOError as e:
+                    if pool_key:
+                        self.session_pool.discard(session)
                     for entry in mw_list:
                         mw = entry['middleware']
                         pass_next = mw.on_failure(prepped, session_args)
@@ -444,6 +618,9 @@ class RequestHelper(object):
                             break
                     raise e
 
+                if pool_key:
+                    self.session_pool.release(pool_key, session)
+
                 success = True
                 for entry in mw_list:
                     mw = entry['middleware']
@@ -466,7 +643,65 @@ class RequestHelper(object):
 
         raise IOError
 
-    def get(self, url, retry=10, user_data=None, **kwargs):
-        return self.request(method='GET', url=url, retry=retry, user_data=user_data, **kwargs)
+    # leader被kill时，通知等待者重新选出leader
+    _LEADER_LOST = object()
 
+    @staticmethod
+    def _flight_key(method, url, **kwargs):
+        """
+        根据影响请求内容的参数（params, headers, cookies, data, proxies, timeout等）生成key。
+        user_data只影响对response的验证，不参与key的计算
+        """
+
+        def freeze(value):
+            if isinstance(value, dict):
+                return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+            elif isinstance(value, (list, tuple)):
+                return tuple(freeze(v) for v in value)
+            else:
+                return repr(value)
 
+        return method, url, freeze(kwargs)
+
+    def get(self, url, retry=10, user_data=None, **kwargs):
+        if not self.single_flight:
+            return self.request(method='GET', url=url, retry=retry, user_data=user_data, **kwargs)
+
+        from gevent.event import AsyncResult
+        from middlewares import validate_response
+
+        key = self._flight_key('GET', url, **kwargs)
+        while key in self._in_flight:
+            # 已经有greenlet在请求同一个资源
+            response = self._in_flight[key].get()
+            if response is self._LEADER_LOST:
+                continue
+
+            self.coalesced += 1
+            # leader只使用它自己的validator。如果共享的response不能通过本调用者的验证，则单独请求
+            if validate_response(response, user_data):
+                return response
+            return self.request(method='GET', url=url, retry=retry, user_data=user_data, **kwargs)
+
+        result = AsyncResult()
+        self._in_flight[key] = result
+        self.flights += 1
+        try:
+            response = self.request(method='GET', url=url, retry=retry, user_data=user_data, **kwargs)
+            result.set(response)
+            return response
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            if not result.ready():
+                # 被kill（GreenletExit），不能把它作为结果传给等待者
+                result.set(self._LEADER_LOST)
+            if self._in_flight.get(key) is result:
+                self._in_flight.pop(key)
+
+    def report(self):
+        if not self.single_flight:
+            return []
+        return ['Single-flight: %d requests, %d coalesced, %d in flight' % (self.flights, self.coalesced,
+                                                                           len(self._in_flight))]
@@ -54,18 +54,37 @@ def reg_processors(proc_dir=None):
                 raise
 
 
-def main():
+def run_engine(cmd):
     from core import ProcessorEngine
 
+    engine = ProcessorEngine.get_instance()
+
+    engine.add_processor(cmd)
+
+    engine.start()
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('cmd', type=str)
+    # 多进程模式：启动N个engine，每个engine处理一个分片
+    parser.add_argument('--processes', type=int, default=1)
     args, leftovers = parser.parse_known_args()
 
-    engine = ProcessorEngine.get_instance()
+    if args.processes > 1:
+        import sys
+        from core import ProcessorEngine
+        from utils.shard import ShardSupervisor
 
-    engine.add_processor(args.cmd)
+        processor_cls = ProcessorEngine.reg_processors().get(args.cmd)
+        if processor_cls and not getattr(processor_cls, 'shardable', False):
+            parser.error('%s does not support --processes > 1: its tasks are not split by shard' % args.cmd)
 
-    engine.start()
+        planner = processor_cls.plan_shards if processor_cls else None
+        failed = ShardSupervisor(args.processes).run(lambda: run_engine(args.cmd), planner=planner)
+        sys.exit(1 if failed else 0)
+    else:
+        run_engine(args.cmd)
 
 
 if __name__ == '__main__':
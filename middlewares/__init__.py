@@ -38,6 +38,22 @@ class MiddlewareManager(object):
                 mw_list = sorted(mw_list, key=lambda v: v['priority'], reverse=True)
                 self.mw_dict[mw_type] = mw_list
 
+            self.check_order(self.mw_dict.get(mw_type, []))
+
+    @staticmethod
+    def check_order(mw_list):
+        """
+        检查middleware的顺序是否满足run_before的要求
+        :param mw_list: 按照priority排列的middleware
+        """
+        seen = set()
+        for entry in mw_list:
+            mw = entry['middleware']
+            for name in mw.run_before:
+                if name in seen:
+                    raise ValueError('%s must have a higher priority than %s' % (type(mw).__name__, name))
+            seen.add(type(mw).__name__)
+
     @classmethod
     def from_engine(cls, engine):
         return MiddlewareManager(engine)
@@ -48,6 +64,9 @@ class DownloadMiddleware(object):
     Base class of download middlewares
     """
 
+    # 必须排在本middleware之后（priority更低）的middleware类名。比如某个middleware在next=False时会中断后续的middleware
+    run_before = ()
+
     def __init__(self, manager):
         self._manager = manager
 
@@ -55,11 +74,53 @@ class DownloadMiddleware(object):
     def from_manager(cls, manager):
         return cls(manager)
 
-    def on_request(self, req, session=None, session_kwarags=None):
+    def on_request(self, req, session=None, session_kwarags=None, user_data=None):
+        """
+        处理请求。session默认为None，此时RequestHelper会从长连接池中取出一个session。
+        如果需要专用的session，可以设置session_kwarags['session_tag']，而不是直接替换session对象。
+        """
         return {'next': True, 'value': (req, session, session_kwarags)}
 
-    def on_response(self, response):
-        return {'next': True, 'value': response}
+    def on_response(self, response, user_data=None):
+        return {'next': True, 'value': response, 'success': True}
 
     def on_failure(self, request, s_args):
-        return True
\ No newline at end of file
+        return True
+
+    def report(self):
+        """
+        Statistics for the heartbeat log
+        """
+        return []
+
+
+def default_validator(response):
+    """
+    默认的response验证器，通过判断HTTP status code来确定请求是否成功
+
+    :param response:
+    :return:
+    """
+    return response.status_code in [200, 301, 302, 304]
+
+
+def validate_response(response, user_data=None, validator=default_validator):
+    """
+    使用user_data['ProxyMiddleware']['validator']中指定的验证器（可以是单个函数，也可以是列表）验证response。
+    如果没有指定，则使用validator
+    """
+    if user_data:
+        try:
+            validator = user_data['ProxyMiddleware']['validator']
+        except KeyError:
+            pass
+
+    if not hasattr(validator, '__iter__'):
+        validator_list = [validator]
+    else:
+        validator_list = validator
+
+    for v in validator_list:
+        if not v(response):
+            return False
+    return True
\ No newline at end of file
@@ -1,16 +1,312 @@
 # coding=utf-8
-from middlewares import DownloadMiddleware
+from middlewares import DownloadMiddleware, validate_response
 
 __author__ = 'zephyre'
 
 
+class ProxyStat(object):
+    """
+    单个代理服务器的统计信息
+    """
+
+    __slots__ = ('name', 'latency', 'success', 'req_cnt', 'fail_cnt', 'idx', 'revive_ts')
+
+    def __init__(self, name, latency):
+        self.name = name
+        # 延迟（秒）和成功率的指数加权移动平均。新加入的代理默认是健康的，以便尽快被试用
+        self.latency = latency
+        self.success = 1.0
+        self.req_cnt = 0
+        # 连续失败的次数
+        self.fail_cnt = 0
+        # 在ProxyPool._active中的位置。-1表示处于冷却状态
+        self.idx = -1
+        # 冷却结束的时间
+        self.revive_ts = 0
+
+
+class ProxyPool(object):
+    """
+    代理服务器池，根据延迟和成功率（EWMA）选择代理。
+
+    选择算法为power-of-two-choices：随机抽取两个代理，使用期望代价较低的那个。期望代价为：
+    latency + (1 - success) / success * failure_penalty，即每获得一次成功的请求，平均需要付出的时间（失败的请求按照
+    failure_penalty计算，一般和请求的超时时间相当）。
+
+    连续失败超过max_error次的代理进入冷却状态，cooldown秒之后重新加入；如果在此之前后台检查成功，则立即重新加入（参见revive）。
+    除了revive之外，所有操作都是O(1)的（冷却队列按照时间顺序排列），并且不会让出greenlet，所以不需要加锁。
+    """
+
+    def __init__(self, alpha=0.3, max_error=5, cooldown=300, failure_penalty=15.0, default_latency=1.0):
+        from collections import deque
+
+        self.alpha = alpha
+        self.max_error = max_error
+        self.cooldown = cooldown
+        self.failure_penalty = failure_penalty
+        self.default_latency = default_latency
+
+        # name => ProxyStat
+        self._stats = {}
+        # 可用的代理
+        self._active = []
+        # 处于冷却状态的代理（按照revive_ts排列）
+        self._cooling = deque()
+
+    @classmethod
+    def from_settings(cls, settings):
+        conf = settings.get('proxy', {})
+        return cls(alpha=conf.get('alpha', 0.3), max_error=conf.get('max_error', 5),
+                   cooldown=conf.get('cooldown', 300), failure_penalty=conf.get('failure_penalty', 15.0),
+                   default_latency=conf.get('default_latency', 1.0))
+
+    def __len__(self):
+        return len(self._active)
+
+    def __contains__(self, name):
+        return name in self._stats
+
+    def names(self):
+        """
+        所有的代理（包括处于冷却状态的）
+        """
+        return self._stats.keys()
+
+    def add(self, name):
+        """
+        添加代理。已经存在（包括处于冷却状态）的代理会被忽略
+        :return: 是否为新的代理
+        """
+        if name in self._stats:
+            return False
+        stat = ProxyStat(name, self.default_latency)
+        self._stats[name] = stat
+        self._activate(stat)
+        return True
+
+    def _activate(self, stat):
+        stat.idx = len(self._active)
+        self._active.append(stat)
+
+    def _deactivate(self, stat):
+        """
+        从可用列表中移除：将最后一个元素移到被删除的位置
+        """
+        last = self._active.pop()
+        if last is not stat:
+            self._active[stat.idx] = last
+            last.idx = stat.idx
+        stat.idx = -1
+
+    def _revive(self):
+        from time import time
+
+        cur = time()
+        while self._cooling and self._cooling[0].revive_ts <= cur:
+            stat = self._cooling.popleft()
+            stat.fail_cnt = 0
+            # 给予重新试用的机会
+            stat.success = max(stat.success, 0.5)
+            self._activate(stat)
+
+    def revive(self, name):
+        """
+        提前结束某个代理的冷却（比如后台检查成功）：重置失败次数和成功率，并重新加入可用列表。
+        需要从冷却队列的中间删除，所以是O(n)的，只在检查成功时调用
+        :return: 如果代理原来处于冷却状态，返回True
+        """
+        stat = self._stats.get(name)
+        if stat is None or stat.idx >= 0:
+            return False
+
+        self._cooling.remove(stat)
+        stat.fail_cnt = 0
+        stat.success = 1.0
+        self._activate(stat)
+        return True
+
+    def cost(self, stat):
+        success = max(stat.success, 0.01)
+        return stat.latency + (1 - success) / success * self.failure_penalty
+
+    def pick(self):
+        """
+        选择一个代理。没有可用的代理时，返回None
+        """
+        from random import randrange
+
+        self._revive()
+
+        size = len(self._active)
+        if not size:
+            return None
+
+        stat = self._active[randrange(size)]
+        if size > 1:
+            other = self._active[randrange(size)]
+            if self.cost(other) < self.cost(stat):
+                stat = other
+
+        stat.req_cnt += 1
+        return stat.name
+
+    def record(self, name, success, latency=None):
+        """
+        记录一次请求的结果
+        :param latency: 请求耗时（秒）。请求失败时，一般无法获得
+        :return: 如果代理因此进入冷却状态，返回True
+        """
+        from time import time
+
+        stat = self._stats.get(name)
+        if stat is None:
+            return False
+
+        alpha = self.alpha
+        stat.success = (1 - alpha) * stat.success + alpha * (1.0 if success else 0.0)
+        if latency is not None:
+            stat.latency = (1 - alpha) * stat.latency + alpha * latency
+
+        if success:
+            stat.fail_cnt = 0
+            return False
+
+        stat.fail_cnt += 1
+        if stat.fail_cnt > self.max_error and stat.idx >= 0:
+            self._deactivate(stat)
+            stat.revive_ts = time() + self.cooldown
+            self._cooling.append(stat)
+            return True
+        return False
+
+    def report(self):
+        if not self._stats:
+            return []
+
+        self._revive()
+
+        # 按照成功率分组
+        buckets = [0, 0, 0]
+        for stat in self._active:
+            buckets[0 if stat.success < 0.5 else (1 if stat.success < 0.8 else 2)] += 1
+
+        lines = ['Proxy pool: %d active, %d cooling down. Success rate: <50%%: %d, 50-80%%: %d, >=80%%: %d' % (
+            len(self._active), len(self._cooling), buckets[0], buckets[1], buckets[2])]
+
+        if self._active:
+            latencies = sorted(stat.latency for stat in self._active)
+            size = len(latencies)
+            lines.append('Proxy pool latency: p50 %.2fs, p90 %.2fs, max %.2fs' % (
+                latencies[size / 2], latencies[min(size - 1, int(size * 0.9))], latencies[-1]))
+        return lines
+
+
+class ProxyProber(object):
+    """
+    在后台检查代理池中的所有代理（包括处于冷却状态的）：通过代理请求canary_url，并将结果计入ProxyPool的统计。
+    这样，失效的代理在真实的请求失败之前就会被发现；处于冷却状态的代理检查成功时，立即重新加入可用列表。
+
+    请求直接通过requests发出，不经过download middleware。
+    """
+
+    def __init__(self, pool, canary_url, timeout=3, interval=60, concur=20, expect=None, logger=None):
+        """
+        :param expect: 如果指定，response中必须包含这个字符串才算成功
+        """
+        self.pool = pool
+        self.canary_url = canary_url
+        self.timeout = timeout
+        self.interval = interval
+        self.concur = concur
+        self.expect = expect
+        self.logger = logger
+
+        # 最近一轮的统计：(检查的代理数量, 成功数量, 耗时)
+        self.last_round = None
+
+    @classmethod
+    def from_settings(cls, pool, settings, logger=None):
+        """
+        没有配置canary URL时，返回None
+        """
+        conf = settings.get('proxy', {})
+        url = conf.get('probe_url')
+        if not url:
+            return None
+        return cls(pool, url, timeout=conf.get('probe_timeout', 3), interval=conf.get('probe_interval', 60),
+                   concur=conf.get('probe_concur', 20), expect=conf.get('probe_expect'), logger=logger)
+
+    def probe(self, name, session=None):
+        """
+        通过某个代理请求canary URL
+        :return: (是否成功, 耗时（秒）)。失败时，耗时为None
+        """
+        import requests
+
+        session = session or requests
+        try:
+            response = session.get(self.canary_url, proxies={'http': name, 'https': name}, timeout=self.timeout,
+                                   allow_redirects=False)
+        except (IOError, ValueError):
+            return False, None
+
+        success = response.status_code == 200 and (self.expect is None or self.expect in response.text)
+        return success, response.elapsed.total_seconds() if success else None
+
+    def probe_all(self):
+        """
+        检查一轮代理池中的所有代理
+        :return: 成功的代理数量
+        """
+        from time import time
+        from gevent.pool import Pool
+        import requests
+
+        names = self.pool.names()
+        ts = time()
+        session = requests.Session()
+        try:
+            def func(name):
+                success, latency = self.probe(name, session)
+                self.pool.record(name, success, latency)
+                if success and self.pool.revive(name) and self.logger:
+                    self.logger.debug('Proxy %s revived by probing' % name)
+                return success
+
+            ok_cnt = sum(Pool(self.concur).imap_unordered(func, names))
+        finally:
+            session.close()
+
+        self.last_round = (len(names), ok_cnt, time() - ts)
+        return ok_cnt
+
+    def run(self):
+        """
+        后台循环，每隔interval秒检查一轮
+        """
+        import gevent
+
+        while True:
+            try:
+                self.probe_all()
+                if self.logger:
+                    self.logger.debug('Proxy probing: %d probed, %d ok, %.1fs' % self.last_round)
+            except Exception:
+                if self.logger:
+                    self.logger.error('Proxy probing failed', exc_info=True)
+            gevent.sleep(self.interval)
+
+    def report(self):
+        if not self.last_round:
+            return []
+        return ['Proxy prober: %d probed, %d ok in the last round (%.1fs)' % self.last_round]
+
+
 class ProxyMiddleware(DownloadMiddleware):
     """
     Proxify traffic
     """
 
-    max_error = 5
-
     def load_proxies(self):
         """
         通过API接口，更新可用代理列表
@@ -20,30 +316,15 @@ class ProxyMiddleware(DownloadMiddleware):
                                                     'verifier=all&latency=2&pageSize=500&recently=24', proxies={})
 
         def func(entry):
-            proxy = '%s://%s:%d' % (entry['scheme'], entry['host'], entry['port'])
-            return proxy, {'failCnt': 0, 'reqCnt': 0}
+            return '%s://%s:%d' % (entry['scheme'], entry['host'], entry['port'])
 
         # 和现有的代理列表融合
-        new_proxies = dict(map(func, filter(lambda v: not v['user'], response.json()['result'])))
+        new_proxies = map(func, filter(lambda v: not v['user'], response.json()['result']))
+        new_cnt = len(filter(self.pool.add, new_proxies))
 
-        new_cnt = 0
-        try:
-            self.rw_lock.writer_acquire()
-            for proxy_name, proxy_data in new_proxies.items():
-                if proxy_name in self.dead_proxies:
-                    continue
-
-                if proxy_name not in self.proxies:
-                    new_cnt += 1
-                    self.proxies[proxy_name] = proxy_data
-
-            self._manager.engine.logger.info('%d proxies added to the pool. Total proxies: %d, dead proxies: %d' %
-                                             (new_cnt, len(self.proxies), len(self.dead_proxies)))
-        finally:
-            self.rw_lock.writer_release()
+        self._manager.engine.logger.info('%d proxies added to the pool. %s' % (new_cnt, self.pool.report()[0]))
 
     def __init__(self, manager):
-        from utils.locking import RWLock
         import argparse
 
         DownloadMiddleware.__init__(self, manager)
@@ -58,45 +339,39 @@ class ProxyMiddleware(DownloadMiddleware):
         if not dhaulagiri_settings['proxy']['enabled']:
             raise RuntimeError
 
-        self.rw_lock = RWLock()
+        self.pool = ProxyPool.from_settings(dhaulagiri_settings)
 
-        self.proxies = {}
-        # 被禁用的代理服务器列表
-        self.dead_proxies = {}
+        import gevent
 
-        from threading import Timer
+        logger = manager.engine.logger
+        # 默认每10分钟刷新一次代理列表
+        refresh_interval = dhaulagiri_settings['proxy'].get('refresh_interval', 600)
 
-        # 每10分钟刷新一次代理列表
-        refresh_interval = 600
+        def refresh():
+            while True:
+                gevent.sleep(refresh_interval)
+                logger.debug('Loading proxies...')
+                try:
+                    self.load_proxies()
+                except Exception:
+                    logger.error('Failed to load proxies', exc_info=True)
 
-        def task():
-            manager.engine.logger.debug('Loading proxies...')
-            self.load_proxies()
-            t = Timer(refresh_interval, task, ())
-            t.daemon = True
-            t.start()
+        self.load_proxies()
+        self.refresher = gevent.spawn(refresh)
 
-        task()
+        # 后台的代理检查。需要配置proxy.probe_url
+        self.prober = ProxyProber.from_settings(self.pool, dhaulagiri_settings, logger)
+        self.probe_greenlet = gevent.spawn(self.prober.run) if self.prober else None
 
     def __fetch(self):
-        from random import randint
-
-        try:
-            self.rw_lock.reader_acquire()
-
-            if not self.proxies:
-                # No available proxies
-                self._manager.engine.logger.warn('No available proxies.')
-                return
+        proxy = self.pool.pick()
+        if not proxy:
+            # No available proxies
+            self._manager.engine.logger.warn('No available proxies.')
+            return
 
-            plist = self.proxies.keys()
-            proxy = plist[randint(0, len(plist) - 1)]
-            self.proxies[proxy]['reqCnt'] += 1
-
-            self._manager.engine.logger.debug('Proxy fetched: %s' % proxy)
-            return proxy
-        finally:
-            self.rw_lock.reader_release()
+        self._manager.engine.logger.debug('Proxy fetched: %s' % proxy)
+        return proxy
 
     def on_request(self, req, session=None, session_kwarags=None, user_data=None):
         if 'proxies' not in session_kwarags or session_kwarags['proxies'] is None:
@@ -106,94 +381,31 @@ class ProxyMiddleware(DownloadMiddleware):
 
         return {'next': True, 'value': (req, session, session_kwarags)}
 
-    def drop_proxy(self, proxy_name):
-        """
-        禁用某个代理服务器
-        """
-        try:
-            self.rw_lock.writer_acquire()
-            if proxy_name in self.proxies:
-                self._manager.engine.logger.warn('Disable proxy: %s' % proxy_name)
-                p = self.proxies.pop(proxy_name)
-                self.dead_proxies[proxy_name] = p
-                self._manager.engine.logger.info(
-                    'Available proxies: %d, disabled proxies: %d' % (len(self.proxies), len(self.dead_proxies)))
-        finally:
-            self.rw_lock.writer_release()
-
-    def add_fail_cnt(self, proxy_name):
-        drop_flag = False
-        try:
-            self.rw_lock.writer_acquire()
-            if proxy_name not in self.proxies:
-                return
-
-            self.proxies[proxy_name]['failCnt'] += 1
-            self._manager.engine.logger.debug(
-                'Proxy: %s failCnt added to %d' % (proxy_name, self.proxies[proxy_name]['failCnt'] ))
-            if self.proxies[proxy_name]['failCnt'] > self.max_error:
-                drop_flag = True
-        finally:
-            self.rw_lock.writer_release()
-
-        if drop_flag:
-            self.drop_proxy(proxy_name)
-
-    def reset_fail_cnt(self, proxy_name):
-        try:
-            self.rw_lock.writer_acquire()
-            if proxy_name not in self.proxies:
-                return
-            self.proxies[proxy_name]['failCnt'] = 0
-        finally:
-            self.rw_lock.writer_release()
+    def record(self, proxy_name, success, latency=None):
+        if self.pool.record(proxy_name, success, latency):
+            self._manager.engine.logger.warn('Proxy %s cooling down for %d seconds' % (proxy_name, self.pool.cooldown))
 
     def on_failure(self, request, s_args):
-        if 'proxies' in s_args:
-            self.add_fail_cnt(s_args['proxies']['http'])
+        if s_args.get('proxies'):
+            self.record(s_args['proxies']['http'], False)
 
         return False
 
-    @staticmethod
-    def default_validator(response):
-        """
-        默认的response验证器，通过判断HTTP status code来确定代理是否有效
-
-        :param response:
-        :return:
-        """
-        return response.status_code in [200, 301, 302, 304]
-
     def on_response(self, response, user_data=None):
         result = {'next': True, 'value': response, 'success': True}
 
-        validator = self.default_validator
-        if user_data:
-            try:
-                validator = user_data['ProxyMiddleware']['validator']
-            except KeyError:
-                pass
-
-        if not hasattr(validator, '__iter__'):
-            validator_list = [validator]
-        else:
-            validator_list = validator
-
-        success = True
-        for v in validator_list:
-            success = success and v(response)
-            if not success:
-                break
+        success = validate_response(response, user_data)
         result['success'] = success
 
         tmp = response.connection.proxy_manager.keys()
-        if tmp and tmp[0] in self.proxies:
+        if tmp and tmp[0] in self.pool:
             proxy_name = tmp[0]
-            if success:
-                self.reset_fail_cnt(proxy_name)
-            else:
+            self.record(proxy_name, success, response.elapsed.total_seconds())
+            if not success:
                 self._manager.engine.logger.debug('Proxy: %s failed in validation' % proxy_name)
-                self.add_fail_cnt(proxy_name)
                 result['next'] = False
 
         return result
+
+    def report(self):
+        return self.pool.report() + (self.prober.report() if self.prober else [])
@@ -0,0 +1,195 @@
+# coding=utf-8
+from urlparse import urlparse
+
+import gevent
+
+from middlewares import DownloadMiddleware, validate_response
+
+__author__ = 'zephyre'
+
+
+class TokenBucket(object):
+    """
+    令牌桶。rate为每秒产生的令牌数，burst为桶的容量
+    """
+
+    def __init__(self, rate, burst=1):
+        from time import time
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time()
+
+    def _refill(self):
+        from time import time
+
+        cur = time()
+        self.tokens = min(self.burst, self.tokens + (cur - self.ts) * self.rate)
+        self.ts = cur
+
+    def acquire(self):
+        """
+        获得一个令牌。如果桶已空，则等待
+        """
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            gevent.sleep((1 - self.tokens) / self.rate)
+
+
+class ThrottleMiddleware(DownloadMiddleware):
+    """
+    按照host进行限速。每个host对应一个令牌桶，其速率按照AIMD的方式调整：
+    请求成功时，速率线性增加（每秒大约增加increase）；验证失败或者请求出错时，速率乘以decrease。
+
+    此外，每个host同时进行的请求不超过concurrency个（0表示不限制）。名额由发出请求的greenlet持有，
+    在on_response或者on_failure中释放。如果请求因为其它异常而中断，名额在这个greenlet下一次请求或者结束时收回。
+
+    验证器和ProxyMiddleware相同（user_data['ProxyMiddleware']['validator']）。
+    由于ProxyMiddleware在on_response和on_failure中会中断后续middleware，本middleware的priority必须比ProxyMiddleware高，
+    否则名额无法释放。MiddlewareManager在加载时检查（参见run_before）。
+    """
+
+    run_before = ('ProxyMiddleware',)
+
+    def __init__(self, manager):
+        import argparse
+
+        DownloadMiddleware.__init__(self, manager)
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--throttle', action='store_true')
+        args, leftover = parser.parse_known_args()
+
+        from core import dhaulagiri_settings
+
+        settings = dhaulagiri_settings.setdefault('throttle', {})
+        settings['enabled'] = args.throttle
+        if not settings['enabled']:
+            raise RuntimeError
+
+        self.default_conf = {'rate': settings.get('rate', 2.0),
+                             'min_rate': settings.get('min_rate', 0.1),
+                             'max_rate': settings.get('max_rate', 50.0),
+                             'burst': settings.get('burst', 1),
+                             'increase': settings.get('increase', 0.5),
+                             'decrease': settings.get('decrease', 0.5),
+                             'concurrency': settings.get('concurrency', 8)}
+        # 针对某些host的特殊配置
+        self.host_conf = settings.get('hosts', {}) or {}
+
+        # host => {'bucket': TokenBucket, 'slots': 并发名额（BoundedSemaphore，不限制时为None）, 'conf': {...},
+        # 'backoff_ts': 最近一次降速的时间}
+        self.hosts = {}
+        # greenlet => 持有的并发名额
+        self.holders = {}
+
+    def _get_host(self, host):
+        if host not in self.hosts:
+            from gevent.lock import BoundedSemaphore
+
+            conf = dict(self.default_conf)
+            conf.update(self.host_conf.get(host, {}))
+            slots = BoundedSemaphore(conf['concurrency']) if conf['concurrency'] else None
+            self.hosts[host] = {'bucket': TokenBucket(conf['rate'], conf['burst']), 'slots': slots, 'conf': conf,
+                                'backoff_ts': 0}
+        return self.hosts[host]
+
+    def _acquire_slot(self, entry):
+        """
+        为当前greenlet获得一个并发名额
+        """
+        slots = entry['slots']
+        if slots is None:
+            return
+
+        slots.acquire()
+        g = gevent.getcurrent()
+        self.holders[g] = slots
+        # greenlet结束时收回名额（比如请求过程中被kill）
+        if hasattr(g, 'rawlink'):
+            g.rawlink(self._release_slot)
+
+    def _release_slot(self, g=None):
+        """
+        释放greenlet持有的并发名额
+        """
+        if g is None:
+            g = gevent.getcurrent()
+        slots = self.holders.pop(g, None)
+        if slots is None:
+            return
+
+        slots.release()
+        if hasattr(g, 'unlink'):
+            g.unlink(self._release_slot)
+
+    def increase(self, host):
+        entry = self._get_host(host)
+        bucket = entry['bucket']
+        conf = entry['conf']
+        bucket.rate = min(conf['max_rate'], bucket.rate + conf['increase'] / bucket.rate)
+
+    def decrease(self, host):
+        from time import time
+
+        entry = self._get_host(host)
+        bucket = entry['bucket']
+        conf = entry['conf']
+
+        # 同一批失败的请求，只降速一次
+        cur = time()
+        if cur - entry['backoff_ts'] < 1.0 / bucket.rate:
+            return
+        entry['backoff_ts'] = cur
+
+        bucket.rate = max(conf['min_rate'], bucket.rate * conf['decrease'])
+        self._manager.engine.logger.debug('Throttle: %s slowed down to %.2f/s' % (host, bucket.rate))
+
+    def on_request(self, req, session=None, session_kwarags=None, user_data=None):
+        # 上一次请求没有经过on_response/on_failure（比如后续的middleware抛出了异常），名额仍然被持有
+        self._release_slot()
+
+        entry = self._get_host(urlparse(req.url).netloc)
+        self._acquire_slot(entry)
+        entry['bucket'].acquire()
+        return {'next': True, 'value': (req, session, session_kwarags)}
+
+    def on_response(self, response, user_data=None):
+        self._release_slot()
+
+        # 发生重定向时（比如去哪儿的security.qunar.com），以原始请求的host为准
+        url = response.history[0].url if response.history else response.url
+        host = urlparse(url).netloc
+
+        success = validate_response(response, user_data)
+        if success:
+            self.increase(host)
+        else:
+            self.decrease(host)
+
+        return {'next': True, 'value': response, 'success': success}
+
+    def on_failure(self, request, s_args):
+        self._release_slot()
+        self.decrease(urlparse(request.url).netloc)
+        return True
+
+    def in_flight(self, host):
+        """
+        某个host正在进行的请求数量
+        """
+        entry = self.hosts.get(host)
+        if not entry or entry['slots'] is None:
+            return 0
+        return entry['conf']['concurrency'] - entry['slots'].counter
+
+    def report(self):
+        if not self.hosts:
+            return []
+        rates = ', '.join('%s: %.2f/s, %d in flight' % (host, self.hosts[host]['bucket'].rate, self.in_flight(host))
+                          for host in sorted(self.hosts))
+        return ['Throttle: %s' % rates]
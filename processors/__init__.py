@@ -3,12 +3,23 @@ from Queue import Empty
 import signal
 
 from core import LoggerMixin
+from utils.bloom import key_filters, refresh_key_filters, save_key_filters
+from utils.cache import page_caches
+from utils.scheduler import get_scheduler, schedulers
 
 
 __author__ = 'zephyre'
 
 import gevent
 
+# 任务对象上，和调度相关的属性：
+# task_key: 用于task tracking
+# priority: 用于PriorityScheduler，数值越大越优先
+# task_host: 用于FairShareScheduler
+# task_desc: 用于RedisScheduler，可序列化的任务描述，参见BaseProcessor.build_task
+# resume_key: 任务在cursor中的排序键，用于checkpoint
+task_attributes = ('task_key', 'priority', 'task_host', 'task_desc', 'resume_key')
+
 
 class Worker(object):
     __index = 0
@@ -45,16 +56,20 @@ class Worker(object):
             self.total_tasks += 1
             self.processor.incr_progress()
 
-            if task_tracker:
-                # Task tracking机制已启用
+            if task_tracker and not getattr(task, 'task_tracked', False):
+                # Task tracking机制已启用（在add_task中批量检查过的任务，不必再次检查）
                 if task_tracker.track(task):
                     self.logger.debug('Task %s bypassed' % getattr(task, 'task_key'))
                     self.processor.bypassed_cnt += 1
+                    self._task_queue.task_done(task)
+                    self.processor.complete_task(task)
                     continue
 
             self.logger.debug('Task #%d started' % self.total_tasks)
             # 任务成功的标识
             success_flag = True
+            # 任务执行期间的BulkWriter操作，都归属于这个任务
+            setattr(g, 'bulk_owner', task)
             try:
                 ret = task()
                 # 满足一致性。如果ret不是iterable，则将其转换为列表
@@ -63,21 +78,23 @@ class Worker(object):
                 for r in ret:
                     if hasattr(r, '__call__'):
                         # 返回值是一个回调函数
-                        self.processor.add_task(r)
+                        self.processor.add_subtask(r, parent=task)
             except Exception as e:
                 success_flag = False
                 if e.message:
                     self.logger.error('Error occured: %s' % e.message, exc_info=True)
                 else:
                     self.logger.error('Error occured: unknown', exc_info=True)
+            finally:
+                setattr(g, 'bulk_owner', None)
 
             if success_flag:
                 self.success_cnt += 1
             else:
                 self.fail_cnt += 1
 
-            if success_flag and task_tracker:
-                task_tracker.update(task)
+            # 更新task tracking和checkpoint，并确认任务已经执行完毕。如果任务还有缓冲中的写入，则等到写入成功之后再进行
+            self.processor.finish_task(task, success_flag)
 
             self.logger.debug('Task #%d completed' % self.total_tasks)
 
@@ -111,6 +128,9 @@ class Worker(object):
 
 class BaseProcessor(LoggerMixin):
     name = 'base-processor'
+    # 是否支持多进程模式（--processes N）。只有通过shard_cursor/shard_source划分任务来源的processor才能设为True，
+    # 否则每个分片都会完整地执行一遍
+    shardable = False
 
     @classmethod
     def from_engine(cls, engine, *args, **kwargs):
@@ -125,7 +145,6 @@ class BaseProcessor(LoggerMixin):
         from time import time
         from hashlib import md5
         from threading import Lock
-        from gevent.queue import LifoQueue
 
         self.processor_name = '%s:%s' % (self.name, md5(str(time())).hexdigest()[:6])
 
@@ -144,9 +163,16 @@ class BaseProcessor(LoggerMixin):
 
         # 超过这一限制时，add_task就暂停向其中添加任务
         self.maxsize = 1000
-        self.tasks = LifoQueue()
         self.workers = []
 
+        # 等待批量检查task tracking的任务
+        self._tracking_buffer = []
+        # 已经执行完毕，但是BulkWriter中还有尚未写入的操作的任务
+        self._unsettled = []
+        # 因为写入失败而失败的任务数量
+        self.write_failed_cnt = 0
+        self.settler = None
+
         # 默认的polling间隔为1秒
         self.polling_interval = 1
 
@@ -155,6 +181,14 @@ class BaseProcessor(LoggerMixin):
         arg_parser = argparse.ArgumentParser()
         # 并发数量
         arg_parser.add_argument('--concur', type=int)
+        # 任务调度器
+        arg_parser.add_argument('--scheduler', choices=sorted(schedulers.keys()))
+        # 只消费任务（配合--scheduler redis使用，由其它节点添加任务）
+        arg_parser.add_argument('--consumer', action='store_true')
+        # 从上次保存的checkpoint处继续
+        arg_parser.add_argument('--resume', action='store_true')
+        # CPU密集型任务的进程数，参见offload。0表示不使用进程池
+        arg_parser.add_argument('--offload', type=int)
         args, leftover = arg_parser.parse_known_args()
 
         from core import dhaulagiri_settings
@@ -163,6 +197,20 @@ class BaseProcessor(LoggerMixin):
             dhaulagiri_settings['core']['concur'] = args.concur
         self.concur = dhaulagiri_settings['core']['concur']
 
+        if args.scheduler:
+            dhaulagiri_settings['core']['scheduler'] = args.scheduler
+        scheduler = dhaulagiri_settings['core'].get('scheduler', 'lifo')
+        # RedisScheduler需要通过build_task在消费者中重建任务
+        if scheduler == 'redis' and type(self).build_task.__func__ is BaseProcessor.build_task.__func__:
+            arg_parser.error('%s does not support --scheduler redis: it does not implement build_task' % self.name)
+        self.tasks = get_scheduler(scheduler, maxsize=self.maxsize, processor=self)
+        self.consumer = args.consumer
+
+        from utils.bulk import BulkWriter
+
+        # MongoDB的批量写入
+        self.bulk = BulkWriter.from_settings(dhaulagiri_settings, self.logger)
+
         self.checkpoint_ts = None
         self.checkpoint_prog = None
         self.init_ts = time()
@@ -170,6 +218,29 @@ class BaseProcessor(LoggerMixin):
         # 心跳任务
         self.heart_beat = None
 
+        import conf
+
+        # 多进程模式下的分片信息，参见utils.shard.ShardSupervisor
+        self.shard = conf.global_conf.get('shard')
+
+        from utils.checkpoint import Checkpoint
+
+        # cursor的遍历进度。各个分片分别保存
+        checkpoint_name = self.name
+        if self.shard:
+            checkpoint_name = '%s:shard-%d-%d' % (self.name, self.shard['index'], self.shard['total'])
+        self.cursor_checkpoint = Checkpoint.from_settings(checkpoint_name, dhaulagiri_settings)
+        self.resume = args.resume
+
+        from utils.procpool import ProcessPool
+
+        # 执行CPU密集型任务的进程池。子进程在第一次调用offload时才会启动。
+        # 没有指定--offload或者core.offload时，进程数由default_offload决定（默认不使用进程池）
+        offload = args.offload if args.offload is not None else dhaulagiri_settings['core'].get('offload')
+        if offload is None:
+            offload = self.default_offload()
+        self.offload_pool = ProcessPool(offload) if offload else None
+
         # worker的Monitor。Worker在每次循环开始的时候，都会在该对象中进行一次状态更新
         self.worker_monitor = {}
 
@@ -200,9 +271,216 @@ class BaseProcessor(LoggerMixin):
 
         return {'zombie': zombie, 'active': active}
 
+    def heartbeat_reports(self):
+        """
+        各个组件的统计信息，在心跳日志中输出
+        :return:
+        """
+        lines = self.tasks.report() + self.bulk.report() + self.request.report() + self.cursor_checkpoint.report()
+        if self._unsettled or self.write_failed_cnt:
+            lines.append('Tasks waiting for buffered writes: %d, failed in writes: %d' % (len(self._unsettled),
+                                                                                       self.write_failed_cnt))
+        if self.offload_pool:
+            lines.extend(self.offload_pool.report())
+        for kf in key_filters.values():
+            lines.extend(kf.report())
+        for cache in page_caches.values():
+            lines.extend(cache.report())
+
+        mw_manager = getattr(self.engine, 'middleware_manager', None)
+        if mw_manager:
+            for mw_list in mw_manager.mw_dict.values():
+                for entry in mw_list:
+                    lines.extend(entry['middleware'].report())
+
+        return lines
+
+    def default_offload(self):
+        """
+        没有指定--offload时，进程池的进程数。0表示不使用进程池，offload直接在当前进程中执行
+        """
+        return 0
+
+    def offload(self, func, *args):
+        """
+        在进程池中执行CPU密集型的纯函数（比如HTML解析），当前greenlet等待结果，其它greenlet不受影响。
+        func必须是模块级别的函数，参数和返回值需要可以被pickle。如果没有启用进程池，则直接执行
+        """
+        if self.offload_pool is None:
+            return func(*args)
+        return self.offload_pool.apply(func, *args)
+
     def incr_progress(self):
         self.progress += 1
 
+    def resume_query(self, key='_id'):
+        """
+        如果指定了--resume，返回从上次checkpoint处继续的查询条件（包括上次失败的key）。
+        cursor需要按照key升序排列，并且任务需要设置resume_key属性
+        """
+        if not self.resume:
+            return {}
+
+        value = self.cursor_checkpoint.load()
+        if value is None:
+            self.log('No checkpoint found for %s, starting from the beginning' % self.cursor_checkpoint.name)
+            return {}
+
+        failed = list(self.cursor_checkpoint.failed)
+        self.log('Resuming %s from %s > %s (%d failed to retry)' % (self.cursor_checkpoint.name, key, value,
+                                                                     len(failed)))
+        query = {key: {'$gt': value}}
+        return {'$or': [query, {key: {'$in': failed}}]} if failed else query
+
+    def complete_task(self, task):
+        """
+        任务已经完成（或者被忽略），更新checkpoint
+        """
+        if hasattr(task, 'resume_key'):
+            self.cursor_checkpoint.complete(getattr(task, 'resume_key'))
+
+    def fail_task(self, task):
+        """
+        任务失败，在checkpoint中单独记录，恢复时重新处理
+        """
+        if hasattr(task, 'resume_key'):
+            self.cursor_checkpoint.fail(getattr(task, 'resume_key'))
+
+    def finish_task(self, task, success):
+        """
+        任务执行完毕。如果任务还有尚未完成的后续任务（参见add_subtask），或者在BulkWriter中还有尚未写入的操作，
+        则等到它们完成之后再提交（参见settle_tasks）
+        """
+        if getattr(task, 'subtasks_pending', 0):
+            setattr(task, 'own_success', success)
+            return
+        if success and getattr(task, 'subtasks_failed', False):
+            success = False
+        if success and self.bulk.pending(task):
+            self._unsettled.append(task)
+            return
+        self._settle_task(task, success)
+
+    def _settle_task(self, task, success):
+        if success and self.bulk.failed(task):
+            success = False
+            self.write_failed_cnt += 1
+            self.logger.error('Task%s failed: buffered writes could not be stored' % (
+                '(%s)' % task.task_key if hasattr(task, 'task_key') else ''))
+        self.bulk.forget(task)
+
+        if success:
+            task_tracker = self.engine.task_tracker
+            if task_tracker:
+                task_tracker.update(task)
+            self.complete_task(task)
+        else:
+            self.fail_task(task)
+
+        # 确认任务已经执行完毕（对于RedisScheduler，未确认的任务会在超时后重新分配）
+        self.tasks.task_done(task)
+
+        parent = getattr(task, 'parent_task', None)
+        if parent is not None:
+            self._subtask_done(parent, success)
+
+    def _subtask_done(self, parent, success):
+        """
+        某个后续任务已经提交。所有的后续任务都完成之后，提交父任务（任何一个后续任务失败，父任务也视为失败）
+        """
+        if not success:
+            setattr(parent, 'subtasks_failed', True)
+        parent.subtasks_pending -= 1
+        if not parent.subtasks_pending and hasattr(parent, 'own_success'):
+            self.finish_task(parent, parent.own_success)
+
+    def settle_tasks(self, force=False):
+        """
+        提交写入已经完成的任务
+        :param force: 如果为True，尚未写入的任务也被视为失败（用于退出时）
+        """
+        remaining = []
+        for task in self._unsettled:
+            if self.bulk.pending(task) and not force:
+                remaining.append(task)
+            else:
+                self._settle_task(task, not self.bulk.pending(task))
+        self._unsettled = remaining
+
+    def shard_cursor(self, cursor, key='_id'):
+        """
+        多进程模式下，只保留属于本分片的文档（按照key的hash值分片）。单进程模式下，直接返回cursor
+        :param key: 字段名，或者从entry中计算分片依据的函数
+        """
+        if not self.shard or self.shard['total'] <= 1:
+            return cursor
+
+        from itertools import ifilter
+        from utils.shard import shard_index
+
+        index = self.shard['index']
+        total = self.shard['total']
+        get_key = key if callable(key) else lambda entry: entry.get(key)
+        return ifilter(lambda entry: shard_index(get_key(entry), total) == index, cursor)
+
+    def shard_sql(self, column='id'):
+        """
+        多进程模式下，本分片在SQL中的条件（按照整数列取模，比如'id % 4 = 1'），由数据库完成过滤，
+        各个分片只读取自己的部分。单进程模式下返回None
+        """
+        if not self.shard or self.shard['total'] <= 1:
+            return None
+        return '%s %% %d = %d' % (column, self.shard['total'], self.shard['index'])
+
+    @classmethod
+    def plan_shards(cls, total):
+        """
+        多进程模式下，由ShardSupervisor在fork之前调用一次，返回值通过self.shard['plan']传给所有的分片。
+        通过shard_source划分任务来源的processor在这里计算_id的分段边界（参见utils.shard.id_bounds），
+        保证各个分片使用同一组边界。默认返回None，shard_source退化为shard_cursor
+        """
+        return None
+
+    def shard_source(self, source, bounds=None):
+        """
+        多进程模式下，将CursorSource的查询限制在本分片的_id范围内，各个分片只读取自己的部分。
+        无法按照_id范围划分时（没有分段边界，或者指定了sort），退化为shard_cursor
+        :param bounds: 分段边界，默认为plan_shards的返回值
+        """
+        if not self.shard or self.shard['total'] <= 1:
+            return source
+
+        from utils.shard import range_cond
+
+        if bounds is None:
+            bounds = self.shard.get('plan')
+        if bounds is not None and source.key == '_id' and not source.sort:
+            cond = range_cond(bounds, self.shard['index'])
+            source.query = {'$and': [source.query, {'_id': cond}]} if source.query else {'_id': cond}
+            return source
+        return self.shard_cursor(source, key=source.key)
+
+    def is_primary_shard(self):
+        """
+        单进程模式，或者多进程模式下的第一个分片。只需要执行一次的操作（比如服务器端的聚合）由它完成
+        """
+        return not self.shard or self.shard['index'] == 0
+
+    def update_shard_stats(self, done=False):
+        """
+        将本分片的进度写入共享内存，由父进程汇总
+        """
+        if not self.shard:
+            return
+
+        from time import time
+        from utils.shard import ShardSupervisor
+
+        width = len(ShardSupervisor.stat_fields)
+        offset = self.shard['index'] * width
+        self.shard['stats'][offset:offset + width] = [self.progress, self.total, self.bypassed_cnt, time(),
+                                                      1 if done else 0]
+
     def _start_workers(self):
         def timer():
             """
@@ -226,9 +504,24 @@ class BaseProcessor(LoggerMixin):
                 msg += ', active workers: %d, zombie workers: %d' % (len(stat['active']), len(stat['zombie']))
 
                 self.log(msg)
+                for line in self.heartbeat_reports():
+                    self.log(line)
+                self.update_shard_stats()
+                refresh_key_filters()
                 gevent.sleep(30)
 
+        def settle():
+            while True:
+                gevent.sleep(1)
+                self.settle_tasks()
+                # 任务完成较慢时，缓冲区可能很久都凑不满一个batch
+                if self.engine.task_tracker:
+                    self.engine.task_tracker.flush_expired()
+
         self.heart_beat = gevent.spawn(timer)
+        self.settler = gevent.spawn(settle)
+        self.bulk.start()
+        self.cursor_checkpoint.start()
 
         gevent.signal(signal.SIGKILL, gevent.kill)
         gevent.signal(signal.SIGQUIT, gevent.kill)
@@ -237,30 +530,80 @@ class BaseProcessor(LoggerMixin):
             worker = Worker.from_processor(self, self.tasks)
             self.workers.append(worker)
 
+    @staticmethod
+    def _wrap_task(task, *args, **kwargs):
+        func = lambda: task(*args, **kwargs)
+        # 调度相关的属性
+        for attr in task_attributes:
+            if hasattr(task, attr):
+                setattr(func, attr, getattr(task, attr))
+        return func
+
     def add_task(self, task, *args, **kwargs):
-        # 是否启用流量控制
-        flow_control = True
-        while flow_control:
-            # 如果self.tasks中的项目过多，则暂停添加
-            if self.tasks.qsize() > self.maxsize:
-                gevent.sleep(self.polling_interval)
-            else:
-                break
+        """
+        添加任务。如果self.tasks中的项目过多，则阻塞，直到有worker取走任务
+        """
+        func = self._wrap_task(task, *args, **kwargs)
+        task_key = getattr(func, 'task_key', None)
 
-        func = lambda: task(*args, **kwargs)
-        task_key = getattr(task, 'task_key', None)
-        if task_key:
-            setattr(func, 'task_key', task_key)
-        self.tasks.put(func, timeout=120)
+        if hasattr(func, 'resume_key'):
+            self.cursor_checkpoint.dispatch(getattr(func, 'resume_key'))
+
+        task_tracker = self.engine.task_tracker
+        if task_tracker and task_key:
+            # 批量检查，已经完成的任务不必进入队列
+            self._tracking_buffer.append(func)
+            if len(self._tracking_buffer) >= task_tracker.batch_size:
+                self._flush_tracking_buffer()
+            return
+
+        self.tasks.put(func)
         self.logger.debug('New task%s added to the queue. Remaining: %d' % ('(%s)' % task_key if task_key else '',
                                                                             self.tasks.qsize()))
         gevent.sleep(0)
 
-    def _wait_for_workers(self):
+    def _flush_tracking_buffer(self):
         """
-        等待所有的worker是否完成。判据：所有的worker都处于idle状态，并且tasks队列已空
-        :return:
+        批量检查缓冲区中的任务，只有未完成的任务才进入队列
+        """
+        buf = self._tracking_buffer
+        self._tracking_buffer = []
+        if not buf:
+            return
+
+        for func, bypass in zip(buf, self.engine.task_tracker.track_many(buf)):
+            if bypass:
+                self.logger.debug('Task %s bypassed' % getattr(func, 'task_key'))
+                self.incr_progress()
+                self.bypassed_cnt += 1
+                self.complete_task(func)
+                continue
+
+            setattr(func, 'task_tracked', True)
+            self.tasks.put(func)
+
+        self.logger.debug('Tracking checked for %d tasks. Remaining: %d' % (len(buf), self.tasks.qsize()))
+        gevent.sleep(0)
+
+    def add_subtask(self, task, parent=None):
         """
+        添加某个任务返回的后续任务。由worker调用，不受maxsize的限制，否则所有的worker都可能阻塞在这里。
+
+        父任务要等到所有的后续任务都完成之后才会提交（task tracking、checkpoint和task_done）。
+        这样，如果进程中途退出，或者某个后续任务失败，父任务不会被标记为已完成，恢复时会重新处理
+        """
+        func = self._wrap_task(task)
+        if parent is not None:
+            setattr(func, 'parent_task', parent)
+            setattr(parent, 'subtasks_pending', getattr(parent, 'subtasks_pending', 0) + 1)
+        self.tasks.put(func, force=True)
+
+    def _wait_idle(self):
+        """
+        等待所有的worker完成。判据：所有的worker都处于idle状态，并且tasks队列已空
+        """
+        self._flush_tracking_buffer()
+
         while True:
             if not self.tasks.empty():
                 gevent.sleep(self.polling_interval)
@@ -276,13 +619,39 @@ class BaseProcessor(LoggerMixin):
             if completed:
                 break
 
+    def _shutdown(self):
+        """
+        停止worker和心跳，并将各个组件的缓冲区写回
+        """
         gevent.killall([w.gevent for w in self.workers])
         gevent.kill(self.heart_beat)
+        gevent.kill(self.settler)
+        self.bulk.close()
+        self.settle_tasks(force=True)
+        self.cursor_checkpoint.close()
+        if self.offload_pool:
+            self.offload_pool.close()
+        if self.engine.task_tracker:
+            self.engine.task_tracker.flush()
+        save_key_filters()
+
+    def _wait_for_workers(self):
+        """
+        等待所有的worker完成，然后关闭各个组件
+        :return:
+        """
+        self._wait_idle()
+        self._shutdown()
 
     def run(self):
         self._start_workers()
-        self.populate_tasks()
+        if not self.consumer:
+            self.tasks.start_producing()
+            self.populate_tasks()
+            self._flush_tracking_buffer()
+            self.tasks.finish_producing()
         self._wait_for_workers()
+        self.update_shard_stats(done=True)
 
         import time
 
@@ -291,3 +660,173 @@ class BaseProcessor(LoggerMixin):
 
     def populate_tasks(self):
         raise NotImplementedError
+
+    def build_task(self, desc):
+        """
+        根据任务描述（task_desc）重建任务，用于RedisScheduler
+        :param desc: {'processor': ..., 'entry_id': ..., 'action': ...}
+        """
+        raise NotImplementedError
+
+
+class PipelineProcessor(BaseProcessor):
+    """
+    分阶段执行任务的processor：fetch（I/O，在worker greenlet中执行）=> parse（CPU密集，通过offload在进程池中执行）
+    => store（写入数据库）。
+    各个阶段之间通过有界队列连接：下游阶段处理不过来的时候，上游阶段会阻塞在put上（backpressure）。
+
+    子类需要提供：
+    * fetch(entry): 下载页面，返回交给parser的数据（比如HTML文本）。返回None表示跳过
+    * parser: 模块级别的纯函数（需要可以被pickle），接受fetch的返回值，返回解析结果。通过staticmethod声明
+    * store(entry, parsed): 保存解析结果（一般通过self.bulk批量写入）
+
+    任务本身仍然是调用self.process(entry)，所以populate_tasks/build_task等不需要修改。
+
+    任务和条目一起经过各个阶段。worker在fetch之后不提交任务：只有当任务的所有条目都完成了store
+    （并且对应的BulkWriter操作已经写入），才会更新task tracking和checkpoint，并确认任务（task_done）。
+    任何一个阶段失败，任务都视为失败。如果进程中途退出，尚未完成的任务不会被标记为已完成，恢复时会重新处理。
+
+    命令行参数：
+    * --concur: fetch阶段的并发数
+    * --offload: parse阶段的进程数，默认为CPU核数（多进程模式下由各个分片平分）
+    * --store-concur: store阶段的并发数
+    * --stage-queue: 阶段之间的队列长度
+    """
+
+    parser = None
+
+    def default_offload(self):
+        from multiprocessing import cpu_count
+
+        total = self.shard['total'] if self.shard else 1
+        return max(1, cpu_count() // total)
+
+    def _start_workers(self):
+        import argparse
+        from gevent.queue import Queue
+        from core import dhaulagiri_settings
+
+        settings = dhaulagiri_settings.get('pipeline', {})
+
+        arg_parser = argparse.ArgumentParser()
+        arg_parser.add_argument('--store-concur', type=int, default=settings.get('store_concur', 4))
+        arg_parser.add_argument('--stage-queue', type=int, default=settings.get('stage_queue', 100))
+        args, leftover = arg_parser.parse_known_args()
+
+        self.parse_queue = Queue(maxsize=args.stage_queue)
+        self.store_queue = Queue(maxsize=args.stage_queue)
+
+        # 各个阶段的统计：正在处理的数量，完成数量，失败数量
+        self.stage_stats = {'parse': [0, 0, 0], 'store': [0, 0, 0]}
+
+        parse_concur = self.offload_pool.processes if self.offload_pool else 1
+        self.stage_workers = [gevent.spawn(self._parse_loop) for _ in xrange(parse_concur)]
+        self.stage_workers.extend(gevent.spawn(self._store_loop) for _ in xrange(args.store_concur))
+
+        BaseProcessor._start_workers(self)
+
+    def _stage_loop(self, name, in_queue, func):
+        """
+        :param func: func(entry, data)。返回True表示条目已经处理完毕，返回False表示条目已经交给了下一个阶段
+        """
+        stat = self.stage_stats[name]
+        g = gevent.getcurrent()
+        while True:
+            task, entry, data = in_queue.get()
+            stat[0] += 1
+            # 这一阶段的BulkWriter操作，仍然归属于原来的任务
+            setattr(g, 'bulk_owner', task)
+            try:
+                finished = func(entry, data)
+                stat[1] += 1
+                if finished:
+                    self._entry_done(task, True)
+            except Exception as e:
+                stat[2] += 1
+                self.logger.error('Error occured in the %s stage: %s' % (name, e.message or 'unknown'), exc_info=True)
+                self._entry_done(task, False)
+            finally:
+                setattr(g, 'bulk_owner', None)
+                stat[0] -= 1
+
+    def _parse_loop(self):
+        def func(entry, data):
+            parsed = self.offload(self.parser, data)
+            if parsed is None:
+                return True
+            task = getattr(gevent.getcurrent(), 'bulk_owner', None)
+            self.store_queue.put((task, entry, parsed))
+            return False
+
+        self._stage_loop('parse', self.parse_queue, func)
+
+    def _store_loop(self):
+        def func(entry, parsed):
+            self.store(entry, parsed)
+            return True
+
+        self._stage_loop('store', self.store_queue, func)
+
+    def process(self, entry):
+        data = self.fetch(entry)
+        if data is not None:
+            # worker执行任务期间，bulk_owner就是当前的任务
+            task = getattr(gevent.getcurrent(), 'bulk_owner', None)
+            if task is not None:
+                setattr(task, 'pipeline_pending', getattr(task, 'pipeline_pending', 0) + 1)
+            # 如果parse阶段处理不过来，在这里阻塞
+            self.parse_queue.put((task, entry, data))
+
+    def _entry_done(self, task, success):
+        """
+        任务的一个条目完成了（或者在某个阶段失败了）
+        """
+        if task is None:
+            return
+        if not success:
+            setattr(task, 'pipeline_failed', True)
+        task.pipeline_pending -= 1
+        self._finish_pipeline_task(task)
+
+    def _finish_pipeline_task(self, task):
+        if task.pipeline_pending == 0 and getattr(task, 'pipeline_fetched', False):
+            BaseProcessor.finish_task(self, task, not getattr(task, 'pipeline_failed', False))
+
+    def finish_task(self, task, success):
+        """
+        worker执行完毕（fetch阶段结束）。如果任务还有条目在parse或者store阶段中，则等到它们完成之后再提交
+        """
+        if not hasattr(task, 'pipeline_pending'):
+            return BaseProcessor.finish_task(self, task, success)
+
+        if not success:
+            setattr(task, 'pipeline_failed', True)
+        setattr(task, 'pipeline_fetched', True)
+        self._finish_pipeline_task(task)
+
+    def fetch(self, entry):
+        raise NotImplementedError
+
+    def store(self, entry, parsed):
+        raise NotImplementedError
+
+    def _stages_drained(self):
+        return self.parse_queue.empty() and self.store_queue.empty() and \
+            all(stat[0] == 0 for stat in self.stage_stats.values())
+
+    def _wait_for_workers(self):
+        self._wait_idle()
+
+        # fetch阶段已经结束，等待parse和store阶段处理完队列中剩余的条目
+        while not self._stages_drained():
+            gevent.sleep(self.polling_interval)
+
+        gevent.killall(self.stage_workers)
+        self._shutdown()
+
+    def heartbeat_reports(self):
+        lines = ['Pipeline queues: parse %d, store %d' % (self.parse_queue.qsize(), self.store_queue.qsize())]
+        for name in ('parse', 'store'):
+            running, done, failed = self.stage_stats[name]
+            lines.append('Pipeline %s stage: %d running, %d done, %d failed' % (name, running, done, failed))
+        return BaseProcessor.heartbeat_reports(self) + lines
@@ -4,7 +4,10 @@ import logging
 import re
 
 from processors import BaseProcessor
+from utils.cache import get_page_cache
 from utils.database import get_mongodb
+from utils.html import parse_html, select
+from utils.rank import MongoPercentileIndex
 from utils.mixin import MfwSuggestion, BaiduSuggestion
 
 
@@ -13,6 +16,7 @@ __author__ = 'zephyre'
 
 class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
     name = 'baidu-scene'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -293,13 +297,19 @@ class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
 
         return data
 
+    # 计算hotness所用的字段：(处理后的字段, 原始数据中的字段)
+    hotness_fields = [['commentCnt', 'rating_count'], ['favorCnt', 'going_count'], ['visitCnt', 'gone_count']]
+
     @staticmethod
-    def build_hotness(entry, col, tot):
+    def build_hotness(entry, hotness_index, tot):
+        """
+        :param hotness_index: 原始数据字段 => PercentileIndex
+        """
         score_list = []
-        for k1, k2 in [['commentCnt', 'rating_count'], ['favorCnt', 'going_count'], ['visitCnt', 'gone_count']]:
+        for k1, k2 in BaiduSceneProcessor.hotness_fields:
             if k1 not in entry:
                 continue
-            score = col.find({k2: {'$lt': entry[k1]}}, {'_id': 1}).count() / float(tot)
+            score = hotness_index[k2].percentile(entry[k1], tot)
             score_list.append(score)
 
         if not score_list:
@@ -327,23 +337,18 @@ class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
             return False
 
         # 检查原网页
-        col = get_mongodb('raw_baidu', 'SceneBody', 'mongo-raw')
-        ret = col.find_one({'key': raw['sid']}, {'body': 1})
-        if ret:
-            body = ret['body']
-        else:
+        def retrieve():
             response = self.request.get('http://lvyou.baidu.com/%s' % raw['surl'])
             response.encoding = 'utf-8'
-            body = response.text
-            col.update({'key': raw['sid']}, {'$set': {'key': raw['sid'], 'body': body}}, upsert=True)
+            return response.text
 
-        from lxml import etree
+        body = get_page_cache('baidu-scene').fetch(raw['sid'], retrieve)
 
-        tree = etree.fromstring(body, parser=etree.HTMLParser())
-        if u'景点' in tree.xpath('//div[@id="J-sceneViewNav"]/a[contains(@class,"nslog")]/span/text()'):
+        tree = parse_html(body)
+        if u'景点' in select(tree, '//div[@id="J-sceneViewNav"]/a[contains(@class,"nslog")]/span/text()'):
             return True
 
-        headers = tree.xpath(
+        headers = select(tree,
             '//nav[@id="J-sceneViewNav"]/div[contains(@class,"scene-navigation")]/div[contains(@class,"nav-col")]')
         if headers:
             return True
@@ -356,6 +361,7 @@ class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
 
         col_raw = get_mongodb('raw_baidu', 'BaiduScene', profile='mongo-raw')
         tot = col_raw.count()
+        hotness_index = dict((k2, MongoPercentileIndex(col_raw, k2).rebuild()) for k1, k2 in self.hotness_fields)
 
         query = json.loads(self.args.query) if self.args.query else {}
         query = {'sid': {'$in': ['68c27ae3b9d414ff762fddfe', 'ee14f4778b2de74f2ebe67fe']}}
@@ -365,7 +371,7 @@ class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
         if self.args.limit:
             cursor.limit(self.args.limit)
 
-        for entry in cursor:
+        for entry in self.shard_cursor(cursor):
             def func(val=entry):
                 self.log(u'Processing: %s, sid=%s, surl=%s' % (val['sname'], val['sid'], val['surl']))
 
@@ -395,7 +401,7 @@ class BaiduSceneProcessor(BaseProcessor, MfwSuggestion, BaiduSuggestion):
 
                 self.build_misc(data, val)
 
-                self.build_hotness(data, col_raw, tot)
+                self.build_hotness(data, hotness_index, tot)
 
                 col = col_mdd if val['is_locality'] else col_vs
                 source = data.pop('source')
@@ -27,6 +27,7 @@ class BaiduSceneIterator(EntryIterator):
 class Coordings(BaseProcessor):
 
     name = 'coordinate'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -38,7 +39,23 @@ class Coordings(BaseProcessor):
         self.mongoconn = None
         self.http_error_count = 0
         self.error_limit = 20
-        self.to_do_list = []
+        self.error_count = 0
+        self.build_args()
+
+    def build_args(self):
+        """
+        处理命令行参数
+        """
+        import argparse
+
+        parser = argparse.ArgumentParser()
+        # 在本地完成坐标转换，不再调用远程接口
+        parser.add_argument('--offline', action='store_true')
+        parser.add_argument('--batch-size', default=1000, type=int)
+        # 离线模式下，抽取多少个点调用远程接口进行校验
+        parser.add_argument('--verify', default=0, type=int)
+        parser.add_argument('--target', choices=['gcj02', 'wgs84'], default='gcj02')
+        self.args, leftover = parser.parse_known_args()
 
     def baidu_mc_to_ll(self, latlnglist):
         """
@@ -84,19 +101,24 @@ class Coordings(BaseProcessor):
         return ll_latlngs
 
 
-    def get_latlngs(self, sp, page_num=20):
+    @staticmethod
+    def is_valid(entry):
+        try:
+            return float(entry['ext']['map_x']) > 1.0 and float(entry['ext']['map_y']) > 1.0
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def get_latlngs(self, entries):
         """
-        从数据库中获取数据
-        :param sp: page index
-        :param page_num: 一次处理的数据内容
+        提取一页数据中的坐标
+        :param entries: 一页数据
         :return: _id列表及对应的经纬度列表
         """
         idlist = []
         latlngs = []
-        for entry in self.to_do_list[int(sp) * page_num : int(sp+1) * page_num]:
-            if float(entry['ext']['map_x']) > 1.0 and float(entry['ext']['map_y']) > 1.0:
-                idlist.append(entry['_id'])
-                latlngs.append(entry['ext']['map_x'] + ',' + entry['ext']['map_y'])
+        for entry in filter(self.is_valid, entries):
+            idlist.append(entry['_id'])
+            latlngs.append(entry['ext']['map_x'] + ',' + entry['ext']['map_y'])
         return idlist, latlngs
 
 
@@ -115,20 +137,93 @@ class Coordings(BaseProcessor):
                 self.mongoconn.update({'_id': val}, {'$set': {"updatelat": True, 'glat': x, 'glng': y}})
 
 
+    def convert_offline(self, entries):
+        """
+        在本地批量转换坐标：BD-09 MC -> BD-09 -> GCJ-02（-> WGS-84）
+        :return: (lngs, lats)
+        """
+        from utils.geo import bd09mc_to_bd09_many, bd09_to_gcj02_many, gcj02_to_wgs84_many
+
+        mxs = [float(entry['ext']['map_x']) for entry in entries]
+        mys = [float(entry['ext']['map_y']) for entry in entries]
+        lngs, lats = bd09_to_gcj02_many(*bd09mc_to_bd09_many(mxs, mys))
+        if self.args.target == 'wgs84':
+            lngs, lats = gcj02_to_wgs84_many(lngs, lats)
+        return lngs, lats
+
+    def verify_offline(self, entries, lngs, lats):
+        """
+        抽取一部分点，和远程接口的转换结果进行比对
+        """
+        from utils import haversine
+
+        latlngs = ['%s,%s' % (entry['ext']['map_x'], entry['ext']['map_y']) for entry in entries]
+        remote = self.baidu_mc_to_ll(latlngs)
+        if self.args.target == 'gcj02':
+            remote = self.baidu_ll_to_google(remote)
+        if len(remote) != len(entries):
+            self.logger.warn('Unable to verify the offline conversion: remote API failed')
+            return
+
+        max_dist = 0
+        for idx, latlng in enumerate(remote):
+            lat, lng = [float(v) for v in latlng.split(',')]
+            max_dist = max(max_dist, haversine(lng, lat, float(lngs[idx]), float(lats[idx])) * 1000)
+        self.logger.info('Offline conversion verified: %d points, max deviation %.1fm' % (len(entries), max_dist))
+
+    def build_source(self, page_size):
+        from utils.database import CursorSource
+
+        return CursorSource(self.mongoconn, {'updatelat': False}, {'_id': 1, 'ext.map_x': 1, 'ext.map_y': 1},
+                            page_size=page_size)
+
+    def populate_offline(self):
+        """
+        离线模式：按批次读取BaiduScene，在本地完成转换后批量写回
+        """
+        import random
+
+        verify_left = self.args.verify
+        for page in self.build_source(self.args.batch_size).pages():
+            batch = filter(self.is_valid, self.shard_cursor(page))
+            if not batch:
+                continue
+
+            verify_size = min(verify_left, 20, len(batch))
+            verify_left -= verify_size
+
+            def task(entries=batch, sample_size=verify_size):
+                lngs, lats = self.convert_offline(entries)
+                for idx, entry in enumerate(entries):
+                    lng, lat = float(lngs[idx]), float(lats[idx])
+                    if 0.0 < lat < 90.0:
+                        self.bulk.update(self.mongoconn, {'_id': entry['_id']},
+                                         {'$set': {'updatelat': True, 'glat': lat, 'glng': lng}})
+                if sample_size:
+                    sample = random.sample(xrange(len(entries)), sample_size)
+                    self.verify_offline([entries[i] for i in sample], [lngs[i] for i in sample],
+                                        [lats[i] for i in sample])
+                self.logger.info('converted: %d' % len(entries))
+
+            self.add_task(task)
+
     def populate_tasks(self):
         # TODO: 提取配置文件
-        self.mongoconn = get_mongodb('raw_baidu', "BaiduScene", 'mongo-raw')
-        self.to_do_list = list(self.mongoconn.find({'updatelat': False}, {"_id": 1, 'ext.map_x': 1, 'ext.map_y': 1}))
-        pages = len(self.to_do_list) / 20 + 1
-        self.logger.info('total page: %s' % pages)
-        for page in range(pages):
+        self.mongoconn = get_mongodb('raw_baidu', 'BaiduScene', 'mongo-raw')
+        if self.args.offline:
+            self.populate_offline()
+            return
+
+        total = self.mongoconn.find({'updatelat': False}).count() / 20 + 1
+        self.logger.info('total page: %s' % total)
+        for page_idx, page in enumerate(self.build_source(20).pages()):
             if self.http_error_count > self.error_limit:
                 self.logger.warn('http errors exceed max limit')
                 break
-            def func(p=page, total=pages):
-                res_arr = self.get_latlngs(p, 20)
-                idlist = res_arr[0]
-                latlngs = res_arr[1]
+
+            def func(entries=list(self.shard_cursor(page)), p=page_idx):
+                idlist, latlngs = self.get_latlngs(entries)
                 self.update_latlngs(idlist, self.baidu_ll_to_google(self.baidu_mc_to_ll(latlngs)))
                 self.logger.info('complete: %s / %s' % (p, total))
-            self.add_task(func)
\ No newline at end of file
+
+            self.add_task(func)
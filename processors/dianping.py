@@ -4,12 +4,128 @@ import logging
 import re
 import argparse
 
-from processors import BaseProcessor
+import pymongo
+
+from processors import BaseProcessor, PipelineProcessor
+from utils.cache import get_page_cache
 from utils.database import get_mongodb
+from utils.geo import GeoResolver
+from utils.extract import Field, Schema
+from utils.html import iter_elements, parse_html, select
 
 
 __author__ = 'zephyre'
 
+# 大众点评的host，用于FairShareScheduler
+DIANPING_HOST = 'www.dianping.com'
+
+# 点评图片的地址模式。替换为1024c1024，以获得大图
+PIC_PATTERN = re.compile(r'(/pc/[0-9a-z]{32})\(\d+[cx]\d+\)/')
+
+
+def large_pic(url):
+    return re.sub(PIC_PATTERN, '\\1(1024c1024)/', url)
+
+
+def comment_text(text_node):
+    """
+    评论正文：将<br>转换为换行符
+    """
+    for br_node in select(text_node, './/br'):
+        br_node.tail = '\n' + br_node.tail if br_node.tail else '\n'
+    return ''.join(txt.strip(' ') for txt in text_node.itertext() if txt and txt.strip()).strip()
+
+
+def strip_dots(name):
+    """
+    去除首尾可能出现的句点
+    """
+    return re.sub(r'^\.\s*', '', re.sub(r'\s*\.$', '', name))
+
+
+# 评论列表中的单条评论（li节点）
+COMMENT_SCHEMA = Schema([
+    Field('comment_id', './@data-id', coerce=int),
+    Field('user_name', './div[@class="pic"]/a[@user-id]/img[@title and @src]/@title'),
+    Field('user_avatar', './div[@class="pic"]/a[@user-id]/img[@title and @src]/@src', coerce=large_pic),
+    Field('contents', './div[@class="content"]/div[@class="comment-txt"]/div[@class="J_brief-cont"]',
+          text=comment_text),
+    Field('rating', './div[@class="content"]/div[@class="user-info"]/span[@title and @class]/@class',
+          regex=r'irr-star(\d+)', coerce=lambda v: float(v) / 50),
+    Field('time_text', './div[@class="content"]/div[@class="misc-info"]/span[@class="time"]/text()'),
+], skip_none=True)
+
+# 评论列表页的流式解析：评论条目，以及分页链接
+COMMENT_LIST_MATCHERS = [
+    ('comment', 'li', 'self::li[@data-id and @id][parent::ul/parent::div[@class="comment-list"]]'),
+    ('page', 'a', 'self::a[@href and @data-pg][parent::div[@class="Pages"]]')
+]
+
+# 相册页的流式解析
+ALBUM_MATCHERS = [('image', 'li', 'self::li[@class="J_list"][parent::ul/parent::div[@class="picture-list"]]')]
+
+
+def parse_album(text):
+    """
+    解析相册页，返回图片列表。在进程池中执行，参见PipelineProcessor
+    """
+    from hashlib import md5
+
+    images = []
+    for name, image_node in iter_elements(text, ALBUM_MATCHERS):
+        titles = select(image_node,
+                        './div[@class="picture-info"]/div[@class="name"]//a[@href and @title and @onclick]/@title')
+        if not titles or u'默认图片' in titles[0]:
+            continue
+
+        sources = select(image_node, './div[@class="img"]/a[@href and @onclick]/img[@src and @title]/@src')
+        if not sources or not PIC_PATTERN.search(sources[0]):
+            continue
+
+        image_src = large_pic(sources[0])
+        key = md5(image_src).hexdigest()
+        images.append({'url_hash': key, 'key': key, 'url': image_src})
+    return images
+
+
+# 推荐菜品（a节点）
+DISH_SCHEMA = Schema([
+    Field('name', './@title', coerce=strip_dots),
+    Field('recommend_cnt', './em[@class="count"]/text()', regex=r'\d+', group=0, coerce=int, default=0),
+])
+
+
+def brief_rating(name, prefix, regex=r'\d+\.\d+', coerce=float):
+    return Field(name, u'.//div[@class="brief-info"]/span[@class="item"]/text()[starts-with(., "%s")]' % prefix,
+                 regex=regex, group=0, coerce=coerce)
+
+
+def other_info(name, prefix, path, **kwargs):
+    return Field(name, u'.//div[contains(@class,"other")]/p[contains(@class,"info")]'
+                       u'[span[@class="info-name"][starts-with(text(), "%s")]]/%s' % (prefix, path), **kwargs)
+
+
+# 店铺详情页
+SHOP_SCHEMA = Schema([
+    Schema([
+        Field('title', './h1[@class="shop-name"]/text()'),
+        brief_rating('taste_rating', u'口味'),
+        brief_rating('env_rating', u'环境'),
+        brief_rating('service_rating', u'服务'),
+        brief_rating('mean_price', u'人均', regex=r'\d+', coerce=int),
+        Field('tel', './/p[contains(@class,"expand-info") and contains(@class,"tel")]/span[@itemprop="tel"]/text()'),
+        Field('addr', './/div[contains(@class,"expand-info") and contains(@class,"address")]'
+                      '/span[@itemprop="street-address"]/text()'),
+        other_info('open_time', u'营业时间', 'span[@class="item"]/text()'),
+        other_info('tags', u'分类标签', 'span[@class="item"]/a/text()', many=True,
+                   reduce=lambda v: list(set(v)) or None),
+        other_info('desc', u'餐厅简介', 'text()', many=True, reduce=lambda v: '\n'.join(v).strip() or None),
+    ], scope='//div[@id="basic-info"]'),
+    Field('cover_image', '//div[@id="aside"]//div[@class="photos"]/a[@href]/img[@itemprop="photo" and @src]/@src'),
+    Field('dishes', '//div[@id="shop-tabs"]/script/text()', coerce=lambda v: DianpingMatcher.get_dishes(v),
+          default=[]),
+])
+
 
 class DianpingHelper(object):
     def __init__(self):
@@ -27,16 +143,11 @@ class DianpingHelper(object):
             try:
                 self._city_cache_lock.acquire()
                 if city_name not in self._city_cache:
-                    col = get_mongodb('geo', 'Locality', 'mongo')
                     lat = coords['lat']
                     lng = coords['lng']
-                    geo_json = {'type': 'Point', 'coordinates': [coords['lng'], coords['lat']]}
                     max_distance = 200000
-                    city_list = list(col.find(
-                        {'alias': city_name,
-                         'location': {'$near': {'$geometry': geo_json, '$maxDistance': max_distance}}}))
-                    if city_list:
-                        city = city_list[0]
+                    city, dist = GeoResolver.get_instance('mongo').nearest(lng, lat, max_distance, alias=city_name)
+                    if city:
                         self._city_cache[city_name] = city
                     else:
                         self._city_cache[city_name] = None
@@ -73,6 +184,32 @@ class FactoryBuilder(object):
             raise ValueError('Invalid factory name: %s' % factory_name)
 
 
+def extract_shop_details(html_body):
+    """
+    从店铺页面中提取详情（包括经纬度）。如果不是餐厅页面，返回None。在进程池中执行，参见BaseProcessor.offload
+    """
+    tree_node = parse_html(html_body)
+
+    # 保证这是一个餐厅页面
+    tmp = select(tree_node, '//div[@class="breadcrumb"]/a[@href]/text()')
+    if not tmp or u'餐厅' not in tmp[0]:
+        return
+
+    details = SHOP_SCHEMA.extract(tree_node)
+    if not details['title']:
+        return
+
+    lat = None
+    lng = None
+    match = re.search(r'lng:(\d+\.\d+),lat:(\d+\.\d+)', html_body)
+    if match:
+        lng = float(match.group(1))
+        lat = float(match.group(2))
+    details['lat'] = lat
+    details['lng'] = lng
+    return details
+
+
 def status_code_validator(response, allowed_codes):
     return response.status_code in allowed_codes
 
@@ -93,6 +230,7 @@ class DianpingFetcher(BaseProcessor):
     """
     抓取大众点评的评论数据
     """
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -116,10 +254,15 @@ class DianpingFetcher(BaseProcessor):
             exec 'from bson import ObjectId'
             query = eval(self.args.query)
 
-        cursor = col.find(query, {'shop_id': 1})
+        resume_query = self.resume_query('_id')
+        if resume_query:
+            query = {'$and': [query, resume_query]}
+
+        cursor = col.find(query, {'shop_id': 1}).sort('_id', pymongo.ASCENDING)
         if self.args.limit:
             cursor.limit(self.args.limit)
-        cursor.skip(self.args.skip)
+        if not resume_query:
+            cursor.skip(self.args.skip)
         if self.args.batch_size:
             cursor.batch_size(self.args.batch_size)
         return cursor
@@ -127,13 +270,23 @@ class DianpingFetcher(BaseProcessor):
     def populate_tasks(self):
         cursor = self.build_cursor()
 
-        for val in cursor:
-            def task(entry=val):
-                self.process(entry)
-
-            setattr(task, 'task_key', 'task:%s:%d' % (self.name, val['shop_id']))
+        for val in self.shard_cursor(cursor):
+            task = self.build_task({'processor': self.name, 'entry_id': val['shop_id'], 'action': 'process'})
+            setattr(task, 'resume_key', val['_id'])
             self.add_task(task)
 
+    def build_task(self, desc):
+        entry = {'shop_id': desc['entry_id']}
+
+        def task():
+            # 后续的任务（比如评论的其它页面）
+            return self.process(entry)
+
+        setattr(task, 'task_key', 'task:%s:%d' % (self.name, entry['shop_id']))
+        setattr(task, 'task_host', DIANPING_HOST)
+        setattr(task, 'task_desc', desc)
+        return task
+
     def process(self, entry):
         raise NotImplementedError
 
@@ -147,7 +300,7 @@ class DianpingCommentSpider(DianpingFetcher):
 
     def process(self, entry):
         shop_id = entry['shop_id']
-        self.parse_comment_page(shop_id)
+        return self.parse_comment_page(shop_id)
 
     def parse_comment_page(self, shop_id, page_idx=1):
         template = 'http://www.dianping.com/shop/%d/review_all?pageno=%d'
@@ -158,79 +311,39 @@ class DianpingCommentSpider(DianpingFetcher):
 
         response = self.request.get(comment_url, timeout=15, user_data={'ProxyMiddleware': {'validator': validators}})
 
-        from lxml import etree
-
         col = get_mongodb('raw_dianping', 'DianpingComment', 'mongo-raw')
-        root_node = etree.fromstring(response.text, parser=etree.HTMLParser())
-        for comment_node in root_node.xpath('//div[@class="comment-list"]/ul/li[@data-id and @id]'):
-            comment = self.parse_comment_details(shop_id, comment_node)
-            col.update({'comment_id': comment['comment_id']}, {'$set': comment}, upsert=True)
-
-        # 查看其它的页面
-        if page_idx == 1:
-            pages = map(int, root_node.xpath('//div[@class="Pages"]/a[@href and @data-pg]/@data-pg'))
-            if not pages:
-                return
-            for page_idx in xrange(2, max(pages) + 1):
-                self.parse_comment_page(shop_id, page_idx)
-
-    def parse_comment_details(self, shop_id, comment_node):
-        comment = {'shop_id': shop_id}
-
-        comment_id = int(comment_node.xpath('./@data-id')[0])
-        comment['comment_id'] = comment_id
-
-        try:
-            image_node = comment_node.xpath('./div[@class="pic"]/a[@user-id]/img[@title and @src]')[0]
-            user_name = image_node.xpath('./@title')[0].strip()
-            user_avatar = image_node.xpath('./@src')[0].strip()
+        pages = []
+        for name, node in iter_elements(response.text, COMMENT_LIST_MATCHERS):
+            if name == 'comment':
+                comment = self.parse_comment_details(shop_id, node)
+                self.bulk.upsert(col, {'comment_id': comment['comment_id']}, {'$set': comment})
+            else:
+                pages.append(int(node.get('data-pg')))
 
-            pattern = re.compile(r'(/pc/[0-9a-z]{32})\(\d+[cx]\d+\)/')
-            if re.search(pattern, user_avatar):
-                user_avatar = re.sub(pattern, '\\1(1024c1024)/', user_avatar)
+        # 其它的页面作为后续任务返回。优先级更高，以便分页尽快完成，而不是堆积在队列中。
+        # 所有的页面都完成之后，第一页的任务才会提交（参见BaseProcessor.add_subtask）
+        if page_idx != 1 or not pages:
+            return
 
-            if user_name:
-                comment['user_name'] = user_name
-            if user_avatar:
-                comment['user_avatar'] = user_avatar
-        except IndexError:
-            pass
+        follow_ups = []
+        for idx in xrange(2, max(pages) + 1):
+            def next_page(page=idx):
+                self.parse_comment_page(shop_id, page)
 
-        try:
-            text_node = comment_node.xpath('./div[@class="content"]/div[@class="comment-txt"]'
-                                           '/div[@class="J_brief-cont"]')[0]
-            for br_node in text_node.xpath('.//br'):
-                br_node.tail = '\n' + br_node.tail if br_node.tail else '\n'
-
-            text_components = []
-            for txt in text_node.itertext():
-                if not txt or not txt.strip():
-                    continue
-                else:
-                    text_components.append(txt.strip(' '))
-            contents = ''.join(text_components).strip()
-            if contents:
-                comment['contents'] = contents
-        except IndexError:
-            pass
+            setattr(next_page, 'priority', 1)
+            setattr(next_page, 'task_host', DIANPING_HOST)
+            follow_ups.append(next_page)
+        return follow_ups
 
-        try:
-            rating_class = comment_node.xpath('./div[@class="content"]/div[@class="user-info"]'
-                                              '/span[@title and @class]/@class')[0]
-            match = re.search(r'irr-star(\d+)', rating_class)
-            if match:
-                comment['rating'] = float(match.group(1)) / 50
-        except IndexError:
-            pass
+    def parse_comment_details(self, shop_id, comment_node):
+        comment = COMMENT_SCHEMA.extract(comment_node)
+        comment['shop_id'] = shop_id
 
-        try:
-            time_text = comment_node.xpath('./div[@class="content"]/div[@class="misc-info"]'
-                                           '/span[@class="time"]/text()')[0]
+        time_text = comment.pop('time_text', None)
+        if time_text:
             ts = self.parse_comment_time(time_text)
             if ts:
                 comment['ctime'] = ts
-        except IndexError:
-            pass
 
         return comment
 
@@ -285,54 +398,30 @@ class DianpingCommentSpider(DianpingFetcher):
         return
 
 
-class DianpingImageSpider(DianpingFetcher):
+class DianpingImageSpider(PipelineProcessor, DianpingFetcher):
     """
-    抓取点评POI的照片
+    抓取点评POI的照片。下载、解析和保存分别在PipelineProcessor的三个阶段中执行
     """
 
     name = 'dianping-image'
 
-    def process(self, entry):
-        shop_id = entry['shop_id']
-        self.get_poi_image(shop_id)
+    parser = staticmethod(parse_album)
 
-    def get_poi_image(self, shop_id, page_idx=1):
+    def fetch(self, entry):
         template = 'http://www.dianping.com/shop/%d/photos?pg=%d'
-        album_url = template % (shop_id, page_idx)
+        album_url = template % (entry['shop_id'], 1)
 
         validators = [lambda v: status_code_validator(v, [200, 404]),
                       lambda v: response_size_validator(v, 4096)]
 
         response = self.request.get(album_url, timeout=15, user_data={'ProxyMiddleware': {'validator': validators}})
+        return response.text
 
-        from lxml import etree
-        from hashlib import md5
-
+    def store(self, entry, images):
         col = get_mongodb('raw_dianping', 'DianpingImage', 'mongo-raw')
-        root_node = etree.fromstring(response.text, parser=etree.HTMLParser())
-        for image_node in root_node.xpath('//div[@class="picture-list"]/ul/li[@class="J_list"]'):
-            try:
-                image_title = image_node.xpath(
-                    './div[@class="picture-info"]/div[@class="name"]//a[@href and @title and @onclick]/@title')[0]
-                if u'默认图片' in image_title:
-                    continue
-            except IndexError:
-                continue
-
-            try:
-                image_src = image_node.xpath('./div[@class="img"]/a[@href and @onclick]/img[@src and @title]/@src')[0]
-                pattern = re.compile(r'(/pc/[0-9a-z]{32})\(\d+[cx]\d+\)/')
-                match = re.search(pattern, image_src)
-                if not match:
-                    continue
-
-                image_src = re.sub(pattern, '\\1(1024c1024)/', image_src)
-                key = md5(image_src).hexdigest()
-                image_entry = {'url_hash': key, 'key': key, 'url': image_src, 'shop_id': shop_id}
-
-                col.update({'key': key}, {'$set': image_entry}, upsert=True)
-            except IndexError:
-                continue
+        for image_entry in images:
+            image_entry['shop_id'] = entry['shop_id']
+            self.bulk.upsert(col, {'key': image_entry['key']}, {'$set': image_entry})
 
 
 class DianpingMatcher(BaseProcessor):
@@ -341,6 +430,7 @@ class DianpingMatcher(BaseProcessor):
     """
 
     name = 'dianping-matcher'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -422,12 +512,10 @@ class DianpingMatcher(BaseProcessor):
         解析单个搜索结果页
         :return 店铺详情的集合
         """
-        from lxml import etree
-
-        tree_node = etree.fromstring(response.text, parser=etree.HTMLParser())
+        tree_node = parse_html(response.text)
         col = get_mongodb('raw_dianping', 'Dining', 'mongo-raw')
-        for shop_href in tree_node.xpath('//div[contains(@class,"shop-list")]/ul/li'
-                                         '//a[@href and @onclick and @title]/@href'):
+        for shop_href in select(tree_node, '//div[contains(@class,"shop-list")]/ul/li'
+                                           '//a[@href and @onclick and @title]/@href'):
             match = re.search(r'shop/(\d+)', shop_href)
             if not match:
                 continue
@@ -441,17 +529,26 @@ class DianpingMatcher(BaseProcessor):
             if shop:
                 yield shop
             else:
-                redis_key = 'dianping:shop_html_%d' % shop_id
-                html_body = self.engine.redis.get(redis_key)
-                if not html_body:
-                    try:
-                        html_body = self.request.get('http://www.dianping.com/shop/%d' % shop_id).text
-                    except IOError:
-                        continue
-
-                shop_details = self.parse_shop_details(html_body, context)
+                shop_url = 'http://www.dianping.com/shop/%d' % shop_id
+                # 缓存未命中时，下载之后立即提取详情：据此决定是否写入缓存，之后也不需要重新解析
+                fetched = {}
+
+                def retrieve():
+                    body = self.request.get(shop_url).text
+                    fetched['details'] = self.offload(extract_shop_details, body)
+                    return body
+
+                try:
+                    html_body = get_page_cache('dianping-shop').fetch(
+                        shop_id, retrieve, validator=lambda body: bool(fetched['details']))
+                except IOError:
+                    continue
+                if 'details' in fetched and not fetched['details']:
+                    # 不是餐厅页面
+                    continue
+
+                shop_details = self.parse_shop_details(html_body, context, details=fetched.get('details'))
                 if shop_details:
-                    self.engine.redis.set(redis_key, html_body)
                     yield shop_details
 
                     # TODO 暂时只返回一个店铺
@@ -462,145 +559,29 @@ class DianpingMatcher(BaseProcessor):
         """
         获得推荐菜品
         """
-        from lxml import etree
-
-        dishes = []
-        sel = etree.fromstring(html, parser=etree.HTMLParser())
-        for tmp in sel.xpath('//div[contains(@class,"shop-tab-recommend")]/p[@class="recommend-name"]'
-                             '/a[@class="item" and @title]'):
-            dish_name = tmp.xpath('./@title')[0].strip()
-            # 去除首尾可能出现的句点
-            dish_name = re.sub(r'\s*\.$', '', dish_name)
-            dish_name = re.sub(r'^\.\s*', '', dish_name)
-            recommend_cnt = 0
-
-            tmp = tmp.xpath('./em[@class="count"]/text()')
-            if tmp:
-                match = re.search(r'\d+', tmp[0])
-                if match:
-                    recommend_cnt = int(match.group())
-            dishes.append({'name': dish_name, 'recommend_cnt': recommend_cnt})
-
-        return dishes
+        return DISH_SCHEMA.extract_all(parse_html(html), '//div[contains(@class,"shop-tab-recommend")]'
+                                                         '/p[@class="recommend-name"]/a[@class="item" and @title]')
 
-    def parse_shop_details(self, html_body, context):
+    def parse_shop_details(self, html_body, context, details=None):
         """
         解析店铺详情
+        :param details: 已经从html_body中提取的详情。如果为None，则重新提取
         :return: 单个店铺详情
         """
         shop_id = context['shop_id']
         self.log('Fetching shop: %d' % shop_id, logging.INFO)
 
-        from lxml import etree
-
-        tree_node = etree.fromstring(html_body, parser=etree.HTMLParser())
-
-        # 保证这是一个餐厅页面
-        tmp = tree_node.xpath('//div[@class="breadcrumb"]/a[@href]/text()')
-        if not tmp or u'餐厅' not in tmp[0]:
-            return
-
-        basic_info_node = tree_node.xpath('//div[@id="basic-info"]')[0]
-
-        taste_rating = None
-        env_rating = None
-        service_rating = None
-        mean_price = None
-
-        def extract_rating(text):
-            match2 = re.search(r'\d+\.\d+', text)
-            if match2:
-                return float(match2.group())
-            else:
-                return None
-
-        for info_text in basic_info_node.xpath('.//div[@class="brief-info"]/span[@class="item"]/text()'):
-            if info_text.startswith(u'口味'):
-                taste_rating = extract_rating(info_text)
-            elif info_text.startswith(u'环境'):
-                env_rating = extract_rating(info_text)
-            elif info_text.startswith(u'服务'):
-                service_rating = extract_rating(info_text)
-            elif info_text.startswith(u'人均'):
-                match = re.search(r'\d+', info_text)
-                if match:
-                    mean_price = int(match.group())
-
-        tel = None
-        tmp = basic_info_node.xpath('.//p[contains(@class,"expand-info") and contains(@class,"tel")]'
-                                    '/span[@itemprop="tel"]/text()')
-        if tmp and tmp[0].strip():
-            tel = tmp[0].strip()
-
-        addr = None
-        tmp = basic_info_node.xpath('.//div[contains(@class,"expand-info") and contains(@class,"address")]'
-                                    '/span[@itemprop="street-address"]/text()')
-        if tmp and tmp[0].strip():
-            addr = tmp[0].strip()
-
-        cover = None
-        tmp = tree_node.xpath('//div[@id="aside"]//div[@class="photos"]/a[@href]/img[@itemprop="photo" and @src]/@src')
-        if tmp:
-            cover = tmp[0].strip()
-
-        open_time = None
-        tags = set([])
-        desc = None
-        for other_info_node in basic_info_node.xpath('.//div[contains(@class,"other")]/p[contains(@class,"info")]'):
-            tmp = other_info_node.xpath('./span[@class="info-name"]/text()')
-            if not tmp:
-                continue
-            info_name = tmp[0]
-            if info_name.startswith(u'营业时间'):
-                tmp = other_info_node.xpath('./span[@class="item"]/text()')
-                if not tmp:
-                    continue
-                open_time = tmp[0].strip()
-            elif info_name.startswith(u'分类标签'):
-                tmp = other_info_node.xpath('./span[@class="item"]/a/text()')
-                for tag in tmp:
-                    tags.add(tag.strip())
-            elif info_name.startswith(u'餐厅简介'):
-                tmp = '\n'.join(filter(lambda v: v,
-                                       (tmp.strip() for tmp in other_info_node.xpath('./text()')))).strip()
-                if not tmp:
-                    continue
-                desc = tmp
-
-        tmp = tree_node.xpath('//div[@id="shop-tabs"]/script/text()')
-        if tmp:
-            dishes = self.get_dishes(tmp[0])
-        else:
-            dishes = []
-
-        lat = None
-        lng = None
-        match = re.search(r'lng:(\d+\.\d+),lat:(\d+\.\d+)', html_body)
-        if match:
-            lng = float(match.group(1))
-            lat = float(match.group(2))
-
-        # addr title mean_price cover_image
-
-        tmp = tree_node.xpath('//div[@id="basic-info"]/h1[@class="shop-name"]/text()')
-        title = None
-        if tmp:
-            title = tmp[0].strip()
-        if not title:
+        if details is None:
+            details = self.offload(extract_shop_details, html_body)
+        if not details:
             return
 
         city_info = context['city_info']
         m = {'city_id': city_info['city_id'], 'city_name': city_info['city_name'],
              'city_pinyin': city_info['city_pinyin'],
              'shop_id': shop_id,
-             'taste_rating': taste_rating,
-             'env_rating': env_rating,
-             'service_rating': service_rating,
-             'tel': tel, 'open_time': open_time, 'desc': desc, 'dishes': dishes,
-             'tags': list(tags) if tags else None,
-             'lat': lat, 'lng': lng,
-             'title': title, 'addr': addr, 'cover_image': cover, 'mean_price': mean_price,
              'review_stat': self.parse_review_stat(shop_id)}
+        m.update(details)
         return m
 
     def parse_review_stat(self, shop_id):
@@ -611,17 +592,17 @@ class DianpingMatcher(BaseProcessor):
                    'act=getreviewfilters&shopId=%d&tab=all'
         review_url = template % shop_id
 
-        redis_key = 'dianping:shop_review_%d' % shop_id
-        response_body = self.engine.redis.get(redis_key)
+        def is_json(text):
+            try:
+                json.loads(text)
+                return True
+            except ValueError:
+                return False
+
         try:
-            if not response_body:
-                response = self.request.get(url=review_url)
-                data = json.loads(response.text)
-                self.engine.redis.set(redis_key, response.text)
-                return data['msg']
-            else:
-                data = json.loads(response_body)
-                return data['msg']
+            response_body = get_page_cache('dianping-review').fetch(
+                shop_id, lambda: self.request.get(url=review_url).text, validator=is_json)
+            return json.loads(response_body)['msg']
         except ValueError:
             return
 
@@ -638,13 +619,11 @@ class DianpingMatcher(BaseProcessor):
         """
         解析搜索结果列表，返回shop details
         """
-        from lxml import etree
-
-        tree_node = etree.fromstring(response.text, parser=etree.HTMLParser())
+        tree_node = parse_html(response.text)
 
         # pagination
         pages = []
-        for page_text in tree_node.xpath('//div[@class="page"]/a[@href and @data-ga-page]/@data-ga-page'):
+        for page_text in select(tree_node, '//div[@class="page"]/a[@href and @data-ga-page]/@data-ga-page'):
             try:
                 pages.append(int(page_text))
             except ValueError:
@@ -708,23 +687,30 @@ class DianpingMatcher(BaseProcessor):
 
         self.store_shops(shop_list)
 
-        the_shop = shop_list[0]
-        # 检查经纬度是否一致
+        # 检查经纬度是否一致：在搜索结果中，选择距离最近的店铺
         try:
-            coords1 = entry['location']['coordinates']
-            coords2 = [the_shop['lng'], the_shop['lat']]
+            coords = entry['location']['coordinates']
         except KeyError:
             return
 
-        from utils import haversine
+        located = []
+        for shop in shop_list:
+            try:
+                located.append((shop, float(shop['lng']), float(shop['lat'])))
+            except (KeyError, TypeError, ValueError):
+                self.log('Unable to locate shop: %d' % shop['shop_id'], logging.WARN)
+        if not located:
+            return
+
+        from utils.geo import GeoIndex
+
+        idx, dist = GeoIndex([v[1] for v in located], [v[2] for v in located]).query(coords[0], coords[1])[0]
+        the_shop = located[idx][0]
 
         # 最多允许1km的误差
         max_distance = 1
-        try:
-            if haversine(coords1[0], coords1[1], coords2[0], coords2[1]) < max_distance:
-                self.bind_shop_id(entry, the_shop['shop_id'])
-        except TypeError:
-            self.log('Unable to locate shop: %d' % the_shop['shop_id'], logging.WARN)
+        if dist < max_distance:
+            self.bind_shop_id(entry, the_shop['shop_id'])
 
     @staticmethod
     def bind_shop_id(shop, dianping_id):
@@ -732,7 +718,7 @@ class DianpingMatcher(BaseProcessor):
         col.update({'_id': shop['_id']}, {'$set': {'source.dianping': {'id': dianping_id}}})
 
     def populate_tasks(self):
-        for val in self.build_cursor():
+        for val in self.shard_cursor(self.build_cursor()):
             def task(entry=val):
                 self.dianping_match(entry)
 
@@ -741,6 +727,7 @@ class DianpingMatcher(BaseProcessor):
 
 class DianpingProcessor(BaseProcessor):
     name = 'dianping-shop'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -752,6 +739,10 @@ class DianpingProcessor(BaseProcessor):
         self._city_cache = {}
         self._city_cache_lock = BoundedSemaphore(1)
 
+        from utils.bloom import get_key_filter
+
+        self.images_filter = get_key_filter('imagestore', 'Images', 'key', 'mongo')
+
     def build_args(self):
         """
         处理命令行参数
@@ -778,7 +769,7 @@ class DianpingProcessor(BaseProcessor):
         return cursor
 
     def populate_tasks(self):
-        for val in self.build_cursor():
+        for val in self.shard_cursor(self.build_cursor()):
             def task(entry=val):
                 self.process_details(entry)
 
@@ -792,18 +783,13 @@ class DianpingProcessor(BaseProcessor):
             try:
                 self._city_cache_lock.acquire()
                 if city_name not in self._city_cache:
-                    col = get_mongodb('geo', 'Locality', 'mongo')
                     lat = coords['lat']
                     lng = coords['lng']
                     if not isinstance(lat, float) or not isinstance(lng, float):
                         return
-                    geo_json = {'type': 'Point', 'coordinates': [coords['lng'], coords['lat']]}
                     max_distance = 200000
-                    city_list = list(col.find(
-                        {'alias': city_name,
-                         'location': {'$near': {'$geometry': geo_json, '$maxDistance': max_distance}}}))
-                    if city_list:
-                        city = city_list[0]
+                    city, dist = GeoResolver.get_instance('mongo').nearest(lng, lat, max_distance, alias=city_name)
+                    if city:
                         self._city_cache[city_name] = city
                     else:
                         self.log('Failed to find city: %s, lat=%f, lng=%f' % (city_name, lat, lng), logging.WARN)
@@ -882,26 +868,26 @@ class DianpingProcessor(BaseProcessor):
 
         self.update_shop(shop)
 
-    @staticmethod
-    def add_image(image_url):
+    def add_image(self, image_url):
         from hashlib import md5
 
         url_hash = md5(image_url).hexdigest()
         image = {'url_hash': url_hash, 'key': url_hash, 'url': image_url}
         col_im = get_mongodb('imagestore', 'Images', 'mongo')
-        if not col_im.find_one({'key': image['key']}, {'_id': 1}):
+        # Bloom filter返回False时，图像肯定不存在，不必查询数据库
+        if not self.images_filter.might_exist(image['key']) or not col_im.find_one({'key': image['key']},
+                                                                                  {'_id': 1}):
             col = get_mongodb('imagestore', 'ImageCandidates', 'mongo')
             col.update({'key': image['key']}, {'$set': image}, upsert=True)
         return image['key']
 
-    @staticmethod
-    def update_shop(shop):
+    def update_shop(self, shop):
         """
         将店铺存储至数据库
         """
         if 'cover_image' in shop:
             cover = shop.pop('cover_image')
-            image_key = DianpingProcessor.add_image(cover)
+            image_key = self.add_image(cover)
             shop['images'] = [{'key': image_key}]
 
         add_to_set = {}
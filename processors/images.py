@@ -3,6 +3,7 @@ import argparse
 import logging
 import re
 from hashlib import md5
+from urlparse import urlparse
 
 import gevent
 import pymongo
@@ -10,6 +11,7 @@ from pymongo.errors import DuplicateKeyError
 import requests
 
 from processors import BaseProcessor
+from utils.bloom import get_key_filter
 from utils.database import get_mongodb
 
 
@@ -22,11 +24,15 @@ class ImageUploader(BaseProcessor):
     """
 
     name = 'image-upload'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
         self.args = self.args_builder()
 
+        # 在查询Images之前，先通过Bloom filter排除肯定不存在的图像
+        self.images_filter = get_key_filter('imagestore', 'Images', 'url_hash', 'mongo')
+
     @staticmethod
     def args_builder():
         parser = argparse.ArgumentParser()
@@ -38,16 +44,17 @@ class ImageUploader(BaseProcessor):
         args, leftover = parser.parse_known_args()
         return args
 
-    @staticmethod
-    def check_exist(entry):
+    def check_exist(self, entry):
         """
         Check if an image is already processed
         """
-        col_im = get_mongodb('imagestore', 'Images', 'mongo')
-
         url = entry['url']
         url_hash = md5(url).hexdigest()
         assert url_hash == entry['url_hash']
+        if not self.images_filter.might_exist(url_hash):
+            return False
+
+        col_im = get_mongodb('imagestore', 'Images', 'mongo')
         ret = col_im.find_one({'url_hash': url_hash}, {'_id': 1})
 
         return bool(ret)
@@ -235,6 +242,7 @@ class ImageUploader(BaseProcessor):
             if 'failCnt' in entry:
                 entry.pop('failCnt')
             col_im.update({'url_hash': entry['url_hash']}, {'$set': entry}, upsert=True)
+            self.images_filter.add(entry['url_hash'])
             col_cand.remove({'_id': image_id})
 
         except IOError:
@@ -253,17 +261,23 @@ class ImageUploader(BaseProcessor):
         if extra_query:
             query = {'$and': [query, extra_query]}
 
-        cursor = col_cand.find(query, snapshot=True)
+        resume_query = self.resume_query('_id')
+        if resume_query:
+            query = {'$and': [query, resume_query]}
+
+        # 按照_id排序，以便通过checkpoint恢复
+        cursor = col_cand.find(query).sort('_id', pymongo.ASCENDING)
         if self.args.limit:
             cursor.limit(self.args.limit)
-        cursor.skip(self.args.skip)
+        if not resume_query:
+            cursor.skip(self.args.skip)
 
         return cursor
 
     def populate_tasks(self):
         cursor = self.build_cursor()
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
 
             def task(entry=val):
                 if self.args.url_filter:
@@ -276,6 +290,8 @@ class ImageUploader(BaseProcessor):
                 self.proc_image(entry)
 
             setattr(task, 'task_key', '%s-%s' % (self.name, val['url_hash']))
+            setattr(task, 'task_host', urlparse(val['url']).netloc)
+            setattr(task, 'resume_key', val['_id'])
             self.add_task(task)
 
 
@@ -288,6 +304,7 @@ class ImageTransfer(BaseProcessor):
         pass
 
     name = 'image-transfer'
+    shardable = True
 
     def __init__(self):
         super(ImageTransfer, self).__init__()
@@ -351,7 +368,7 @@ class ImageTransfer(BaseProcessor):
 
         super(ImageTransfer, self).run()
 
-        for entry in cursor:
+        for entry in self.shard_cursor(cursor):
             def func(val=entry):
                 self.progress += 1
 
@@ -406,6 +423,7 @@ class ImageValidator(BaseProcessor):
         pass
 
     name = 'image-validate'
+    shardable = True
 
     def __init__(self):
         super(ImageValidator, self).__init__()
@@ -441,7 +459,7 @@ class ImageValidator(BaseProcessor):
 
         self.total = 0
         super(ImageValidator, self).run()
-        for entry in cursor:
+        for entry in self.shard_cursor(cursor):
             def func(val=entry):
                 modified = False
                 if 'images' not in val or not val['images']:
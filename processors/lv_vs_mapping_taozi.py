@@ -1,9 +1,10 @@
 # coding=utf-8
 
 from processors import BaseProcessor
-from utils.database import get_mongodb
+from utils.database import get_mongodb, CursorSource
 from utils.mixin import BaiduSuggestion
-from math import radians, asin, sqrt, cos, sin
+from utils.shard import id_bounds
+from utils import haversine
 
 
 class LvVsMappingTaozi(BaseProcessor, BaiduSuggestion):
@@ -11,37 +12,32 @@ class LvVsMappingTaozi(BaseProcessor, BaiduSuggestion):
     匹配桃子旅行和同城两方的景点
     """
     name = 'lv_mapping_taozi'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
         BaiduSuggestion.__init__(self, *args, **kwargs)
 
+    @staticmethod
+    def build_source():
+        conn = get_mongodb('raw_ly', 'ViewSpot', 'mongo-raw')
+        # 按照_id分页读取，在遍历的过程中修改mapped字段不会影响后续的页
+        return CursorSource(conn, {'mapped': False}, {'lyId': 1, 'lyName': 1, 'lat': 1, 'lng': 1})
+
+    @classmethod
+    def plan_shards(cls, total):
+        source = cls.build_source()
+        return id_bounds(source.col, source.query, total)
+
     def vs_generate(self):
         """
         待处理景点生成器
         """
         conn = get_mongodb('raw_ly', 'ViewSpot', 'mongo-raw')
-        for entry in list(conn.find({'mapped': False}, {'lyId': 1, 'lyName': 1, 'lat': 1, 'lng': 1})):
+        for entry in self.shard_source(self.build_source()):
             conn.update({'lyId': entry['lyId']}, {'$set': {'mapped': True}}, upsert=False)
             yield entry
 
-    def cal_dist(self, lat1, lng1, lat2, lng2):
-        """
-        通过经纬度计算两点距离
-        """
-        EARTH_RADIUS = 6378.137
-        radlat1 = radians(lat1)  # a点纬度(单位是弧度)
-        radlat2 = radians(lat2)  # b点纬度(单位是弧度)
-        a = radlat1 - radlat2  # 两点间的纬度弧度差
-        b = radians(lng1) - radians(lng2)  # 两点间的经度弧度差
-        s = 2 * asin(sqrt(pow(sin(a/2), 2) + cos(radlat1)*cos(radlat2)*pow(sin(b/2), 2)))  # 两点间的弧度
-        s *= EARTH_RADIUS
-        s = round(s * 10000) / 10000  # 四舍五入保留小数点后4位
-        if s < 0:
-            return -s
-        else:
-            return s
-
     def look_up_vs(self):
         """
         查询匹配：先做已有库名字匹配，无则通过百度旅游suggestion匹配
@@ -62,7 +58,7 @@ class LvVsMappingTaozi(BaseProcessor, BaiduSuggestion):
                     suggs = self.get_baidu_sug(ly_name, None)
                     if len(suggs):
                         target = suggs[0]  # 只选第一个
-                        if target['type_code'] >= 6 and self.cal_dist(vs_info['lat'], vs_info['lng'], target['lat'], target['lng']) < 50:  # 单位 km
+                        if target['type_code'] >= 6 and haversine(vs_info['lng'], vs_info['lat'], target['lng'], target['lat']) < 50:  # 单位 km
                             res = conn_taozi.find_one({'source.baidu.id': target['sid']}, {'_id': True, 'zhName': True})
                             if res is not None:
                                 coon_mapping.update({'itemId': res['_id']}, {'$set': {'itemId': res['_id'], 'zhNameLxp': res['zhName'], 'zhNameLy': ly_name, 'lyId': ly_id, 'mapEstimated': True}}, upsert=True)
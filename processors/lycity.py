@@ -2,8 +2,9 @@
 
 from processors import BaseProcessor
 from utils.database import get_mongodb
+from utils.geo import GeoResolver
+from utils.html import parse_html, select
 
-from lxml import etree
 
 class LyCity(BaseProcessor):
 
@@ -27,8 +28,9 @@ class LyCity(BaseProcessor):
         for url in self.url_generate():
             temp = {}
             res = self.request.get(url)
-            res_html = res.content
-            title = etree.fromstring(res_html, etree.HTMLParser()).xpath("//head[@id='Head1']/title/text()")[0]
+            # 每个页面只解析一次
+            tree = parse_html(res.content)
+            title = select(tree, "//head[@id='Head1']/title/text()")[0]
             idx = title.index(u'景区')
             assert idx != -1
             province_name = title[ : idx]
@@ -37,8 +39,8 @@ class LyCity(BaseProcessor):
             temp['location_id'] = province_id
             location_list.append(temp)
 
-            city_name = etree.fromstring(res_html, etree.HTMLParser()).xpath("//div[@class='search_screen_dl']//dl[2]//div[@class='right']/a/@title")
-            city_id = etree.fromstring(res_html, etree.HTMLParser()).xpath("//div[@class='search_screen_dl']//dl[2]//div[@class='right']/a/@tvalue")
+            city_name = select(tree, "//div[@class='search_screen_dl']//dl[2]//div[@class='right']/a/@title")
+            city_id = select(tree, "//div[@class='search_screen_dl']//dl[2]//div[@class='right']/a/@tvalue")
             for name, id in zip(city_name, city_id):
                 temp = {}
                 temp['location_name'] = self.rename_citys(name)
@@ -56,10 +58,12 @@ class LyCity(BaseProcessor):
         """
         location = self.crawl_city()
         dbcon = get_mongodb('geo', 'Locality', 'mongo')
+        geo = GeoResolver.get_instance('mongo')
         for ele in location:
-            count = dbcon.find({'alias': ele['location_name']}).count()
+            candidates = geo.by_alias(ele['location_name'])
+            count = len(candidates)
             if count == 1:
-                dbcon.update({'alias': ele['location_name']}, {'$set': {'source.ly': {'id': int(ele['location_id'])}}})
+                dbcon.update({'_id': candidates[0]['_id']}, {'$set': {'source.ly': {'id': int(ele['location_id'])}}})
             elif count > 1:
                 self.logger.info('---More-Than-One: %s --- %s' % (ele['location_name'], ele['location_id']))
             else:
@@ -5,17 +5,94 @@ import logging
 import re
 from hashlib import md5
 
-from lxml.sax import ElementTreeContentHandler
-
 from processors import BaseProcessor
 from utils import haversine
+from utils.bloom import get_key_filter
+from utils.cache import get_page_cache
 from utils.database import get_mongodb
+from utils.extract import Field, Schema
+from utils.geo import GeoResolver
+from utils.html import parse_html, rewrite_html, select
+from utils.rank import MongoPercentileIndex
 from utils.mixin import BaiduSuggestion, MfwSuggestion
 
 
 __author__ = 'zephyre'
 
 
+def parse_publish_time(text):
+    """
+    发布时间（东八区）转换为时间戳（毫秒）
+    """
+    from datetime import datetime, timedelta
+
+    return long((datetime.strptime(text, '%Y-%m-%d %H:%M:%S') - timedelta(seconds=8 * 3600)
+                 - datetime.utcfromtimestamp(0)).total_seconds() * 1000)
+
+
+# 点评的详情
+COMMENT_SCHEMA = Schema([
+    Field('authorName', '//div[@class="info"]/a[@class="user-name"]/text()', strip=False, default=''),
+    Field('voteCnt', '//span[@class="useful-num"]/text()', coerce=int, default=0),
+    Field('contents', '//div[@class="c-content"]/p', many=True, reduce=lambda v: '\n\n'.join(v)),
+    Field('publishTime', '//span[@class="time"]/text()', coerce=parse_publish_time),
+])
+
+
+def extract_comment(html):
+    """
+    解析点评的HTML，返回(头像地址, 点评详情)。在进程池中执行，参见BaseProcessor.offload
+    """
+    sel = parse_html(html)
+    avatar = select(sel, '//span[@class="user-avatar"]/a[@href]/img[@src]/@src')[0]
+    return avatar, COMMENT_SCHEMA.extract(sel)
+
+
+def strip_site_link(node):
+    """
+    去掉指向马蜂窝站内（或者相对路径）的链接
+    """
+    from urlparse import urlparse
+
+    href = node.get('href')
+    if href is not None:
+        ret = urlparse(href)
+        if not ret.netloc or 'mafengwo' in ret.netloc:
+            del node.attrib['href']
+
+
+def get_html(body_list):
+    """
+    将body_list中的HTML片段合并输出，并去掉站内链接。在进程池中执行，参见BaseProcessor.offload
+    """
+    from lxml import etree
+
+    if not hasattr(body_list, '__iter__'):
+        body_list = [body_list]
+
+    proc_list = []
+
+    for body in body_list:
+        body = body.replace('\r\n', '\n')
+
+        # 在解析的同时过滤链接，不再建立第二棵树
+        tree = rewrite_html(body, 'a', strip_site_link)
+        div_list = list(tree[0])
+        if len(div_list) > 1:
+            tree = etree.Element('div')
+            for div_node in div_list:
+                tree.append(div_node)
+        else:
+            tree = div_list[0]
+
+        proc_list.append(etree.tostring(tree, encoding='utf-8', with_tail=False))
+
+    if proc_list:
+        return '<div>%s</div>' % '\n'.join(proc_list) if len(proc_list) > 1 else proc_list[0]
+    else:
+        return None
+
+
 class MfwImageExtractor(object):
     def __init__(self):
         from hashlib import md5
@@ -50,6 +127,7 @@ class SuggestionProcessor(BaseProcessor):
     读取蚂蜂窝的输入提示
     """
     name = 'mfw-sug'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -69,7 +147,8 @@ class SuggestionProcessor(BaseProcessor):
         col_raw1 = get_mongodb('raw_baidu', 'BaiduPoi', 'mongo-raw')
         col_raw2 = get_mongodb('raw_baidu', 'BaiduLocality', 'mongo-raw')
 
-        col = get_mongodb('raw_mfw', 'MfwSug', 'mongo-raw')
+        sug_cache = get_page_cache('mfw-sug')
+        sug_filter = get_key_filter('raw_mfw', 'MfwSug', 'key', 'mongo-raw')
 
         query = json.loads(self.args.query) if self.args.query else {}
 
@@ -78,7 +157,7 @@ class SuggestionProcessor(BaseProcessor):
             if self.args.limit:
                 cursor.limit(self.args.limit)
 
-            for val in cursor:
+            for val in self.shard_cursor(cursor):
                 def func(entry=val):
 
                     for name in set(filter(lambda v: v.strip(), [entry[k] for k in ['ambiguity_sname', 'sname']])):
@@ -87,7 +166,7 @@ class SuggestionProcessor(BaseProcessor):
                         url = 'http://www.mafengwo.cn/group/ss.php?callback=j&key=%s' % quote(name.encode('utf-8'))
                         key = md5(url).hexdigest()
 
-                        if col.find_one({'key': key}, {'_id': 1}):
+                        if sug_filter.might_exist(key) and sug_cache.exists(key):
                             # The record already exists
                             self.log(u'Already exists, skipping: %s, id=%s' % (name, entry['sid']))
                             continue
@@ -97,8 +176,8 @@ class SuggestionProcessor(BaseProcessor):
                             self.log(u'Failed to query url: %s, %s, id=%s' % (url, name, entry['sid']), logging.ERROR)
                             continue
 
-                        col.update({'key': key}, {'key': key, 'body': response.text, 'name': name, 'url': url},
-                                   upsert=True)
+                        sug_cache.set(key, response.text, name=name, url=url)
+                        sug_filter.add(key)
 
                 self.add_task(func)
 
@@ -108,6 +187,7 @@ class PoiCommentProcessor(BaseProcessor, MfwImageExtractor):
     清洗蚂蜂窝的POI评论数据
     """
     name = 'mfw-poi-comment'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -134,7 +214,7 @@ class PoiCommentProcessor(BaseProcessor, MfwImageExtractor):
 
         poi_dict = {}
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
             def func(entry=val):
                 poi_dbs = {'vs': col_vs, 'dining': col_dining, 'shopping': col_shopping}
 
@@ -173,16 +253,15 @@ class PoiCommentProcessor(BaseProcessor, MfwImageExtractor):
             self.add_task(func)
 
 
-    @staticmethod
-    def update(item_type, item_data):
+    def update(self, item_type, item_data):
         if item_type == 'comment':
             db_dict = {'vs': 'ViewSpotComment', 'dining': 'DiningComment', 'shopping': 'ShoppingComment'}
             db_name = db_dict[item_data.pop('type')]
             col = get_mongodb('comment', db_name, 'mongo')
-            col.update({'source.mafengwo.id': item_data['source']['mafengwo']['id']}, {'$set': item_data}, upsert=True)
+            self.bulk.upsert(col, {'source.mafengwo.id': item_data['source']['mafengwo']['id']}, {'$set': item_data})
         elif item_type == 'image':
             col = get_mongodb('imagestore', 'ImageCandidates', 'mongo')
-            col.update({'key': item_data['key']}, {'$set': item_data}, upsert=True)
+            self.bulk.upsert(col, {'key': item_data['key']}, {'$set': item_data})
         else:
             assert False, 'Invalid type: %s' % item_type
 
@@ -218,11 +297,7 @@ class PoiCommentProcessor(BaseProcessor, MfwImageExtractor):
             self.update(item_type, item_data)
 
     def parse_contents(self, node):
-        from lxml import etree
-        from datetime import datetime, timedelta
-
-        sel = etree.fromstring(node, parser=etree.HTMLParser())
-        avatar = sel.xpath('//span[@class="user-avatar"]/a[@href]/img[@src]/@src')[0]
+        avatar, data = self.offload(extract_comment, node)
         ret = self.retrieve_image(avatar)
 
         if ret:
@@ -243,51 +318,11 @@ class PoiCommentProcessor(BaseProcessor, MfwImageExtractor):
         else:
             avatar = ''
 
-        tmp = sel.xpath('//div[@class="info"]/a[@class="user-name"]/text()')
-        user = tmp[0] if tmp else ''
-
-        tmp = sel.xpath('//span[@class="useful-num"]/text()')
-        try:
-            vote_cnt = int(tmp[0])
-        except (ValueError, IndexError):
-            vote_cnt = 0
-
-        paras = []
-        for content in sel.xpath('//div[@class="c-content"]/p'):
-            tmp = ''.join(content.itertext()).strip()
-            if tmp:
-                paras.append(tmp)
-        contents = '\n\n'.join(paras)
-
-        time_str = sel.xpath('//span[@class="time"]/text()')[0]
-        ts = long((datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S') - timedelta(seconds=8 * 3600)
-                   - datetime.utcfromtimestamp(0)).total_seconds() * 1000)
-
-        data = {'authorName': user, 'authorAvatar': avatar, 'publishTime': ts, 'voteCnt': vote_cnt,
-                'contents': contents}
+        data['authorAvatar'] = avatar
         item_type = 'comment'
         yield item_type, data
 
 
-class MfwHtmlHandler(ElementTreeContentHandler):
-    def startElementNS(self, ns_name, qname, attributes=None):
-        from urlparse import urlparse
-
-        if qname == 'a':  # and attributes.has_key('href'):
-            attrs = getattr(attributes, '_attrs')
-            new_attrs = {}
-            for key, value in attrs.items():
-                if key[1] == 'href':
-                    ret = urlparse(value)
-                    if not ret.netloc or 'mafengwo' in ret.netloc:
-                        # remove links that point to mafengwo sites
-                        continue
-                new_attrs[key] = value
-            setattr(attributes, '_attrs', new_attrs)
-
-        ElementTreeContentHandler.startElementNS(self, ns_name, qname, attributes)
-
-
 class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
     """
     马蜂窝目的地的清洗
@@ -304,6 +339,7 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
     """
 
     name = 'mfw-mdd'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -406,16 +442,15 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
     def resolve_targets(item):
         data = item['data']
 
-        col_mdd = get_mongodb('geo', 'Locality', 'mongodb-general')
-        col_country = get_mongodb('geo', 'Country', 'mongodb-general')
+        geo = GeoResolver.get_instance('mongodb-general')
 
         country_flag = False
         crumb_list = data.pop('crumbIds')
         crumb = []
         for cid in crumb_list:
-            ret = col_mdd.find_one({'source.mafengwo.id': cid}, {'_id': 1, 'zhName': 1, 'enName': 1})
+            ret = geo.project(geo.by_source('mafengwo', cid))
             if not ret and not country_flag:
-                ret = col_country.find_one({'source.mafengwo.id': cid}, {'_id': 1, 'zhName': 1, 'enName': 1, 'code': 1})
+                ret = geo.project(geo.by_source('mafengwo', cid, kind='country'), ('_id', 'zhName', 'enName', 'code'))
                 if ret:
                     # 添加到country字段
                     data['country'] = ret
@@ -430,7 +465,7 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
         city = None
         for idx in xrange(len(crumb_list) - 1, -1, -1):
             cid = crumb_list[idx]
-            ret = col_mdd.find_one({'source.mafengwo.id': cid}, {'_id': 1, 'zhName': 1, 'enName': 1})
+            ret = geo.by_source('mafengwo', cid)
             if ret:
                 city = {'_id': ret['_id']}
                 for key in ['zhName', 'enName']:
@@ -446,47 +481,14 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
         """
         将body_list中的内容，作为纯文本格式输出
         """
-        from lxml import etree
-
         if not hasattr(body_list, '__iter__'):
             body_list = [body_list]
 
-        plain_list = [''.join(etree.fromstring(body, parser=etree.HTMLParser()).itertext()).strip() for body in
+        plain_list = [''.join(parse_html(body).itertext()).strip() for body in
                       body_list]
 
         return '\n\n'.join(plain_list) if plain_list else None
 
-    @staticmethod
-    def get_html(body_list):
-        from lxml import etree
-        import lxml.sax
-
-        if not hasattr(body_list, '__iter__'):
-            body_list = [body_list]
-
-        proc_list = []
-
-        for body in body_list:
-            body = body.replace('\r\n', '\n')
-            handler = MfwHtmlHandler()
-
-            tree = etree.fromstring(body, parser=etree.HTMLParser())
-            div_list = list(tree[0])
-            if len(div_list) > 1:
-                tree = etree.Element('div')
-                for div_node in div_list:
-                    tree.append(div_node)
-            else:
-                tree = div_list[0]
-
-            lxml.sax.saxify(tree, handler)
-            proc_list.append(etree.tostring(handler.etree, encoding='utf-8'))
-
-        if proc_list:
-            return '<div>%s</div>' % '\n'.join(proc_list) if len(proc_list) > 1 else proc_list[0]
-        else:
-            return None
-
     def parse_vs_contents(self, entry, data):
         """
         解析POI的详细内容
@@ -553,26 +555,26 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
             elif info_entry['info_cat'] == u'概况' and info_entry['title'] == u'建议游玩天数':
                 time_cost = self.get_plain(info_entry['details'])
             elif info_entry['info_cat'] == u'内部交通':
-                tmp = self.get_html(info_entry['details'])
+                tmp = self.offload(get_html, info_entry['details'])
                 if tmp:
                     local_traffic.append({'title': info_entry['title'], 'desc': tmp})
             elif info_entry['info_cat'] == u'外部交通':
-                tmp = self.get_html(info_entry['details'])
+                tmp = self.offload(get_html, info_entry['details'])
                 if tmp:
                     remote_traffic.append({'title': info_entry['title'], 'desc': tmp})
             elif info_entry['info_cat'] == u'节庆':
-                tmp = self.get_html(info_entry['details'])
+                tmp = self.offload(get_html, info_entry['details'])
                 if tmp:
                     activities.append({'title': info_entry['title'], 'desc': tmp})
             elif info_entry['info_cat'] == u'亮点':
-                tmp = self.get_html(info_entry['details'])
+                tmp = self.offload(get_html, info_entry['details'])
                 if tmp:
                     specials.append({'title': info_entry['title'], 'desc': tmp})
             else:
                 # 忽略出入境信息
                 if info_entry['info_cat'] == u'出入境':
                     continue
-                tmp = self.get_html(info_entry['details'])
+                tmp = self.offload(get_html, info_entry['details'])
                 if tmp:
                     misc_info.append({'title': info_entry['title'], 'desc': tmp})
         if desc:
@@ -600,33 +602,27 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
         :param mfw_id:
         :return:
         """
-        col = get_mongodb('raw_mfw', 'MfwMddBody', 'mongo-raw')
-        ret = col.find_one({'key': mfw_id}, {'body': 1})
-        if ret:
-            body = ret['body']
-        else:
+        url = 'http://www.mafengwo.cn/travel-scenic-spot/mafengwo/%d.html' % mfw_id
+
+        def retrieve():
             self.logger.debug('Cache missed for mdd: %d' % mfw_id)
-            url = ''
-            try:
-                url = 'http://www.mafengwo.cn/travel-scenic-spot/mafengwo/%d.html' % mfw_id
-                response = self.engine.request.get(url)
-                body = response.text
-                col.update({'key': mfw_id}, {'key': mfw_id, 'body': body}, upsert=True)
-            except IOError:
-                self.logger.error('Error downloading %s' % url)
-                return
+            return self.engine.request.get(url).text
+
+        try:
+            body = get_page_cache('mfw-mdd').fetch(mfw_id, retrieve)
+        except IOError:
+            self.logger.error('Error downloading %s' % url)
+            return
 
         # 网页格式分两种情况：
         # 1. 普通：http://www.mafengwo.cn/jd/10035/gonglve.html
         # 2. 重点目的地：http://www.mafengwo.cn/travel-scenic-spot/mafengwo/11025.html
 
-        from lxml import etree
-
-        tree = etree.fromstring(body, etree.HTMLParser())
+        tree = parse_html(body)
 
         lat = None
         lng = None
-        for tmp in tree.xpath('//script[@type="text/javascript"]/text()'):
+        for tmp in select(tree, '//script[@type="text/javascript"]/text()'):
             m = re.search(r'^\s*var\s+mdd_center(.+$)', tmp, re.M)
             if not m:
                 continue
@@ -645,7 +641,7 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
                 'lng'  : 129.07412052155
             },
             """
-            for tmp in tree.xpath('//script[@type="text/javascript"]/text()'):
+            for tmp in select(tree, '//script[@type="text/javascript"]/text()'):
                 m = re.search(r'var\s+map\s+=\s+\{(.+?)\}', tmp, re.S)
                 if not m:
                     continue
@@ -671,10 +667,11 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
             cursor.limit(self.args.limit)
         cursor.skip(self.args.skip)
 
-        # Cache for hotness calculation results
-        hotness_cache = {}
+        # 用于计算hotness的排名索引
+        hotness_index = dict((key, MongoPercentileIndex(col_raw, key).rebuild())
+                             for key in ('comment_cnt', 'images_tot', 'vs_cnt'))
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
             def func(entry=val):
                 self.log('Parsing: %s, id=%d' % (entry['title'], entry['id']), logging.DEBUG)
                 data = {}
@@ -709,11 +706,7 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
                 def calc_hotness(key):
                     if key not in entry:
                         return 0.5
-                    x = entry[key]
-                    sig = '%s:%d' % (key, x)
-                    if sig not in hotness_cache:
-                        hotness_cache[sig] = col_raw.find({key: {'$lt': x}}).count() / float(tot_num)
-                    return hotness_cache[sig]
+                    return hotness_index[key].percentile(entry[key], tot_num)
 
                 hotness_terms = map(calc_hotness, ('comment_cnt', 'images_tot', 'vs_cnt'))
                 data['hotness'] = sum(hotness_terms) / float(len(hotness_terms))
@@ -780,7 +773,6 @@ class MafengwoProcessor(BaseProcessor, BaiduSuggestion, MfwSuggestion):
                 self.log('Parsing done: %s / %s / %s' % tuple(data[key] if key in data else None for key in
                                                               ['zhName', 'enName', 'locName']))
 
-                col_proc.update({'source.mafengwo.id': data['source']['mafengwo']['id']}, {'$set': data},
-                                upsert=True)
+                self.bulk.upsert(col_proc, {'source.mafengwo.id': data['source']['mafengwo']['id']}, {'$set': data})
 
             self.add_task(func)
\ No newline at end of file
@@ -2,6 +2,7 @@
 from processors import BaseProcessor
 from utils import load_yaml
 from utils.database import get_mongodb
+from utils.geo import GeoResolver
 
 __author__ = 'zephyre'
 
@@ -100,6 +101,7 @@ class EditorMerger(BaseMerger):
 
 class BaiduMergeProcessor(BaseProcessor):
     name = 'baidu-merger'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -147,8 +149,7 @@ class BaiduMergeProcessor(BaseProcessor):
         if 'locList' not in data:
             return
 
-        col_country = get_mongodb('geo', 'Country', 'mongo')
-        col_mdd = get_mongodb('geo', 'Locality', 'mongo')
+        geo = GeoResolver.get_instance('mongo')
 
         def func(loc_list):
             """
@@ -163,9 +164,9 @@ class BaiduMergeProcessor(BaseProcessor):
 
             for item in loc_list:
                 if country_flag:
-                    ret = col_country.find_one({'alias': item['sname']}, {'zhName': 1, 'enName': 1})
+                    ret = geo.project((geo.by_alias(item['sname'], kind='country') or [None])[0])
                 else:
-                    ret = col_mdd.find_one({'source.baidu.id': item['sid']}, {'zhName': 1, 'enName': 1})
+                    ret = geo.project(geo.by_source('baidu', item['sid']))
                 if not ret:
                     continue
 
@@ -198,7 +199,7 @@ class BaiduMergeProcessor(BaseProcessor):
         if self.args.limit:
             cursor.limit(self.args.limit)
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
             def func(entry=val):
                 surl = entry['source']['baidu']['surl'] if 'surl' in entry['source']['baidu'] else ''
                 self.log(u'Processing: zhName=%s, sid=%s, surl=%s' % (entry['zhName'], entry['source']['baidu']['id'],
@@ -221,6 +222,7 @@ class BaiduMergeProcessor(BaseProcessor):
 
 class CMSMerger(BaseProcessor):
     name = 'cms-merger'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -234,7 +236,7 @@ class CMSMerger(BaseProcessor):
         dst_col = get_mongodb('poi', 'ViewSpot', 'mongo-cms')
         cursor = src_col.find({}, {'isDone': 1, 'images': 1})
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
             def task_func(entry=val):
                 ops_set = {}
                 ops_unset = {}
@@ -2,22 +2,67 @@
 import argparse
 from hashlib import md5
 import json
+import logging
 import re
 
 import pymongo
 
 from processors import BaseProcessor
-from utils.database import get_mongodb, get_mysql_db
+from utils import haversine
+from utils.cache import get_page_cache
+from utils.database import get_mongodb, get_mysql_db, iter_mysql_table
+from utils.geo import GeoResolver
+from utils.extract import Field, Schema
+from utils.html import iter_elements, parse_html, select
+from utils.rank import PercentileIndex
 
 
 __author__ = 'zephyre'
 
 
-class QunarPoiProcessor(BaseProcessor):
-    def populate_tasks(self):
-        pass
+def parse_comment_date(text):
+    """
+    评论日期（东八区，比如2015-03-15）转换为时间戳（秒）
+    """
+    from datetime import datetime, timedelta
+
+    return long((datetime.strptime(text, '%Y-%m-%d') - datetime.utcfromtimestamp(0)
+                 - timedelta(hours=8)).total_seconds())
+
+
+# 去哪儿攻略的host，用于FairShareScheduler
+QUNAR_HOST = 'travel.qunar.com'
+
+# 评论列表中的单条评论（li节点）
+COMMENT_SCHEMA = Schema([
+    Field('comment_id', './@id', regex=r'cmt_item_(\d+)', coerce=int),
+    Field('title', './/div[@class="e_comment_title"]', strip=False, coerce=lambda v: v or None),
+    Field('contents', './/div[@class="e_comment_content"]', strip=False, coerce=lambda v: v or None),
+    Field('rating', './/div[@class="e_comment_star_box"]//span[contains(@class,"cur_star")]/@class',
+          regex=r'star_(\d)', coerce=lambda v: float(v) / 5.0),
+    Field('images', './/div[@class="e_comment_imgs_box"]//a[@data-beacon="comment_pic"]/img[@src]/@src', many=True,
+          coerce=lambda v: {'url': re.sub(r'_r_\d+x\d+[^/]+\.jpg', '', v)}, reduce=lambda v: v or None),
+    Field('cTime', './/div[@class="e_comment_add_info"]/ul/li/text()', coerce=parse_comment_date),
+    Field('avatar', './/div[@class="e_comment_usr"]/div[@class="e_comment_usr_pic"]/a/img[@src]/@src',
+          coerce=lambda v: re.sub(r'\?\w$', '', v)),
+    Field('user_name', './/div[@class="e_comment_usr"]/div[@class="e_comment_usr_name"]/a/text()'),
+], skip_none=True)
+
+# 评论列表的流式解析
+COMMENT_LIST_MATCHERS = [
+    ('comment', 'li', 'self::li[contains(@class,"e_comment_item")][parent::ul[@id="comment_box"]]')]
+
+
+def extract_comments(data):
+    """
+    解析评论列表的HTML片段。在进程池中执行，参见BaseProcessor.offload
+    """
+    return [COMMENT_SCHEMA.extract(node) for name, node in iter_elements(data, COMMENT_LIST_MATCHERS)]
 
+
+class QunarPoiProcessor(BaseProcessor):
     name = 'qunar-poi'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -25,6 +70,8 @@ class QunarPoiProcessor(BaseProcessor):
         self.args = self.args_builder()
         self.conn = None
         self.denom = None
+        # hotScore的排名索引
+        self.hotness_index = None
 
     def args_builder(self):
         parser = argparse.ArgumentParser()
@@ -33,28 +80,9 @@ class QunarPoiProcessor(BaseProcessor):
         parser.add_argument('--cat', required=True, choices=['dining', 'shopping', 'hotel'], type=str)
         parser.add_argument('--query', type=str)
         parser.add_argument('--order', type=str)
+        parser.add_argument('--batch-size', default=1000, type=int)
         return parser.parse_args()
 
-    @staticmethod
-    def haversine(lon1, lat1, lon2, lat2):
-        """
-        Calculate the great circle distance between two points
-        on the earth (specified in decimal degrees)
-        """
-        from math import radians, sin, cos, asin, sqrt
-        # convert decimal degrees to radians
-        lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-        # haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * asin(sqrt(a))
-
-        # 6367 km is the radius of the Earth
-        km = 6367 * c
-        return km
-
     def build_poi(self, entry, poi_type):
         poi_id = int(entry['id'])
         data = {'zhName': entry['name'], 'source': {'qunar': {'id': poi_id}},
@@ -73,20 +101,22 @@ class QunarPoiProcessor(BaseProcessor):
 
         data['alias'] = [data['zhName'].lower()]
 
-        col_country = get_mongodb('geo', 'Country', profile='mongo')
-        ret = col_country.find_one({'alias': entry['countryName'].lower().strip()}, {'zhName': 1, 'enName': 1})
+        geo = GeoResolver.get_instance('mongo')
+        ret = geo.project((geo.by_alias(entry['countryName'].lower().strip(), kind='country') or [None])[0])
         assert ret is not None, 'Cannot find country: %s' % entry['countryName']
         data['country'] = ret
 
-        col_loc = get_mongodb('geo', 'Locality', profile='mongo')
-        ret = col_loc.find_one({'alias': re.compile(ur'^%s' % entry['distName'].lower().strip())},
-                               {'zhName': 1, 'enName': 1, 'location': 1})
+        ret = geo.project((geo.by_alias_prefix(entry['distName'].lower().strip()) or [None])[0],
+                          ('_id', 'zhName', 'enName', 'location'))
+        if not ret:
+            self.log(u'Cannot find city: %s' % entry['distName'], logging.WARN)
+            return
 
         coord1 = data['location']['coordinates']
         coord2 = ret['location']['coordinates']
-        dist = self.haversine(coord1[0], coord1[1], coord2[0], coord2[1])
+        dist = haversine(coord1[0], coord1[1], coord2[0], coord2[1])
         if dist >= 300:
-            print ('Cannot find city: %s' % entry['distName']).encode('utf-8')
+            self.log(u'Cannot find city: %s' % entry['distName'], logging.WARN)
             return
         data['locality'] = ret
 
@@ -106,10 +136,7 @@ class QunarPoiProcessor(BaseProcessor):
             if entry['special']:
                 data['specials'] = filter(lambda val: val, re.split(r'\s+', entry['special']))
 
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) AS cnt FROM qunar_%s WHERE hotScore<%d' % (
-            'meishi' if poi_type == 'dining' else 'gouwu', entry['hotScore']))
-        data['hotness'] = float(cursor.fetchone()['cnt']) / self.denom
+        data['hotness'] = self.hotness_index.percentile(entry['hotScore'], self.denom)
         # TODO rating和hotness不能一样
         data['rating'] = data['hotness']
 
@@ -122,61 +149,33 @@ class QunarPoiProcessor(BaseProcessor):
 
         return data
 
-    def run(self):
+    def populate_tasks(self):
         self.conn = get_mysql_db('restore_poi', profile='mysql')
 
         table = {'dining': 'qunar_meishi', 'shopping': 'qunar_gouwu', 'hotel': 'qunar_jiudian'}[self.args.cat]
 
-        stmt_tmpl = 'SELECT * FROM %s' % table
-        order = 'ORDER BY %s' % self.args.order if self.args.order else ''
-        query = 'WHERE %s' % self.args.query if self.args.query else ''
-
-        import sys
-
-        if self.args.limit or self.args.skip:
-            limit = self.args.limit if self.args.limit else sys.maxint
-            offset = self.args.skip
-        else:
-            limit = sys.maxint
-            offset = 0
-
         cur = self.conn.cursor()
         cur.execute('SELECT COUNT(*) AS cnt FROM %s' % table)
         self.denom = cur.fetchone()['cnt']
+        self.hotness_index = PercentileIndex.from_mysql(self.conn, 'qunar_meishi' if self.args.cat == 'dining'
+                                                        else 'qunar_gouwu', 'hotScore')
+
+        # 多进程模式下，每个分片只读取自己的部分（skip和limit也按照分片分别计算）
+        where = ' AND '.join('(%s)' % cond for cond in [self.args.query, self.shard_sql('id')] if cond) or None
+        rows = iter_mysql_table('restore_poi', table, profile='mysql', where=where, order=self.args.order,
+                                skip=self.args.skip, limit=self.args.limit, batch_size=self.args.batch_size)
+        for entry in rows:
+            def func(val=entry):
+                self.log(u'Upserting %s' % val['name'], logging.INFO)
+                data = self.build_poi(val, self.args.cat)
+                if not data:
+                    return
+
+                col_name = {'dining': 'Restaurant', 'shopping': 'Shopping', 'hotel': 'Hotel'}[self.args.cat]
+                col = get_mongodb('poi', col_name, profile='mongo')
+                col.update({'source.qunar.id': data['source']['qunar']['id']}, {'$set': data}, upsert=True)
 
-        batch_size = 5
-        start = offset
-
-        while True:
-            if start > offset + limit:
-                break
-
-            l = batch_size
-            if start + l > offset + limit:
-                l = offset + limit - start
-
-            tail = ' LIMIT %d, %d' % (start, l)
-            start += l
-
-            stmt = '%s %s %s %s' % (stmt_tmpl, query, order, tail)
-            cur.execute(stmt)
-
-            if cur.rowcount < 1:
-                break
-
-            for entry in cur:
-                def func(val=entry):
-                    print ('Upserting %s' % val['name']).encode('utf-8')
-                    data = self.build_poi(val, self.args.cat)
-                    if not data:
-                        return
-
-                    col_name = {'dining': 'Restaurant', 'shopping': 'Shopping', 'hotel': 'Hotel'}[self.args.cat]
-                    col = get_mongodb('poi', col_name, profile='mongo')
-                    col.update({'source.qunar.id': data['source']['qunar']['id']}, {'$set': data}, upsert=True)
-                    self.progress += 1
-
-                self.add_task(func)
+            self.add_task(func)
 
 
 def status_code_validator(response, allowed_codes):
@@ -221,6 +220,7 @@ class QunarFetcher(BaseProcessor):
     """
 
     name = 'qunar.fetch'
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
@@ -235,9 +235,15 @@ class QunarFetcher(BaseProcessor):
         args, leftover = parser.parse_known_args()
         self.args = args
 
+        # 不同的action分别保存checkpoint
+        self.cursor_checkpoint.name = '%s:%s' % (self.cursor_checkpoint.name, self.args.action)
+        resume_query = self.resume_query('source.qunar.id')
+
         context = {
             'limit': self.args.limit,
-            'skip': self.args.skip,
+            # 从checkpoint恢复时，使用范围查询代替skip
+            'skip': 0 if resume_query else self.args.skip,
+            'resume': resume_query,
             'query': self.args.query,
             'type': self.args.type,
             'batch_size': self.args.batch_size
@@ -271,11 +277,14 @@ class QunarFetcher(BaseProcessor):
         action = self.get_action()
         cursor = action.build_cursor()
 
-        for val in cursor:
+        for val in self.shard_cursor(cursor):
             def func(entry=val):
-                action.process(entry)
+                # 后续的任务（比如评论的下一页）
+                return action.process(entry)
 
             setattr(func, 'task_key', 'task:qunar.fetch:%s:%s' % (self.args.action, val['_id']))
+            setattr(func, 'task_host', QUNAR_HOST)
+            setattr(func, 'resume_key', val['source']['qunar']['id'])
             self.add_task(func)
 
 
@@ -298,6 +307,8 @@ class QunarPoiSpider(object):
         if self.context['query']:
             exec 'from bson import ObjectId'
             query = {'$and': [query, eval(self.context['query'])]}
+        if self.context['resume']:
+            query = {'$and': [query, self.context['resume']]}
         cursor = col.find(query, {'source.qunar.id': 1}).sort('source.qunar.id', pymongo.ASCENDING)
         if self.context['limit']:
             cursor.limit(self.context['limit'])
@@ -320,11 +331,9 @@ class QunarPoiSpider(object):
         if response.status_code == 404:
             return
 
-        from lxml import etree
-
-        tree_node = etree.fromstring(response.text, parser=etree.HTMLParser())
+        tree_node = parse_html(response.text)
         try:
-            score_text = tree_node.xpath('//div[@class="scorebox clrfix"]/span[@class="cur_score"]/text()')[0]
+            score_text = select(tree_node, '//div[@class="scorebox clrfix"]/span[@class="cur_score"]/text()')[0]
             score = float(score_text) / 5.0
         except (IndexError, ValueError):
             self.logger.warn('Failed to get rating: %s' % poi_url)
@@ -364,66 +373,20 @@ class QunarCommentSpider(object):
         return ret_url
 
     def parse_comments(self, data):
-        from lxml import etree
-        from datetime import datetime, timedelta
-        from hashlib import md5
-
         try:
-            node_list = etree.fromstring(data, etree.HTMLParser()).xpath(
-                '//ul[@id="comment_box"]/li[contains(@class,"e_comment_item")]')
+            comments = self.fetcher.offload(extract_comments, data)
         except ValueError:
             self.logger.warn(data)
             return
 
-        for comment_node in node_list:
-            comment = {'comment_id': int(re.search(r'cmt_item_(\d+)', comment_node.xpath('./@id')[0]).group(1))}
-
-            for k1, k2 in [['title', 'e_comment_title'], ['contents', 'e_comment_content']]:
-                tmp = comment_node.xpath('.//div[@class="%s"]' % k2)
-                if tmp:
-                    tmp = tmp[0]
-                    text = ''.join(tmp.itertext())
-                    if text:
-                        comment[k1] = text
-
-            tmp = comment_node.xpath('.//div[@class="e_comment_star_box"]//span[contains(@class,"cur_star")]/@class')
-            if tmp:
-                match = re.search(r'star_(\d)', tmp[0])
-                if match:
-                    comment['rating'] = float(match.group(1)) / 5.0
-
-            images = []
-            for image_node in comment_node.xpath('.//div[@class="e_comment_imgs_box"]'
-                                                 '//a[@data-beacon="comment_pic"]/img[@src]'):
-                tmp = image_node.xpath('./@src')
-                if not tmp:
-                    continue
-                images.append({'url': re.sub(r'_r_\d+x\d+[^/]+\.jpg', '', tmp[0])})
-
-            if images:
-                comment['images'] = images
-
-            for tmp in comment_node.xpath('.//div[@class="e_comment_add_info"]/ul/li/text()'):
-                try:
-                    comment['cTime'] = long((datetime.strptime(tmp, '%Y-%m-%d') -
-                                             datetime.utcfromtimestamp(0) - timedelta(hours=8)).total_seconds())
-                    break
-                except ValueError:
-                    pass
-
-            tmp = comment_node.xpath('.//div[@class="e_comment_usr"]/div[@class="e_comment_usr_pic"]/a/img[@src]/@src')
-            if tmp:
-                avatar = re.sub(r'\?\w$', '', tmp[0])
-
+        for comment in comments:
+            avatar = comment.pop('avatar', None)
+            if avatar:
                 redis_key = 'qunar:poi-comment:avatar:%s' % md5(avatar).hexdigest()
                 avatar_expire = 7 * 24 * 3600
                 comment['user_avatar'] = self.redis.get_cache(redis_key, lambda: self.resolve_avatar(avatar),
                                                               expire=avatar_expire)
 
-            tmp = comment_node.xpath('.//div[@class="e_comment_usr"]/div[@class="e_comment_usr_name"]/a/text()')
-            if tmp and tmp[0].strip():
-                comment['user_name'] = tmp[0].strip()
-
             yield comment
 
     def build_cursor(self):
@@ -433,60 +396,66 @@ class QunarCommentSpider(object):
         if self.context['query']:
             exec 'from bson import ObjectId'
             query = {'$and': [query, eval(self.context['query'])]}
+        if self.context['resume']:
+            query = {'$and': [query, self.context['resume']]}
         cursor = col.find(query, {'source.qunar.id': 1}).sort('source.qunar.id', pymongo.ASCENDING)
         if self.context['limit']:
             cursor.limit(self.context['limit'])
         cursor.skip(self.context['skip'])
         return cursor
 
-    def process(self, entry):
+    def process(self, entry, page=1):
         """
-        开始处理评论列表
+        处理某一页评论列表。如果还有下一页，返回下一页的任务（优先级更高，以便分页尽快完成，而不是堆积在队列中）。
+        下一页完成之后，这一页的任务才会提交（参见BaseProcessor.add_subtask）
         """
         col_raw = get_mongodb('raw_qunar', 'PoiComment', 'mongo-raw')
         tmpl = 'http://travel.qunar.com/place/api/html/comments/poi/%d?sortField=1&pageSize=%d&page=%d'
         qunar_id = entry['source']['qunar']['id']
 
-        page = 0
         page_size = 50
 
-        while True:
-            page += 1
-            comments_list_url = tmpl % (qunar_id, page_size, page)
-            self.logger.debug('Fetching: poi: %d, page: %d, url: %s' % (qunar_id, page, comments_list_url))
+        comments_list_url = tmpl % (qunar_id, page_size, page)
+        self.logger.debug('Fetching: poi: %d, page: %d, url: %s' % (qunar_id, page, comments_list_url))
 
-            redis_key = 'qunar:poi-comment:list:%d:%d:%d' % (qunar_id, page_size, page)
+        cache_key = '%d:%d:%d' % (qunar_id, page_size, page)
 
-            def get_comments_list():
-                """
-                获得评论列表的response body
-                """
-                validators = [qunar_validator, qunar_json_validator]
-                response = self.request.get(comments_list_url, timeout=15,
-                                            user_data={'ProxyMiddleware': {'validator': validators}})
-                return response.text
+        def get_comments_list():
+            """
+            获得评论列表的response body
+            """
+            validators = [qunar_validator, qunar_json_validator]
+            response = self.request.get(comments_list_url, timeout=15,
+                                        user_data={'ProxyMiddleware': {'validator': validators}})
+            return response.text
 
-            try:
-                comments_list_expire = 3600 * 24
-                search_result_text = self.redis.get_cache(redis_key, get_comments_list, expire=comments_list_expire)
-                data = json.loads(search_result_text)
-            except (IOError, ValueError):
-                self.logger.warn('Fetching failed: %s' % comments_list_url)
-                break
+        try:
+            search_result_text = get_page_cache('qunar-comment-list').fetch(cache_key, get_comments_list)
+            data = json.loads(search_result_text)
+        except (IOError, ValueError):
+            self.logger.warn('Fetching failed: %s' % comments_list_url)
+            return
+
+        if data['errmsg'] != 'success':
+            self.logger.warn('Fetching failed %s, errmsg: %s' % (comments_list_url, data['errmsg']))
+            return
+
+        tmp = self.parse_comments(data['data'])
+        comments = list(tmp) if tmp else []
+        for c in comments:
+            c['poi_id'] = qunar_id
+            self.fetcher.bulk.upsert(col_raw, {'comment_id': c['comment_id']}, {'$set': c})
 
-            if data['errmsg'] != 'success':
-                self.logger.warn('Fetching failed %s, errmsg: %s' % (comments_list_url, data['errmsg']))
-                break
+        # 如果返回空列表，或者comments数量不足pageSize，说明已经到达最末页
+        if not comments or len(comments) < page_size:
+            return
 
-            tmp = self.parse_comments(data['data'])
-            comments = list(tmp) if tmp else []
-            for c in comments:
-                c['poi_id'] = qunar_id
-                col_raw.update({'comment_id': c['comment_id']}, {'$set': c}, upsert=True)
+        def next_page():
+            return self.process(entry, page + 1)
 
-            # 如果返回空列表，或者comments数量不足pageSize，说明已经到达最末页
-            if not comments or len(comments) < page_size:
-                return
+        setattr(next_page, 'priority', 1)
+        setattr(next_page, 'task_host', QUNAR_HOST)
+        return next_page
 
 
 class QunarImageSpider(object):
@@ -509,6 +478,8 @@ class QunarImageSpider(object):
         if self.context['query']:
             exec 'from bson import ObjectId'
             query = {'$and': [query, eval(self.context['query'])]}
+        if self.context['resume']:
+            query = {'$and': [query, self.context['resume']]}
         cursor = col.find(query, {'source.qunar.id': 1}).sort('source.qunar.id', pymongo.ASCENDING)
         if self.context['limit']:
             cursor.limit(self.context['limit'])
@@ -551,7 +522,7 @@ class QunarImageSpider(object):
             ops = {'$set': image, '$addToSet': {'itemIds': entry['_id']}}
             ret = col_im.update({'url_hash': url_hash}, ops)
             if not ret['updatedExisting']:
-                col_cand.update({'url_hash': url_hash}, ops, upsert=True)
+                self.fetcher.bulk.upsert(col_cand, {'url_hash': url_hash}, ops)
 
 
 class QunarCommentProcessor(object):
@@ -573,6 +544,8 @@ class QunarCommentProcessor(object):
         if self.context['query']:
             exec 'from bson import ObjectId'
             query = {'$and': [query, eval(self.context['query'])]}
+        if self.context['resume']:
+            query = {'$and': [query, self.context['resume']]}
         cursor = col.find(query, {'source.qunar.id': 1}).sort('source.qunar.id', pymongo.ASCENDING)
         if self.context['limit']:
             cursor.limit(self.context['limit'])
@@ -3,50 +3,128 @@
 import pymongo
 from bson.objectid import ObjectId
 from processors import BaseProcessor
-from utils.database import get_mongodb
+from utils.database import get_mongodb, CursorSource
 
 
 class PoiRank(BaseProcessor):
+    """
+    按照hotness，计算每个目的地下POI的排名（rank字段）。
+
+    默认模式下，每个目的地是一个任务：按照hotness降序遍历，只有rank发生变化的文档才会通过bulk writer批量写回。
+    指定--merge时，直接在服务器端通过$setWindowFields和$merge完成计算和写回（需要MongoDB 5.0以上）。
+    """
+
     name = "poi-rank"
+    shardable = True
 
     def __init__(self, *args, **kwargs):
         BaseProcessor.__init__(self, *args, **kwargs)
+        self.build_args()
+
+        # 统计：重新计算的文档数量，以及其中rank发生变化的数量
+        self.ranked = 0
+        self.changed = 0
+
+    def build_args(self):
+        """
+        处理命令行参数
+        """
+        import argparse
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--col', action='append', choices=['Restaurant', 'Shopping', 'Hotel', 'ViewSpot'])
+        # 目的地的ObjectId。不指定的话，处理所有的目的地
+        parser.add_argument('--locality', nargs='*')
+        parser.add_argument('--query', type=str)
+        parser.add_argument('--merge', action='store_true')
+        self.args, leftover = parser.parse_known_args()
+
+    def build_query(self):
+        query = {'taoziEna': True}
+        if self.args.query:
+            exec 'from bson import ObjectId'
+            query = {'$and': [query, eval(self.args.query)]}
+        return query
+
+    def get_localities(self, col, query):
+        if self.args.locality:
+            return [ObjectId(loc_id) for loc_id in self.args.locality]
+        return sorted(filter(lambda v: v is not None, col.distinct('locality._id', query)))
+
+    def rank_locality(self, col, query, loc_id):
+        """
+        计算某个目的地下POI的排名，只写回发生变化的部分
+        """
+        loc_query = {'$and': [query, {'locality._id': loc_id}]}
+        source = CursorSource(col, loc_query, {'_id': 1, 'rank': 1},
+                              sort=[('hotness', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)])
+
+        count = 0
+        changed = 0
+        for idx, entry in enumerate(source):
+            count += 1
+            rank = idx + 1
+            if entry.get('rank') != rank:
+                changed += 1
+                self.bulk.update(col, {'_id': entry['_id']}, {'$set': {'rank': rank}})
+
+        self.ranked += count
+        self.changed += changed
+        if 0 == count:
+            self.log('%s can\'t be found with "locality._id" in %s' % (loc_id, col.full_name))
+        else:
+            self.log('%s: %d ranked, %d changed' % (loc_id, count, changed))
+
+    def heartbeat_reports(self):
+        return BaseProcessor.heartbeat_reports(self) + ['Ranks: %d computed, %d changed' % (self.ranked, self.changed)]
+
+    @staticmethod
+    def supports_merge(col):
+        """
+        $setWindowFields需要MongoDB 5.0以上
+        """
+        version = col.database.command('buildInfo').get('versionArray', [0])
+        return version[0] >= 5
+
+    def rank_by_merge(self, col, query):
+        """
+        在服务器端完成排名，并通过$merge写回。只有rank发生变化的文档才会被写回
+        """
+        from bson.son import SON
+
+        match = dict(query)
+        if self.args.locality:
+            match = {'$and': [query, {'locality._id': {'$in': [ObjectId(v) for v in self.args.locality]}}]}
+
+        pipeline = [
+            {'$match': match},
+            {'$setWindowFields': {'partitionBy': '$locality._id', 'sortBy': SON([('hotness', -1), ('_id', 1)]),
+                                  'output': {'newRank': {'$documentNumber': {}}}}},
+            {'$match': {'$expr': {'$ne': ['$rank', '$newRank']}}},
+            {'$project': {'_id': 1, 'rank': '$newRank'}},
+            {'$merge': {'into': col.name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+        ]
+        col.database.command('aggregate', col.name, pipeline=pipeline, cursor={}, allowDiskUse=True)
+        self.log('Ranks of %s merged on the server side' % col.full_name)
 
     def populate_tasks(self):
+        query = self.build_query()
+
+        for col_name in self.args.col or ['Shopping', 'Hotel']:
+            col = get_mongodb('poi', col_name, 'mongo')
 
-        # extract ids
-        fin = open('/root/Dhaulagiri/tempfile/online_city_raw.txt', 'r')
-        fout = open('/root/Dhaulagiri/tempfile/online_city_final.txt','a')
-        id_list = []
-        id_kv_name = {}
-
-        for line in fin.readlines():
-            temp_id = line[20:44]
-            id_list.append(temp_id)
-            temp_name = line.split(' ')[6].replace('"', '')
-            id_kv_name[temp_id] = temp_name
-            fout.write(('%s %s\n') % (temp_id, temp_name))
-
-        fin.close()
-        fout.close()
-        print id_list
-
-        # Restaurant
-        cols = ["Shopping", "Hotel"]
-        for col in cols:
-            print 'Begin %s' % col
-            for loc_id in id_list:
-                col_poi = get_mongodb('poi', col, 'mongo')
-                query = {'taoziEna': True, 'locality._id': ObjectId(loc_id)}
-                cursor = list(col_poi.find(query, {"_id": 1}).sort('hotness', pymongo.DESCENDING))
-
-                if 0 == len(cursor):
-                    print ('%s %s can\'t be find with "locality._id"') % (loc_id, id_kv_name[loc_id])
+            if self.args.merge:
+                if self.supports_merge(col):
+                    # 服务器端一次完成所有目的地，多进程模式下只需要执行一次
+                    if self.is_primary_shard():
+                        self.rank_by_merge(col, query)
                     continue
+                self.log('$setWindowFields is not supported by the server, falling back to bulk writes')
 
-                for idx, val in enumerate(cursor):
-                    def func(entry=val, flag=idx):
-                        col_poi.update({"_id": entry['_id']}, {'$set': {'rank': flag + 1}})
+            self.log('Begin %s' % col_name)
+            # 多进程模式下，按照目的地分片
+            for loc_id in self.shard_cursor(self.get_localities(col, query), key=lambda v: v):
+                def func(c=col, loc=loc_id):
+                    self.rank_locality(c, query, loc)
 
-                    self.add_task(func)
-            print '\n'
\ No newline at end of file
+                self.add_task(func)
@@ -0,0 +1,66 @@
+# coding=utf-8
+"""
+测试用例。在仓库的根目录下执行：python -m unittest discover -s tests -t .
+
+测试不读取conf/dhaulagiri.yaml，而是使用下面的最小配置。
+需要redis的测试连接DHAULAGIRI_TEST_REDIS（默认为127.0.0.1:6379）的db 15，并且会清空这个数据库；连接不上时跳过。
+"""
+import os
+import unittest
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import utils
+
+__author__ = 'zephyre'
+
+REDIS_HOST, REDIS_PORT = os.environ.get('DHAULAGIRI_TEST_REDIS', '127.0.0.1:6379').split(':')
+REDIS_PORT = int(REDIS_PORT)
+REDIS_DB = 15
+
+utils.load_yaml.config = {
+    'request': {},
+    'logging': {'write_to_stream': False, 'write_to_file': False, 'log_level': 'INFO'},
+    'redis': [{'profile': 'test', 'host': REDIS_HOST, 'port': REDIS_PORT, 'db_no': REDIS_DB}],
+}
+
+
+def get_test_redis():
+    """
+    获得测试使用的RedisClient，并清空数据库。连接不上时跳过测试
+    """
+    from redis.exceptions import ConnectionError
+    from core import RedisClient
+
+    cli = RedisClient('test')
+    try:
+        cli.redis.flushdb()
+    except ConnectionError:
+        raise unittest.SkipTest('No redis-server at %s:%d' % (REDIS_HOST, REDIS_PORT))
+    return cli
+
+
+def serve_stub(handler):
+    """
+    在本地启动一个HTTP服务器（后台线程）
+    :return: (server, 'http://127.0.0.1:port')。server.connections为已经接受的TCP连接数
+    """
+    import threading
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class StubServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        connections = 0
+
+        def process_request(self, request, client_address):
+            self.connections += 1
+            ThreadingMixIn.process_request(self, request, client_address)
+
+    server = StubServer(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
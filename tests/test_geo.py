@@ -0,0 +1,97 @@
+# coding=utf-8
+import unittest
+from random import Random
+
+from utils import haversine
+
+__author__ = 'zephyre'
+
+
+def random_points(n, seed):
+    rnd = Random(seed)
+    return [rnd.uniform(100, 120) for _ in xrange(n)], [rnd.uniform(20, 40) for _ in xrange(n)]
+
+
+class GeoIndexTest(unittest.TestCase):
+    def brute_force(self, lngs, lats, lng, lat):
+        return sorted((haversine(lng, lat, x, y), idx) for idx, (x, y) in enumerate(zip(lngs, lats)))
+
+    def check(self, n):
+        from utils.geo import GeoIndex
+
+        lngs, lats = random_points(n, n)
+        index = GeoIndex(lngs, lats)
+        for lng, lat in zip(*random_points(20, -n)):
+            expected = self.brute_force(lngs, lats, lng, lat)
+
+            (idx, dist), = index.query(lng, lat)
+            self.assertEqual(idx, expected[0][1])
+            self.assertAlmostEqual(dist, expected[0][0], places=6)
+
+            hits = index.query_radius(lng, lat, 300)
+            self.assertEqual([v[0] for v in hits], [v[1] for v in expected if v[0] <= 300])
+
+    def test_small_index(self):
+        self.check(10)
+
+    def test_large_index(self):
+        self.check(500)
+
+    def test_empty_index(self):
+        from utils.geo import GeoIndex
+
+        index = GeoIndex([], [])
+        self.assertEqual(index.query(116.4, 39.9), [])
+        self.assertEqual(index.query_radius(116.4, 39.9, 100), [])
+
+
+class Collection(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        return self
+
+    def sort(self, key, direction):
+        return sorted(self.docs, key=lambda doc: doc[key])
+
+
+class GeoResolverTest(unittest.TestCase):
+    def setUp(self):
+        from utils.geo import GeoResolver
+
+        lngs, lats = random_points(200, 0)
+        self.docs = [{'_id': idx, 'alias': ['city-%d' % (idx % 10)],
+                      'location': {'type': 'Point', 'coordinates': [lng, lat]}}
+                     for idx, (lng, lat) in enumerate(zip(lngs, lats))]
+        self.docs.append({'_id': 200, 'alias': ['city-0']})
+
+        self.resolver = GeoResolver(ttl=0)
+        for kind in ('locality', 'country'):
+            alias_map, alias_sorted, source_map, located = self.resolver._load_kind(Collection(self.docs))
+            self.resolver._alias[kind] = alias_map
+            self.resolver._alias_sorted[kind] = alias_sorted
+            self.resolver._source[kind] = source_map
+            self.resolver._located[kind] = located
+        self.resolver.load_ts = 0
+
+    def nearest(self, lng, lat, max_distance, alias=None):
+        best = None
+        for doc in self.docs:
+            if 'location' not in doc or (alias and alias not in doc['alias']):
+                continue
+            dist = haversine(lng, lat, *doc['location']['coordinates']) * 1000
+            if dist <= max_distance and (best is None or dist < best[1]):
+                best = doc, dist
+        return best
+
+    def test_nearest(self):
+        for lng, lat in zip(*random_points(20, 1)):
+            for max_distance, alias in ((50000, None), (500000, None), (500000, 'city-3'), (1, None)):
+                expected = self.nearest(lng, lat, max_distance, alias)
+                doc, dist = self.resolver.nearest(lng, lat, max_distance, alias=alias)
+                if expected is None:
+                    self.assertIsNone(doc)
+                else:
+                    self.assertEqual(doc['_id'], expected[0]['_id'])
+                    self.assertAlmostEqual(dist, expected[1], places=3)
@@ -0,0 +1,99 @@
+# coding=utf-8
+import socket
+import unittest
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from tests import serve_stub
+
+__author__ = 'zephyre'
+
+
+class CanaryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('canary')
+
+    def log_message(self, *args):
+        pass
+
+
+class ForwardingHandler(CanaryHandler):
+    """
+    正常转发的代理
+    """
+
+    def do_GET(self):
+        # 代理请求中，path是完整的URL
+        body = urllib2.build_opener(urllib2.ProxyHandler({})).open(self.path, timeout=3).read()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BrokenHandler(CanaryHandler):
+    """
+    总是返回502的代理
+    """
+
+    def do_GET(self):
+        self.send_response(502)
+        self.end_headers()
+
+
+class ProxyProberTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        canary_url = self.serve(CanaryHandler) + '/canary'
+        self.good = self.serve(ForwardingHandler)
+        self.broken = self.serve(BrokenHandler)
+
+        # 无法连接的代理：绑定一个端口之后立即关闭
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.dead = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+
+        from middlewares.proxy import ProxyPool, ProxyProber
+
+        self.pool = ProxyPool(max_error=1, cooldown=60)
+        for name in (self.good, self.broken, self.dead):
+            self.pool.add(name)
+        self.prober = ProxyProber(self.pool, canary_url, timeout=1, expect='canary')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def serve(self, handler):
+        server, url = serve_stub(handler)
+        self.servers.append(server)
+        return url
+
+    def is_active(self, name):
+        return self.pool._stats[name].idx >= 0
+
+    def test_probe_sorts_out_failing_proxies(self):
+        for _ in xrange(3):
+            self.prober.probe_all()
+
+        self.assertTrue(self.is_active(self.good))
+        self.assertFalse(self.is_active(self.broken))
+        self.assertFalse(self.is_active(self.dead))
+        self.assertGreater(self.pool._stats[self.good].success, self.pool._stats[self.broken].success)
+        self.assertEqual(self.pool.pick(), self.good)
+
+    def test_probe_revives_cooling_proxy(self):
+        # 连续失败，进入冷却状态（cooldown为60秒）
+        for _ in xrange(2):
+            self.pool.record(self.good, False)
+        self.assertFalse(self.is_active(self.good))
+
+        self.prober.probe_all()
+        self.assertTrue(self.is_active(self.good))
+        self.assertEqual(self.pool._stats[self.good].success, 1.0)
+        self.assertNotIn(self.pool._stats[self.good], self.pool._cooling)
+        # 失败的代理没有因为检查而被恢复
+        self.assertLess(self.pool._stats[self.broken].success, 1.0)
@@ -0,0 +1,146 @@
+# coding=utf-8
+import os
+import signal
+import unittest
+from Queue import Empty
+from urlparse import urlparse
+
+from tests import get_test_redis
+
+__author__ = 'zephyre'
+
+
+def make_task(name, url=None, priority=None):
+    def task():
+        return name
+
+    if url:
+        setattr(task, 'task_host', urlparse(url).netloc)
+    if priority is not None:
+        setattr(task, 'priority', priority)
+    return task
+
+
+class LocalSchedulerTest(unittest.TestCase):
+    def test_fair_share_interleaves_hosts(self):
+        from utils.scheduler import FairShareScheduler
+
+        # 按照host分组添加的任务（比如图片列表中，某个host的URL集中在一起），应该在各个host之间交替取出
+        urls = ['http://a.example.com/%d.jpg' % idx for idx in xrange(4)] + \
+               ['http://b.example.com/%d.jpg' % idx for idx in xrange(4)] + ['http://c.example.com/0.jpg']
+        scheduler = FairShareScheduler()
+        for url in urls:
+            scheduler.put(make_task(urlparse(url).netloc[0], url))
+        self.assertEqual(''.join(scheduler.get()() for _ in urls), 'abcababab')
+
+    def test_priority_follow_ups_first(self):
+        from utils.scheduler import PriorityScheduler
+
+        # 分页等后续任务（priority=1）应该先于cursor中的普通任务被取出
+        scheduler = PriorityScheduler()
+        for idx in xrange(3):
+            scheduler.put(make_task('cursor-%d' % idx))
+        for idx in xrange(2):
+            scheduler.put(make_task('page-%d' % (idx + 2), priority=1), force=True)
+        self.assertEqual([scheduler.get()() for _ in xrange(5)],
+                         ['page-2', 'page-3', 'cursor-0', 'cursor-1', 'cursor-2'])
+
+
+def build_task(desc):
+    def task():
+        return desc['entry_id']
+
+    setattr(task, 'task_desc', desc)
+    return task
+
+
+class RedisSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.cli = get_test_redis()
+
+    def tearDown(self):
+        self.cli.redis.flushdb()
+
+    def make_scheduler(self):
+        from utils.scheduler import RedisScheduler
+
+        return RedisScheduler(queue_name='test', task_builder=build_task, redis_cli=self.cli, visibility_timeout=1,
+                              poll_interval=0.1)
+
+    def drain(self, consumer):
+        completed = []
+        while not consumer.empty():
+            try:
+                task = consumer.get(timeout=0.2)
+            except Empty:
+                continue
+            completed.append(task())
+            consumer.task_done(task)
+        return completed
+
+    def test_consumer_ignores_previous_run(self):
+        previous = self.make_scheduler()
+        previous.start_producing()
+        previous.finish_producing()
+
+        # 新的生产者启动之前，上一次run留下的done标记不能让消费者退出
+        consumer = self.make_scheduler()
+        self.assertFalse(consumer.empty())
+
+        producer = self.make_scheduler()
+        producer.start_producing()
+        producer.put(build_task({'entry_id': 0}))
+        producer.finish_producing()
+
+        self.assertEqual(self.drain(consumer), [0])
+        self.assertTrue(producer.empty())
+
+    def test_killed_consumer_task_is_reaped(self):
+        producer = self.make_scheduler()
+        producer.start_producing()
+        for idx in xrange(3):
+            producer.put(build_task({'entry_id': idx}))
+        producer.finish_producing()
+
+        # 子进程取走一个任务，在确认之前被kill
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            try:
+                self.make_scheduler().get()
+                os.write(w, 'claimed')
+                signal.pause()
+            finally:
+                os._exit(1)
+
+        os.close(w)
+        self.assertEqual(os.read(r, 16), 'claimed')
+        os.close(r)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cli.redis.zcard(producer.processing_key), 1)
+
+        consumer = self.make_scheduler()
+        self.assertEqual(sorted(self.drain(consumer)), [0, 1, 2])
+        self.assertEqual(consumer.reaped, 1)
+        self.assertEqual(consumer.acked, 3)
+        self.assertEqual(self.cli.redis.zcard(consumer.processing_key), 0)
+        self.assertTrue(producer.empty())
+
+    def test_follow_ups_stay_local_and_others_keep_backpressure(self):
+        from Queue import Full
+        from utils.scheduler import RedisScheduler
+
+        scheduler = RedisScheduler(maxsize=1, queue_name='test', task_builder=build_task, redis_cli=self.cli,
+                                   poll_interval=0.1)
+        scheduler.start_producing()
+
+        # 无法序列化的任务在本地执行，但仍然受maxsize的限制
+        scheduler.put(make_task('local-0'))
+        self.assertRaises(Full, scheduler.put, make_task('local-1'), timeout=0.2)
+
+        # 后续任务即使带有task_desc，也在本地执行，不受maxsize的限制
+        scheduler.put(build_task({'entry_id': 'page-2'}), force=True)
+        self.assertEqual(self.cli.redis.llen(scheduler.pending_key), 0)
+        self.assertEqual([scheduler.get(block=False)() for _ in xrange(2)], ['local-0', 'page-2'])
@@ -0,0 +1,50 @@
+# coding=utf-8
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from tests import serve_stub
+
+__author__ = 'zephyre'
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 缓冲响应，避免header和body分成两个TCP包（和delayed ACK叠加，长连接上每个请求会多出40ms）
+    wbufsize = -1
+
+    def do_GET(self):
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SessionPoolTest(unittest.TestCase):
+    count = 50
+
+    def run_requests(self, pool_size):
+        from core import RequestHelper, SessionPool
+
+        server, url = serve_stub(OkHandler)
+        try:
+            helper = RequestHelper()
+            helper.session_pool = SessionPool(max_size=pool_size)
+            bodies = [helper.request('GET', '%s/item/%d' % (url, idx), retry=1).text for idx in xrange(self.count)]
+            return bodies, server.connections
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_pooled_sessions_reuse_connections(self):
+        bodies, connections = self.run_requests(64)
+        self.assertEqual(bodies, ['ok'] * self.count)
+        self.assertEqual(connections, 1)
+
+    def test_unpooled_sessions_open_a_connection_per_request(self):
+        bodies, connections = self.run_requests(0)
+        self.assertEqual(bodies, ['ok'] * self.count)
+        self.assertEqual(connections, self.count)
@@ -0,0 +1,85 @@
+# coding=utf-8
+import os
+import unittest
+
+__author__ = 'zephyre'
+
+
+class SortedCollection(object):
+    """
+    只支持按照_id排序的find_one
+    """
+
+    def __init__(self, ids):
+        self.ids = sorted(ids)
+
+    def find_one(self, query, projection, sort):
+        if not self.ids:
+            return None
+        return {'_id': self.ids[0] if sort[0][1] > 0 else self.ids[-1]}
+
+
+class IdBoundsTest(unittest.TestCase):
+    def assert_partition(self, ids, total):
+        from utils.shard import id_bounds, range_cond
+
+        bounds = id_bounds(SortedCollection(ids), {}, total)
+        self.assertEqual(len(bounds), total - 1)
+
+        # 每个文档恰好属于一个分片
+        for _id in ids:
+            matched = [idx for idx in xrange(total) if all(
+                (_id >= v if op == '$gte' else _id < v) for op, v in range_cond(bounds, idx).items())]
+            self.assertEqual(len(matched), 1, _id)
+
+    def test_numeric_ids(self):
+        self.assert_partition(range(3, 1000, 7), 4)
+
+    def test_object_ids(self):
+        from datetime import datetime, timedelta
+        from bson.objectid import ObjectId
+
+        start = datetime(2015, 1, 1)
+        self.assert_partition([ObjectId.from_datetime(start + timedelta(hours=idx)) for idx in xrange(100)], 3)
+
+    def test_unsplittable(self):
+        from utils.shard import id_bounds
+
+        self.assertIsNone(id_bounds(SortedCollection([]), {}, 4))
+        self.assertIsNone(id_bounds(SortedCollection(['a', 'b']), {}, 4))
+
+    def test_open_ends(self):
+        from utils.shard import range_cond
+
+        self.assertEqual(range_cond([10, 20], 0), {'$lt': 10})
+        self.assertEqual(range_cond([10, 20], 1), {'$gte': 10, '$lt': 20})
+        self.assertEqual(range_cond([10, 20], 2), {'$gte': 20})
+
+
+class ShardSupervisorTest(unittest.TestCase):
+    def test_plan_is_computed_once_and_shared(self):
+        from utils.shard import ShardSupervisor
+
+        planned = []
+
+        def planner(total):
+            planned.append(total)
+            return [os.getpid(), total]
+
+        parent = os.getpid()
+        r, w = os.pipe()
+
+        def target():
+            import conf
+
+            shard = conf.global_conf['shard']
+            os.write(w, '%d:%s\n' % (shard['index'], ','.join(str(v) for v in shard['plan'])))
+
+        failed = ShardSupervisor(3, heartbeat_interval=3600).run(target, planner=planner)
+        os.close(w)
+        with os.fdopen(r) as f:
+            lines = sorted(f.read().split())
+
+        self.assertEqual(failed, 0)
+        self.assertEqual(planned, [3])
+        self.assertEqual(lines, ['%d:%d,3' % (idx, parent) for idx in xrange(3)])
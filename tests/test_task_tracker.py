@@ -0,0 +1,53 @@
+# coding=utf-8
+import time
+import unittest
+
+from tests import get_test_redis
+
+__author__ = 'zephyre'
+
+
+class Task(object):
+    def __init__(self, key):
+        self.task_key = key
+
+
+class RedisTaskTrackerTest(unittest.TestCase):
+    def setUp(self):
+        from core import RedisTaskTracker
+
+        self.cli = get_test_redis()
+        self.tracker = RedisTaskTracker(redis_cli=self.cli, expire=600, batch_size=10, flush_interval=0.2)
+
+    def tearDown(self):
+        self.cli.redis.flushdb()
+
+    def test_update_flushes_at_batch_size(self):
+        tasks = [Task('test:task:%d' % idx) for idx in xrange(15)]
+        self.assertEqual(self.tracker.track_many(tasks), [False] * 15)
+
+        for task in tasks:
+            self.tracker.update(task)
+        # 第一个batch已经写入，剩下的5个仍然在缓冲区中
+        self.assertEqual(self.tracker.track_many(tasks), [True] * 10 + [False] * 5)
+
+        self.tracker.flush()
+        self.assertEqual(self.tracker.track_many(tasks), [True] * 15)
+        self.assertTrue(0 < self.cli.redis.ttl('test:task:0') <= 600)
+
+    def test_flush_expired_waits_for_interval(self):
+        task = Task('test:task:slow')
+        self.tracker.update(task)
+
+        self.tracker.flush_expired()
+        self.assertFalse(self.tracker.track(task))
+
+        time.sleep(0.25)
+        self.tracker.flush_expired()
+        self.assertTrue(self.tracker.track(task))
+
+    def test_tasks_without_key_are_not_tracked(self):
+        task = Task(None)
+        self.tracker.update(task)
+        self.tracker.flush()
+        self.assertEqual(self.tracker.track_many([task, Task('test:task:x')]), [False, False])
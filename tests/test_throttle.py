@@ -0,0 +1,108 @@
+# coding=utf-8
+import logging
+import sys
+import unittest
+
+import gevent
+from requests import Request
+
+from middlewares import DownloadMiddleware
+
+__author__ = 'zephyre'
+
+
+class Engine(object):
+    logger = logging.getLogger('test')
+
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+
+
+class Manager(object):
+    engine = Engine()
+
+
+class ThrottleTest(unittest.TestCase):
+    def setUp(self):
+        from core import dhaulagiri_settings
+        from middlewares.throttle import ThrottleMiddleware
+
+        dhaulagiri_settings['throttle'] = {'rate': 1000.0, 'max_rate': 1000.0, 'burst': 100, 'concurrency': 2}
+        argv = sys.argv
+        sys.argv = ['test', '--throttle']
+        try:
+            self.throttle = ThrottleMiddleware(Manager())
+        finally:
+            sys.argv = argv
+        self.req = Request('GET', 'http://a.example.com/item').prepare()
+
+    def test_concurrency_per_host(self):
+        running = [0, 0]
+
+        def fetch(url):
+            req = Request('GET', url).prepare()
+            self.throttle.on_request(req, None, {})
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+            gevent.sleep(0.02)
+            running[0] -= 1
+            self.throttle.on_failure(req, {})
+
+        gevent.joinall([gevent.spawn(fetch, 'http://a.example.com/%d' % idx) for idx in xrange(6)])
+        self.assertEqual(running[1], 2)
+        self.assertEqual(self.throttle.in_flight('a.example.com'), 0)
+
+        # 不同的host互不影响
+        running[1] = 0
+        gevent.joinall([gevent.spawn(fetch, 'http://%s.example.com/' % name) for name in 'bcd'])
+        self.assertEqual(running[1], 3)
+
+    def test_slot_reclaimed_from_interrupted_requests(self):
+        def hold():
+            self.throttle.on_request(self.req, None, {})
+            gevent.sleep(60)
+
+        # 请求过程中被kill
+        g = gevent.spawn(hold)
+        gevent.sleep(0)
+        self.assertEqual(self.throttle.in_flight('a.example.com'), 1)
+        g.kill()
+        # link的回调在下一轮事件循环中执行
+        gevent.sleep(0)
+        self.assertEqual(self.throttle.in_flight('a.example.com'), 0)
+
+        # 请求没有经过on_response/on_failure，同一个greenlet再次请求
+        def retry():
+            self.throttle.on_request(self.req, None, {})
+            self.throttle.on_request(self.req, None, {})
+            return self.throttle.in_flight('a.example.com')
+
+        self.assertEqual(gevent.spawn(retry).get(), 1)
+
+
+class First(DownloadMiddleware):
+    run_before = ('Second',)
+
+
+class Second(DownloadMiddleware):
+    pass
+
+
+class MiddlewareOrderTest(unittest.TestCase):
+    def load(self, first_priority, second_priority):
+        from middlewares import MiddlewareManager
+
+        return MiddlewareManager(Engine({'middlewares': {'download': [
+            {'name': 'tests.test_throttle.First', 'priority': first_priority},
+            {'name': 'tests.test_throttle.Second', 'priority': second_priority}]}}))
+
+    def test_run_before(self):
+        manager = self.load(2, 1)
+        self.assertEqual([type(entry['middleware']) for entry in manager.mw_dict['download']], [First, Second])
+        self.assertRaises(ValueError, self.load, 1, 2)
+
+    def test_throttle_runs_before_proxy(self):
+        from middlewares.proxy import ProxyMiddleware
+        from middlewares.throttle import ThrottleMiddleware
+
+        self.assertIn(ProxyMiddleware.__name__, ThrottleMiddleware.run_before)
@@ -0,0 +1,247 @@
+# coding=utf-8
+import logging
+import math
+import os
+import struct
+from hashlib import md5
+
+from gevent.lock import BoundedSemaphore
+
+from utils import load_yaml
+
+__author__ = 'zephyre'
+
+
+class BloomFilter(object):
+    """
+    Bloom filter。might_contain返回False时，key一定不存在；返回True时，key可能存在（误判率约为error_rate）
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # Double hashing: h1 + i * h2
+        h1, h2 = struct.unpack('<QQ', md5(str(key)).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def dump(self):
+        return {'capacity': self.capacity, 'error_rate': self.error_rate, 'count': self.count,
+                'bits': str(self.bits)}
+
+    @classmethod
+    def load(cls, data):
+        bf = cls(data['capacity'], data['error_rate'])
+        bf.bits = bytearray(data['bits'])
+        bf.count = data['count']
+        return bf
+
+
+class KeyFilter(object):
+    """
+    位于某个MongoDB collection之前的Bloom filter，用于减少"是否存在"的查询。
+
+    启动时，从磁盘加载上次保存的filter，然后增量加载上次扫描之后写入的文档。如果磁盘上没有filter，则完整扫描collection。
+    运行期间，其它分片或者节点写入的文档需要通过refresh定期加载。
+
+    增量加载按照ObjectId中的时间戳进行，而不是_id的大小：不同客户端生成的ObjectId并不按写入顺序递增，
+    所以每次从上次扫描开始时间之前overlap秒开始加载，以覆盖时钟偏差和扫描时尚未完成的写入。
+    如果collection的_id不是ObjectId，则每次refresh都完整扫描。
+    由于只能增量添加，如果collection中有文档被删除，filter只会产生更多的误判，不会导致漏判。
+    """
+
+    def __init__(self, db, col_name, field, profile, error_rate=0.001, capacity=None, path=None, overlap=600,
+                 refresh_interval=300):
+        self.db = db
+        self.col_name = col_name
+        self.field = field
+        self.profile = profile
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.path = path
+        # 增量加载时向前回溯的秒数
+        self.overlap = overlap
+        # 两次refresh之间的最小间隔（秒）
+        self.refresh_interval = refresh_interval
+
+        self.bloom = None
+        # 上一次扫描的开始时间（UTC）。在这一时间之前overlap秒以后写入的文档，下一次扫描时会重新加载
+        self.last_ts = None
+        self.refresh_ts = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = BoundedSemaphore(1)
+
+        self.name = '%s.%s.%s' % (db, col_name, field)
+
+    def _file_name(self):
+        return os.path.join(self.path, '%s.bloom' % self.name) if self.path else None
+
+    def _get_col(self):
+        from utils.database import get_mongodb
+
+        return get_mongodb(self.db, self.col_name, self.profile)
+
+    def load(self):
+        import cPickle
+
+        fname = self._file_name()
+        if fname and os.path.isfile(fname):
+            try:
+                with open(fname, 'rb') as f:
+                    data = cPickle.load(f)
+                self.bloom = BloomFilter.load(data['bloom'])
+                self.last_ts = data['last_ts']
+            except (IOError, EOFError, KeyError, cPickle.UnpicklingError):
+                self.bloom = None
+                self.last_ts = None
+
+        if not self.bloom:
+            # 预留足够的空间
+            capacity = max(self.capacity or 0, self._get_col().count() * 2, 1000)
+            self.bloom = BloomFilter(capacity, self.error_rate)
+            self.last_ts = None
+
+        self.refresh(force=True)
+        return self
+
+    def refresh(self, force=False):
+        """
+        加载上次扫描之后写入的文档
+        :param force: 如果为False，距离上次refresh不足refresh_interval时直接返回
+        """
+        from datetime import datetime, timedelta
+        from time import time
+        from bson.objectid import ObjectId
+
+        if not force and self.refresh_ts is not None and time() - self.refresh_ts < self.refresh_interval:
+            return
+
+        try:
+            self._lock.acquire()
+            col = self._get_col()
+
+            sample = col.find_one({}, {'_id': 1})
+            if sample is None:
+                self.refresh_ts = time()
+                return
+            if not isinstance(sample['_id'], ObjectId):
+                # 无法按照时间增量加载
+                self.last_ts = None
+
+            scan_ts = datetime.utcnow()
+            if self.last_ts is not None:
+                query = {'_id': {'$gte': ObjectId.from_datetime(self.last_ts - timedelta(seconds=self.overlap))}}
+            else:
+                query = {}
+            for entry in col.find(query, {self.field: 1}):
+                if self.field in entry and entry[self.field] is not None:
+                    self.bloom.add(entry[self.field])
+
+            self.last_ts = scan_ts if isinstance(sample['_id'], ObjectId) else None
+            self.refresh_ts = time()
+        finally:
+            self._lock.release()
+
+    def save(self):
+        import cPickle
+
+        fname = self._file_name()
+        if not fname or not self.bloom:
+            return
+
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+        # 多进程模式下，各个分片都会保存，临时文件不能重名
+        tmp_name = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            cPickle.dump({'bloom': self.bloom.dump(), 'last_ts': self.last_ts}, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, fname)
+
+    def might_exist(self, key):
+        """
+        返回False时，key在上一次refresh时一定不存在，不必再查询数据库。
+        上一次refresh之后由其它分片或者节点写入的key可能返回False，调用者需要能够容忍这种情况（比如写入操作是幂等的）
+        """
+        ret = key in self.bloom
+        if ret:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return ret
+
+    def add(self, key):
+        self.bloom.add(key)
+
+    def report(self):
+        return ['Key filter [%s]: %d keys, %d hits, %d misses' % (self.name, self.bloom.count if self.bloom else 0,
+                                                                   self.hits, self.misses)]
+
+
+key_filters = {}
+
+_key_filters_lock = BoundedSemaphore(1)
+
+
+def get_key_filter(db, col_name, field, profile):
+    """
+    获得某个collection字段的KeyFilter。第一次调用时加载
+    """
+    sig = '%s|%s|%s|%s' % (db, col_name, field, profile)
+    if sig not in key_filters:
+        try:
+            _key_filters_lock.acquire()
+            if sig not in key_filters:
+                import tempfile
+
+                section = load_yaml().get('bloom', {})
+                path = section.get('path', os.path.join(tempfile.gettempdir(), 'dhaulagiri-bloom'))
+                key_filters[sig] = KeyFilter(db, col_name, field, profile, error_rate=section.get('error_rate', 0.001),
+                                             capacity=section.get('capacity'), path=path,
+                                             overlap=section.get('overlap', 600),
+                                             refresh_interval=section.get('refresh_interval', 300)).load()
+                logging.getLogger('bloom').debug('Key filter loaded: %s' % key_filters[sig].name)
+        finally:
+            _key_filters_lock.release()
+
+    return key_filters[sig]
+
+
+def save_key_filters():
+    """
+    将所有已加载的KeyFilter保存到磁盘
+    """
+    for kf in key_filters.values():
+        kf.save()
+
+
+def refresh_key_filters():
+    """
+    加载所有KeyFilter在上次refresh之后写入的文档（未到refresh_interval的会被跳过）
+    """
+    for kf in key_filters.values():
+        kf.refresh()
@@ -0,0 +1,239 @@
+# coding=utf-8
+import logging
+from time import time
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+__author__ = 'zephyre'
+
+
+class BulkWriter(object):
+    """
+    Write-behind sink for MongoDB writes. Operations are buffered per collection and flushed as unordered bulk
+    operations, either when the buffer reaches batch_size, or when the oldest buffered operation is older than
+    flush_interval seconds.
+
+    Note: operations within the same flush are unordered. Callers should not rely on the order of two writes
+    targeting the same document.
+
+    每个操作都记录了owner（默认为当前greenlet的bulk_owner属性，即正在执行的任务，参见processors.Worker）。
+    失败的操作会在下一次flush时重试，最多max_retries次；仍然失败的操作，其owner会被记录下来（参见failed）。
+    processor据此判断任务的写入是否已经完成（pending），避免在写入失败的情况下，将任务标记为已完成。
+    """
+
+    def __init__(self, logger=None, batch_size=500, flush_interval=5, max_retries=3):
+        self.logger = logger if logger else logging.getLogger('bulk_writer')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        # full_name => {'col': collection, 'ops': [...], 'ts': timestamp of the first buffered op}
+        self._buffers = {}
+        # 每个collection一把锁，保证同一个collection的flush顺序执行
+        self._locks = {}
+        self._lock = BoundedSemaphore(1)
+
+        # full_name => {'flushes', 'docs', 'failed', 'retried', 'latency', 'max_latency'}
+        self.stats = {}
+
+        # owner => 尚未写入（或者等待重试）的操作数量
+        self._owners = {}
+        # 写入最终失败的owner
+        self._failed_owners = set()
+
+        self._flusher = None
+
+    @classmethod
+    def from_settings(cls, settings, logger=None):
+        section = settings.get('bulk', {}) if settings else {}
+        return cls(logger=logger, batch_size=section.get('batch_size', 500),
+                   flush_interval=section.get('flush_interval', 5), max_retries=section.get('max_retries', 3))
+
+    def _get_lock(self, sig):
+        if sig not in self._locks:
+            try:
+                self._lock.acquire()
+                if sig not in self._locks:
+                    self._locks[sig] = BoundedSemaphore(1)
+                    self.stats[sig] = {'flushes': 0, 'docs': 0, 'failed': 0, 'retried': 0, 'latency': 0.0,
+                                       'max_latency': 0.0}
+            finally:
+                self._lock.release()
+        return self._locks[sig]
+
+    def update(self, col, spec, doc, upsert=False, owner=None):
+        """
+        添加一个update操作。doc中如果不含有$开头的操作符，则作为replacement处理（和collection.update的语义一致）
+        :param owner: 操作所属的任务。默认为当前greenlet的bulk_owner属性
+        """
+        if owner is None:
+            owner = getattr(gevent.getcurrent(), 'bulk_owner', None)
+
+        sig = col.full_name
+        self._get_lock(sig)
+
+        if sig not in self._buffers:
+            self._buffers[sig] = {'col': col, 'ops': [], 'ts': None}
+        if owner is not None:
+            self._owners[owner] = self._owners.get(owner, 0) + 1
+        self._append(sig, (spec, doc, upsert, owner, 0))
+
+        if len(self._buffers[sig]['ops']) >= self.batch_size:
+            self.flush_collection(sig)
+
+    def upsert(self, col, spec, doc, owner=None):
+        self.update(col, spec, doc, upsert=True, owner=owner)
+
+    def _append(self, sig, op):
+        buf = self._buffers[sig]
+        if not buf['ops']:
+            buf['ts'] = time()
+        buf['ops'].append(op)
+
+    def _settle(self, owner, success):
+        """
+        某个操作已经写入，或者最终失败
+        """
+        if owner is None:
+            return
+        self._owners[owner] -= 1
+        if not self._owners[owner]:
+            self._owners.pop(owner)
+        if not success:
+            self._failed_owners.add(owner)
+
+    def pending(self, owner):
+        """
+        owner是否还有尚未写入的操作
+        """
+        return owner in self._owners
+
+    def failed(self, owner):
+        """
+        owner是否有写入失败的操作
+        """
+        return owner in self._failed_owners
+
+    def forget(self, owner):
+        """
+        owner对应的任务已经处理完毕，清除失败记录
+        """
+        self._failed_owners.discard(owner)
+
+    def flush_collection(self, sig):
+        """
+        将某个collection的缓冲区写入数据库
+        """
+        lock = self._get_lock(sig)
+        try:
+            lock.acquire()
+            buf = self._buffers.get(sig)
+            if not buf or not buf['ops']:
+                return
+            ops = buf['ops']
+            buf['ops'] = []
+            buf['ts'] = None
+            self._execute(sig, buf['col'], ops)
+        finally:
+            lock.release()
+
+    def _execute(self, sig, col, ops):
+        from pymongo.errors import BulkWriteError, PyMongoError
+
+        stat = self.stats[sig]
+        bulk = col.initialize_unordered_bulk_op()
+        for spec, doc, upsert, owner, retries in ops:
+            view = bulk.find(spec)
+            if upsert:
+                view = view.upsert()
+            if any(key.startswith('$') for key in doc):
+                view.update_one(doc)
+            else:
+                view.replace_one(doc)
+
+        # 失败的操作在ops中的位置
+        failed_idx = set()
+        ts = time()
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            failed_idx = set(err['index'] for err in errors)
+            if not errors:
+                failed_idx = set(xrange(len(ops)))
+            self.logger.error('Bulk write to %s: %d of %d operations failed. First error: %s' % (
+                sig, len(failed_idx), len(ops), errors[0]['errmsg'] if errors else 'unknown'))
+        except PyMongoError as e:
+            failed_idx = set(xrange(len(ops)))
+            self.logger.error('Bulk write to %s failed: %s' % (sig, e), exc_info=True)
+        latency = time() - ts
+
+        failed = 0
+        for idx, op in enumerate(ops):
+            owner, retries = op[3], op[4]
+            if idx not in failed_idx:
+                self._settle(owner, True)
+            elif retries < self.max_retries:
+                # 在下一次flush时重试
+                stat['retried'] += 1
+                self._append(sig, op[:4] + (retries + 1,))
+            else:
+                failed += 1
+                self._settle(owner, False)
+
+        stat['flushes'] += 1
+        stat['docs'] += len(ops)
+        stat['failed'] += failed
+        stat['latency'] += latency
+        stat['max_latency'] = max(stat['max_latency'], latency)
+
+    def flush(self, force=True):
+        """
+        Flush the buffers.
+        :param force: 如果为False，只flush超过flush_interval的缓冲区
+        """
+        cur = time()
+        for sig, buf in self._buffers.items():
+            if not buf['ops']:
+                continue
+            if force or cur - buf['ts'] >= self.flush_interval:
+                self.flush_collection(sig)
+
+    def start(self):
+        """
+        启动后台的flush任务
+        """
+
+        def run():
+            while True:
+                gevent.sleep(1)
+                self.flush(force=False)
+
+        if not self._flusher:
+            self._flusher = gevent.spawn(run)
+
+    def close(self):
+        """
+        停止后台任务，并写入所有的缓冲数据（包括等待重试的操作）
+        """
+        if self._flusher:
+            gevent.kill(self._flusher)
+            self._flusher = None
+        while any(buf['ops'] for buf in self._buffers.values()):
+            self.flush(force=True)
+
+    def report(self):
+        """
+        Statistics for the heartbeat log
+        """
+        lines = []
+        for sig in sorted(self.stats.keys()):
+            stat = self.stats[sig]
+            pending = len(self._buffers[sig]['ops']) if sig in self._buffers else 0
+            avg = stat['latency'] / stat['flushes'] * 1000 if stat['flushes'] else 0
+            lines.append('Bulk writer [%s]: %d flushes, %d docs, %d retried, %d failed, %d pending, '
+                         'latency avg %dms / max %dms' % (sig, stat['flushes'], stat['docs'], stat['retried'],
+                                                          stat['failed'], pending, int(avg),
+                                                          int(stat['max_latency'] * 1000)))
+        return lines
@@ -0,0 +1,299 @@
+# coding=utf-8
+import logging
+import os
+import struct
+import zlib
+from hashlib import md5
+from time import time
+
+from gevent.lock import BoundedSemaphore
+
+from utils import load_yaml
+
+__author__ = 'zephyre'
+
+# 压缩后的数据以magic开头。没有magic的数据，按照未压缩的旧数据处理
+ZLIB_MAGIC = '\x00DZ1'
+ZSTD_MAGIC = '\x00DS1'
+
+
+def compress(text, method='zlib', level=6):
+    """
+    压缩网页内容。text可以是unicode，也可以是str（按照utf-8处理）
+    """
+    data = text.encode('utf-8') if isinstance(text, unicode) else text
+    if method == 'zstd':
+        try:
+            import zstandard
+
+            return ZSTD_MAGIC + zstandard.ZstdCompressor(level=level).compress(data)
+        except ImportError:
+            pass
+    if method in ('zlib', 'zstd'):
+        return ZLIB_MAGIC + zlib.compress(data, level)
+    return data
+
+
+def decompress(data):
+    """
+    解压缩，返回unicode。兼容未压缩的旧数据
+    """
+    if data is None:
+        return None
+    if isinstance(data, unicode):
+        return data
+
+    data = str(data)
+    if data.startswith(ZLIB_MAGIC):
+        data = zlib.decompress(data[len(ZLIB_MAGIC):])
+    elif data.startswith(ZSTD_MAGIC):
+        import zstandard
+
+        data = zstandard.ZstdDecompressor().decompress(data[len(ZSTD_MAGIC):])
+    return data.decode('utf-8')
+
+
+class CacheBackend(object):
+    """
+    缓存的存储后端。value为压缩后的str，expire为过期时间（秒）
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, expire=None, extra=None):
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+
+class RedisBackend(CacheBackend):
+    def __init__(self, profile='engine', prefix=''):
+        from core import RedisClient
+
+        self.redis = RedisClient(profile)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.redis.get('%s%s' % (self.prefix, key))
+
+    def set(self, key, value, expire=None, extra=None):
+        self.redis.set('%s%s' % (self.prefix, key), value, expire)
+
+    def exists(self, key):
+        return self.redis.exists('%s%s' % (self.prefix, key))
+
+
+class MongoBackend(CacheBackend):
+    """
+    文档格式：{key: ..., body: ..., expireAt: ...}。extra中的字段（比如url）一并保存
+    """
+
+    def __init__(self, db, col_name, profile='mongo-raw', key_field='key', body_field='body'):
+        self.db = db
+        self.col_name = col_name
+        self.profile = profile
+        self.key_field = key_field
+        self.body_field = body_field
+
+    def _col(self):
+        from utils.database import get_mongodb
+
+        return get_mongodb(self.db, self.col_name, self.profile)
+
+    def get(self, key):
+        from datetime import datetime
+
+        ret = self._col().find_one({self.key_field: key}, {self.body_field: 1, 'expireAt': 1})
+        if not ret or ret.get(self.body_field) is None:
+            return None
+        if ret.get('expireAt') and ret['expireAt'] < datetime.utcnow():
+            return None
+        return ret[self.body_field]
+
+    def set(self, key, value, expire=None, extra=None):
+        from datetime import datetime, timedelta
+        from bson import Binary
+
+        doc = dict(extra or {})
+        doc[self.key_field] = key
+        doc[self.body_field] = Binary(value) if not isinstance(value, unicode) else value
+        if expire:
+            doc['expireAt'] = datetime.utcnow() + timedelta(seconds=expire)
+        self._col().update({self.key_field: key}, {'$set': doc}, upsert=True)
+
+    def exists(self, key):
+        return bool(self._col().find_one({self.key_field: key}, {'_id': 1}))
+
+
+class DiskBackend(CacheBackend):
+    """
+    本地磁盘缓存。每个key对应一个文件，文件头部为过期时间戳（0表示永不过期）
+    """
+
+    header = struct.Struct('<d')
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file_name(self, key):
+        sig = md5(str(key)).hexdigest()
+        return os.path.join(self.path, sig[:2], sig)
+
+    def get(self, key):
+        try:
+            with open(self._file_name(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        expire_ts, = self.header.unpack(data[:self.header.size])
+        if expire_ts and expire_ts < time():
+            return None
+        return data[self.header.size:]
+
+    def set(self, key, value, expire=None, extra=None):
+        fname = self._file_name(key)
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError:
+            pass
+
+        tmp_name = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            f.write(self.header.pack(time() + expire if expire else 0))
+            f.write(value)
+        os.rename(tmp_name, fname)
+
+
+class PageCache(object):
+    """
+    网页内容的缓存（fetch-through）。
+
+    fetch(key, retrieve_func)：如果缓存未命中（或者refresh=True），则调用retrieve_func获得内容并写入缓存。
+    同一个key同时只会有一个greenlet调用retrieve_func，其它greenlet等待并直接读取结果。
+    """
+
+    def __init__(self, name, backend, expire=None, compression='zlib'):
+        self.name = name
+        self.backend = backend
+        self.expire = expire
+        self.compression = compression
+
+        # key => [lock, 引用计数]
+        self._locks = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = decompress(self.backend.get(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, text, expire=None, **extra):
+        if text is None:
+            return
+        self.backend.set(key, compress(text, self.compression), expire or self.expire, extra)
+
+    def exists(self, key):
+        return self.backend.exists(key)
+
+    def fetch(self, key, retrieve_func, expire=None, refresh=False, validator=None, **extra):
+        """
+        获得缓存内容
+        :param retrieve_func: 缓存未命中时，通过这一函数来获得内容。返回None表示获取失败，不写入缓存
+        :param expire: 过期时间（秒），默认为cache的配置
+        :param refresh: 强制刷新缓存
+        :param validator: 只有validator(text)为True时，才写入缓存
+        :param extra: 额外保存的字段（仅MongoBackend）
+        """
+        if not refresh:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+        if key not in self._locks:
+            self._locks[key] = [BoundedSemaphore(1), 0]
+        entry = self._locks[key]
+        entry[1] += 1
+        try:
+            entry[0].acquire()
+            if not refresh:
+                # 等待期间，其它greenlet可能已经获取了同一个key
+                value = decompress(self.backend.get(key))
+                if value is not None:
+                    return value
+
+            value = retrieve_func()
+            if value is not None and (not validator or validator(value)):
+                self.set(key, value, expire, **extra)
+            return value
+        finally:
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+    def report(self):
+        return ['Page cache [%s]: %d hits, %d misses' % (self.name, self.hits, self.misses)]
+
+
+# 内置的缓存配置。可以在配置文件的page_cache.caches中覆盖
+default_caches = {
+    'mfw-sug': {'backend': 'mongo', 'db': 'raw_mfw', 'col': 'MfwSug'},
+    'mfw-poi': {'backend': 'mongo', 'db': 'raw_mfw', 'col': 'MfwPoiBody'},
+    'mfw-mdd': {'backend': 'mongo', 'db': 'raw_mfw', 'col': 'MfwMddBody'},
+    'baidu-sug': {'backend': 'mongo', 'db': 'raw_baidu', 'col': 'BaiduSug'},
+    'baidu-scene': {'backend': 'mongo', 'db': 'raw_baidu', 'col': 'SceneBody'},
+    'dianping-shop': {'backend': 'redis', 'prefix': 'dianping:shop_html_'},
+    'dianping-review': {'backend': 'redis', 'prefix': 'dianping:shop_review_'},
+    'qunar-comment-list': {'backend': 'redis', 'prefix': 'qunar:poi-comment:list:', 'expire': 3600 * 24},
+}
+
+page_caches = {}
+
+_page_caches_lock = BoundedSemaphore(1)
+
+
+def build_backend(name, conf, section):
+    backend = conf.get('backend', 'mongo')
+    if backend == 'mongo':
+        return MongoBackend(conf['db'], conf['col'], conf.get('profile', 'mongo-raw'))
+    elif backend == 'redis':
+        return RedisBackend(conf.get('profile', 'engine'), conf.get('prefix', '%s:' % name))
+    elif backend == 'disk':
+        import tempfile
+
+        root = section.get('path', os.path.join(tempfile.gettempdir(), 'dhaulagiri-cache'))
+        return DiskBackend(conf.get('path', os.path.join(root, name)))
+    else:
+        raise ValueError('Invalid cache backend: %s' % backend)
+
+
+def get_page_cache(name):
+    """
+    获得名为name的PageCache
+    """
+    if name not in page_caches:
+        try:
+            _page_caches_lock.acquire()
+            if name not in page_caches:
+                section = load_yaml().get('page_cache', {})
+                conf = dict(default_caches.get(name, {}))
+                conf.update((section.get('caches', {}) or {}).get(name, {}))
+                if not conf:
+                    raise ValueError('Invalid page cache: %s' % name)
+
+                page_caches[name] = PageCache(name, build_backend(name, conf, section), expire=conf.get('expire'),
+                                              compression=conf.get('compression',
+                                                                   section.get('compression', 'zlib')))
+                logging.getLogger('page_cache').debug('Page cache created: %s' % name)
+        finally:
+            _page_caches_lock.release()
+
+    return page_caches[name]
@@ -0,0 +1,160 @@
+# coding=utf-8
+import os
+from collections import deque
+
+import gevent
+
+__author__ = 'zephyre'
+
+
+class Checkpoint(object):
+    """
+    记录processor遍历cursor的进度，用于中断后恢复。
+
+    任务按照cursor的排序依次添加（dispatch），但是完成（complete）的顺序是任意的。
+    Checkpoint记录的是low watermark：所有不大于该值的任务都已经完成。恢复时，从该值之后开始（{key: {'$gt': value}}）。
+
+    失败的任务（fail）单独记录，low watermark可以越过它们；恢复时，这些key会被重新处理（参见BaseProcessor.resume_query）。
+    失败的key超过max_failed个之后，不再单独记录，low watermark停在第一个未记录的失败key之前。
+    """
+
+    def __init__(self, name, backend='redis', profile='engine', path=None, interval=5, max_failed=10000):
+        self.name = name
+        self.backend = backend
+        self.profile = profile
+        self.path = path
+        self.interval = interval
+        self.max_failed = max_failed
+
+        # 已经添加、但是还没有越过low watermark的key（按照添加的顺序）
+        self._dispatched = deque()
+        # key => 已经完成的次数（同一个key可能被添加多次）
+        self._completed = {}
+        # 失败的key，以及上次保存的、尚未重新处理的失败key
+        self.failed = set()
+        self.failed_cnt = 0
+        self._dirty = False
+
+        self.watermark = None
+        self._saved = None
+
+        self._redis = None
+        self._greenlet = None
+
+    @classmethod
+    def from_settings(cls, name, settings):
+        import tempfile
+
+        section = settings.get('checkpoint', {})
+        path = section.get('path', os.path.join(tempfile.gettempdir(), 'dhaulagiri-checkpoint'))
+        return cls(name, backend=section.get('backend', 'redis'), profile=section.get('profile', 'engine'),
+                   path=path, interval=section.get('interval', 5), max_failed=section.get('max_failed', 10000))
+
+    def _redis_key(self):
+        return 'dhaulagiri:checkpoint:%s' % self.name
+
+    def _file_name(self):
+        return os.path.join(self.path, '%s.checkpoint' % self.name)
+
+    def _get_redis(self):
+        if not self._redis:
+            from core import RedisClient
+
+            self._redis = RedisClient(self.profile)
+        return self._redis
+
+    def dispatch(self, key):
+        self._dispatched.append(key)
+
+    def complete(self, key):
+        if key in self.failed:
+            # 上次失败的key，这次成功了
+            self.failed.remove(key)
+            self._dirty = True
+        self._advance(key)
+
+    def fail(self, key):
+        self.failed_cnt += 1
+        if key in self.failed:
+            self._advance(key)
+        elif len(self.failed) < self.max_failed:
+            self.failed.add(key)
+            self._dirty = True
+            self._advance(key)
+
+    def _advance(self, key):
+        self._completed[key] = self._completed.get(key, 0) + 1
+
+        # 推进low watermark
+        while self._dispatched and self._completed.get(self._dispatched[0]):
+            head = self._dispatched.popleft()
+            self._completed[head] -= 1
+            if not self._completed[head]:
+                self._completed.pop(head)
+            # 恢复时，重新处理的失败key小于上次保存的值，low watermark不能后退
+            if self.watermark is None or head > self.watermark:
+                self.watermark = head
+
+    def load(self):
+        """
+        读取上次保存的恢复点。不存在时返回None。上次失败的key保存在failed中
+        """
+        from bson import json_util
+
+        if self.backend == 'redis':
+            data = self._get_redis().get(self._redis_key())
+        else:
+            try:
+                with open(self._file_name()) as f:
+                    data = f.read()
+            except IOError:
+                data = None
+
+        if not data:
+            return None
+        data = json_util.loads(data)
+        self.failed = set(data.get('failed', []))
+        self.watermark = self._saved = data['value']
+        return data['value']
+
+    def save(self):
+        from bson import json_util
+
+        if self.watermark is None or (self.watermark == self._saved and not self._dirty):
+            return
+
+        data = json_util.dumps({'value': self.watermark, 'failed': list(self.failed)})
+        if self.backend == 'redis':
+            self._get_redis().set(self._redis_key(), data)
+        else:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+            tmp_name = '%s.tmp' % self._file_name()
+            with open(tmp_name, 'w') as f:
+                f.write(data)
+            os.rename(tmp_name, self._file_name())
+
+        self._saved = self.watermark
+        self._dirty = False
+
+    def start(self):
+        def func():
+            while True:
+                gevent.sleep(self.interval)
+                self.save()
+
+        self._greenlet = gevent.spawn(func)
+
+    def close(self):
+        if self._greenlet:
+            gevent.kill(self._greenlet)
+            self._greenlet = None
+        self.save()
+
+    def report(self):
+        if self.watermark is None and not self._dispatched:
+            return []
+        return ['Checkpoint [%s]: %s (%d pending, %d failed, %d to retry)' % (
+            self.name, self.watermark, len(self._dispatched), self.failed_cnt, len(self.failed))]
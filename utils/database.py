@@ -103,7 +103,17 @@ def get_mongodb(db_name, col_name, profile):
     return client[db_name][col_name]
 
 
-def get_mysql_db(db_name, user=None, passwd=None, profile=None, host='localhost', port=3306):
+def reset_mongodb_clients():
+    """
+    关闭并清除缓存的MongoDB连接（比如在fork之前）
+    """
+    with get_mongodb.lock:
+        for client in get_mongodb.cached_clients.values():
+            client.close()
+        get_mongodb.cached_clients.clear()
+
+
+def get_mysql_db(db_name, user=None, passwd=None, profile=None, host='localhost', port=3306, cursorclass=None):
     """
     建立MySQL连接
     :param db_name:
@@ -112,6 +122,7 @@ def get_mysql_db(db_name, user=None, passwd=None, profile=None, host='localhost'
     :param profile:
     :param host:
     :param port:
+    :param cursorclass: 默认为DictCursor
     :return:
     """
 
@@ -131,5 +142,152 @@ def get_mysql_db(db_name, user=None, passwd=None, profile=None, host='localhost'
     from MySQLdb.cursors import DictCursor
     import MySQLdb
 
-    return MySQLdb.connect(host=host, port=port, user=user, passwd=passwd, db=db_name, cursorclass=DictCursor,
-                           charset='utf8')
\ No newline at end of file
+    return MySQLdb.connect(host=host, port=port, user=user, passwd=passwd, db=db_name,
+                           cursorclass=cursorclass or DictCursor, charset='utf8')
+
+
+def iter_mysql_table(db_name, table, profile=None, key='id', where=None, order=None, skip=0, limit=None,
+                     batch_size=1000):
+    """
+    流式读取MySQL表中的记录，避免LIMIT offset, n带来的重复扫描。
+
+    如果没有指定order，则按照主键key进行分页（keyset pagination）：WHERE key > 上一页的最大值 ORDER BY key LIMIT n。
+    如果指定了order，则无法按照主键分页，改为使用服务器端游标（SSDictCursor）一次性读取。
+
+    两种方式都使用单独的连接，不影响调用者在处理记录时使用其它连接进行查询。
+
+    :param where: 额外的WHERE条件（SQL片段）
+    :param order: ORDER BY子句（SQL片段）
+    :param skip: 跳过的记录数
+    :param limit: 最多返回的记录数
+    """
+    from MySQLdb.cursors import SSDictCursor
+
+    where_clause = '(%s)' % where if where else '1=1'
+
+    if order:
+        tail = ' LIMIT %d, %d' % (skip, limit) if limit else (' LIMIT %d, 18446744073709551615' % skip if skip else '')
+        conn = get_mysql_db(db_name, profile=profile, cursorclass=SSDictCursor)
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM %s WHERE %s ORDER BY %s%s' % (table, where_clause, order, tail))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            cur.close()
+        finally:
+            conn.close()
+        return
+
+    conn = get_mysql_db(db_name, profile=profile)
+    try:
+        cur = conn.cursor()
+        last_key = None
+        if skip:
+            # 只在开始的时候扫描一次，找到起始位置
+            cur.execute('SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT %d, 1' % (key, table, where_clause, key,
+                                                                              skip - 1))
+            row = cur.fetchone()
+            if not row:
+                return
+            last_key = row[key]
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = min(batch_size, remaining) if remaining is not None else batch_size
+            cond = where_clause
+            args = ()
+            if last_key is not None:
+                cond = '%s AND %s > %%s' % (where_clause, key)
+                args = (last_key,)
+            cur.execute('SELECT * FROM %s WHERE %s ORDER BY %s LIMIT %d' % (table, cond, key, size), args)
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+            last_key = rows[-1][key]
+            if remaining is not None:
+                remaining -= len(rows)
+            if len(rows) < size:
+                break
+    finally:
+        conn.close()
+
+class CursorSource(object):
+    """
+    流式读取MongoDB collection中的记录，按页返回，内存占用与集合大小无关。
+
+    如果没有指定sort，则按照key（必须唯一，默认为_id）进行分页（keyset pagination）：
+    find({'$and': [query, {key: {'$gt': 上一页的最大值}}]}).sort(key).limit(page_size)。
+    每一页都是一次独立的查询，因此在遍历的过程中修改满足query条件的字段（比如标记为已处理），不会导致遗漏或者重复。
+
+    如果指定了sort，则无法按照key分页，改为使用单个服务器端游标，以page_size作为batch_size分批读取。
+
+    :param projection: 需要返回的字段。key会被自动加入
+    :param sort: [(field, direction), ...]
+    :param limit: 最多返回的记录数
+    """
+
+    def __init__(self, col, query=None, projection=None, key='_id', sort=None, page_size=1000, limit=None):
+        self.col = col
+        self.query = query or {}
+        self.key = key
+        self.sort = sort
+        self.page_size = page_size
+        self.limit = limit
+
+        if projection is not None and not sort:
+            projection = dict(projection)
+            projection[key] = 1
+        self.projection = projection
+
+    def _sorted_pages(self):
+        from itertools import islice
+
+        cursor = self.col.find(self.query, self.projection).sort(self.sort).batch_size(self.page_size)
+        if self.limit:
+            cursor = cursor.limit(self.limit)
+        while True:
+            page = list(islice(cursor, self.page_size))
+            if not page:
+                break
+            yield page
+
+    def _keyset_pages(self):
+        import pymongo
+
+        last_key = None
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = min(self.page_size, remaining) if remaining is not None else self.page_size
+            query = self.query
+            if last_key is not None:
+                cond = {self.key: {'$gt': last_key}}
+                query = {'$and': [self.query, cond]} if self.query else cond
+
+            page = list(self.col.find(query, self.projection).sort(self.key, pymongo.ASCENDING).limit(size))
+            if not page:
+                break
+            yield page
+
+            last_key = page[-1][self.key]
+            if remaining is not None:
+                remaining -= len(page)
+            if len(page) < size:
+                break
+
+    def pages(self):
+        """
+        逐页返回记录，每一页是一个list
+        """
+        return self._sorted_pages() if self.sort else self._keyset_pages()
+
+    def __iter__(self):
+        for page in self.pages():
+            for entry in page:
+                yield entry
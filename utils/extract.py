@@ -0,0 +1,133 @@
+# coding=utf-8
+import re
+
+from utils.html import compile_xpath
+
+__author__ = 'zephyre'
+
+
+def node_text(node):
+    """
+    节点的纯文本内容
+    """
+    return ''.join(node.itertext())
+
+
+class Field(object):
+    """
+    声明式的字段定义：
+    * selector: XPath表达式（预编译）
+    * regex: 对选出的文本进行正则匹配，取第group组。不匹配的值被丢弃
+    * coerce: 类型转换函数（比如int, float）。返回None，或者抛出ValueError/TypeError的值被丢弃
+    * many: 如果为True，返回所有的值组成的列表；否则返回第一个有效的值
+    * reduce: 在many=True时，对结果列表进行处理（比如去重、拼接）
+    * strip: 是否对文本进行strip。strip之后为空的字符串被丢弃
+    * schema: 如果指定，则对选出的每个节点应用这个schema，得到嵌套的记录
+
+    如果选出的是节点（而不是文本或者属性），并且没有指定schema，则默认取节点的纯文本。
+    """
+
+    def __init__(self, name, selector, regex=None, group=1, coerce=None, many=False, reduce=None, strip=True,
+                 default=None, schema=None, text=node_text):
+        self.name = name
+        self.selector = compile_xpath(selector)
+        self.regex = re.compile(regex) if isinstance(regex, basestring) else regex
+        self.group = group
+        self.coerce = coerce
+        self.many = many
+        self.reduce = reduce
+        self.strip = strip
+        self.default = default
+        self.schema = schema
+        self.text = text
+
+    def convert(self, value):
+        """
+        对单个值进行后处理。返回None表示丢弃
+        """
+        if self.schema is not None:
+            return self.schema.extract(value)
+
+        if not isinstance(value, basestring):
+            if self.text is None:
+                # 由coerce直接处理节点
+                return self._coerce(value)
+            value = self.text(value)
+
+        if self.strip:
+            value = value.strip()
+            if not value:
+                return None
+
+        if self.regex is not None:
+            match = self.regex.search(value)
+            if not match:
+                return None
+            value = match.group(self.group)
+
+        return self._coerce(value)
+
+    def _coerce(self, value):
+        if self.coerce is None:
+            return value
+        try:
+            return self.coerce(value)
+        except (ValueError, TypeError):
+            return None
+
+    def evaluate(self, node):
+        results = self.selector(node)
+        if not isinstance(results, list):
+            # 比如count()，string()等XPath函数
+            results = [results]
+
+        if self.many:
+            values = filter(lambda v: v is not None, (self.convert(v) for v in results))
+            if self.reduce is not None:
+                return self.reduce(values)
+            return values if values else self.default
+
+        for v in results:
+            v = self.convert(v)
+            if v is not None:
+                return v
+        return self.default
+
+
+class Schema(object):
+    """
+    一组字段定义，用于从某个节点中提取一条记录。
+
+    如果指定了scope，则先通过scope选出子树，所有字段都在这棵子树上求值（使用相对路径，避免每个字段都遍历整个文档）。
+    fields中也可以包含Schema，其结果会被合并到当前的记录中。
+
+    :param skip_none: 如果为True，结果中不包含值为None的字段
+    """
+
+    def __init__(self, fields, scope=None, skip_none=False):
+        self.fields = fields
+        self.scope = compile_xpath(scope) if scope else None
+        self.skip_none = skip_none
+
+    def extract(self, node):
+        if self.scope is not None:
+            scoped = self.scope(node)
+            node = scoped[0] if scoped else None
+
+        record = {}
+        for field in self.fields:
+            if isinstance(field, Schema):
+                record.update(field.extract(node))
+                continue
+
+            value = field.evaluate(node) if node is not None else field.default
+            if value is None and self.skip_none:
+                continue
+            record[field.name] = value
+        return record
+
+    def extract_all(self, node, selector):
+        """
+        对selector选出的每一个节点，提取一条记录
+        """
+        return [self.extract(v) for v in compile_xpath(selector)(node)]
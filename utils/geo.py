@@ -0,0 +1,421 @@
+# coding=utf-8
+from bisect import bisect_left
+from math import pi, sqrt, sin, cos, atan2
+from time import time
+
+from gevent.lock import BoundedSemaphore
+
+from utils import haversine, load_yaml
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__author__ = 'zephyre'
+
+# 和utils.haversine保持一致（km）
+EARTH_RADIUS = 6367.0
+
+
+def haversine_matrix(lngs1, lats1, lngs2, lats2):
+    """
+    计算两组坐标之间的距离矩阵（km），结果的形状为(len(lngs1), len(lngs2))。需要numpy
+    """
+    lng1 = np.radians(np.asarray(lngs1, dtype=float))[:, np.newaxis]
+    lat1 = np.radians(np.asarray(lats1, dtype=float))[:, np.newaxis]
+    lng2 = np.radians(np.asarray(lngs2, dtype=float))[np.newaxis, :]
+    lat2 = np.radians(np.asarray(lats2, dtype=float))[np.newaxis, :]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def haversine_many(lng, lat, lngs, lats):
+    """
+    计算一个点到一组点的距离（km）。如果没有安装numpy，则逐个计算
+    """
+    if np is None:
+        return [haversine(lng, lat, x, y) for x, y in zip(lngs, lats)]
+    if not len(lngs):
+        return np.zeros(0)
+    return haversine_matrix([lng], [lat], lngs, lats)[0]
+
+
+# 百度墨卡托坐标（BD-09 MC）转百度经纬度（BD-09）的分段多项式参数
+MC_BAND = (12890594.86, 8362377.87, 5591021, 3481989.83, 1678043.12, 0)
+
+MC2LL = (
+    (1.410526172116255e-8, 0.00000898305509648872, -1.9939833816331, 200.9824383106796, -187.2403703815547,
+     91.6087516669843, -23.38765649603339, 2.57121317296198, -0.03801003308653, 17337981.2),
+    (-7.435856389565537e-9, 0.000008983055097726239, -0.78625201886289, 96.32687599759846, -1.85204757529826,
+     -59.36935905485877, 47.40033549296737, -16.50741931063887, 2.28786674699375, 10260144.86),
+    (-3.030883460898826e-8, 0.00000898305509983578, 0.30071316287616, 59.74293618442277, 7.357984074871,
+     -25.38371002664745, 13.45380521110908, -3.29883767235584, 0.32710905363475, 6856817.37),
+    (-1.981981304930552e-8, 0.000008983055099779535, 0.03278182852591, 40.31678527705744, 0.65659298677277,
+     -4.44255534477492, 0.85341911805263, 0.12923347998204, -0.04625736007561, 4482777.06),
+    (3.09191371068437e-9, 0.000008983055096812155, 0.00006995724062, 23.10934304144901, -0.00023663490511,
+     -0.6321817810242, -0.00663494467273, 0.03430082397953, -0.00466043876332, 2555164.4),
+    (2.890871144776878e-9, 0.000008983055095805407, -3.068298e-8, 7.47137025468032, -0.00000353937994,
+     -0.02145144861037, -0.00001234426596, 0.00010322952773, -0.00000323890364, 826088.5))
+
+# BD-09和GCJ-02之间的偏移参数
+BD_X_PI = pi * 3000.0 / 180.0
+
+# GCJ-02所采用的克拉索夫斯基椭球参数
+KRASOVSKY_A = 6378245.0
+KRASOVSKY_EE = 0.00669342162296594323
+
+
+def _mc_coeffs(my):
+    for band, coeffs in zip(MC_BAND, MC2LL):
+        if abs(my) >= band:
+            return coeffs
+    return MC2LL[-1]
+
+
+def bd09mc_to_bd09(mx, my):
+    """
+    百度墨卡托坐标转百度经纬度坐标（相当于geoconv接口的from=6, to=5）
+    :return: (lng, lat)
+    """
+    c = _mc_coeffs(my)
+    lng = c[0] + c[1] * abs(mx)
+    t = abs(my) / c[9]
+    lat = c[2] + c[3] * t + c[4] * t ** 2 + c[5] * t ** 3 + c[6] * t ** 4 + c[7] * t ** 5 + c[8] * t ** 6
+    return (lng if mx >= 0 else -lng), (lat if my >= 0 else -lat)
+
+
+def bd09_to_gcj02(lng, lat):
+    """
+    百度经纬度坐标转火星坐标（GCJ-02）
+    """
+    x = lng - 0.0065
+    y = lat - 0.006
+    z = sqrt(x * x + y * y) - 0.00002 * sin(y * BD_X_PI)
+    theta = atan2(y, x) - 0.000003 * cos(x * BD_X_PI)
+    return z * cos(theta), z * sin(theta)
+
+
+def out_of_china(lng, lat):
+    return not (72.004 <= lng <= 137.8347 and 0.8293 <= lat <= 55.8271)
+
+
+def _gcj02_delta(lng, lat, m):
+    """
+    GCJ-02相对于WGS-84的偏移量。m为math或者numpy
+    """
+    x = lng - 105.0
+    y = lat - 35.0
+    common = (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+
+    dlat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * m.sqrt(abs(x)) + common
+    dlat += (20.0 * m.sin(y * pi) + 40.0 * m.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    dlat += (160.0 * m.sin(y / 12.0 * pi) + 320 * m.sin(y * pi / 30.0)) * 2.0 / 3.0
+
+    dlng = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * m.sqrt(abs(x)) + common
+    dlng += (20.0 * m.sin(x * pi) + 40.0 * m.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    dlng += (150.0 * m.sin(x / 12.0 * pi) + 300.0 * m.sin(x / 30.0 * pi)) * 2.0 / 3.0
+
+    radlat = lat / 180.0 * pi
+    magic = 1 - KRASOVSKY_EE * m.sin(radlat) ** 2
+    sqrtmagic = m.sqrt(magic)
+    dlat = (dlat * 180.0) / ((KRASOVSKY_A * (1 - KRASOVSKY_EE)) / (magic * sqrtmagic) * pi)
+    dlng = (dlng * 180.0) / (KRASOVSKY_A / sqrtmagic * m.cos(radlat) * pi)
+    return dlng, dlat
+
+
+def gcj02_to_wgs84(lng, lat):
+    """
+    火星坐标转WGS-84坐标（近似逆变换，误差在米级）。中国境外的坐标不做处理
+    """
+    import math
+
+    if out_of_china(lng, lat):
+        return lng, lat
+    dlng, dlat = _gcj02_delta(lng, lat, math)
+    return lng - dlng, lat - dlat
+
+
+def bd09mc_to_wgs84(mx, my):
+    """
+    百度墨卡托坐标转WGS-84坐标：BD-09 MC -> BD-09 -> GCJ-02 -> WGS-84
+    """
+    return gcj02_to_wgs84(*bd09_to_gcj02(*bd09mc_to_bd09(mx, my)))
+
+
+def bd09mc_to_bd09_many(mxs, mys):
+    """
+    bd09mc_to_bd09的向量化版本
+    :return: (lngs, lats)。如果安装了numpy，返回numpy数组
+    """
+    if np is None:
+        result = [bd09mc_to_bd09(x, y) for x, y in zip(mxs, mys)]
+        return [v[0] for v in result], [v[1] for v in result]
+
+    mx = np.asarray(mxs, dtype=float)
+    my = np.asarray(mys, dtype=float)
+    ay = np.abs(my)
+
+    # 为每个点选择对应的分段参数
+    band = np.full(my.shape, len(MC_BAND) - 1, dtype=int)
+    for idx in xrange(len(MC_BAND) - 1, -1, -1):
+        band[ay >= MC_BAND[idx]] = idx
+    c = np.asarray(MC2LL)[band].T
+
+    lng = c[0] + c[1] * np.abs(mx)
+    t = ay / c[9]
+    lat = c[2] + c[3] * t + c[4] * t ** 2 + c[5] * t ** 3 + c[6] * t ** 4 + c[7] * t ** 5 + c[8] * t ** 6
+    return np.where(mx < 0, -lng, lng), np.where(my < 0, -lat, lat)
+
+
+def bd09_to_gcj02_many(lngs, lats):
+    if np is None:
+        result = [bd09_to_gcj02(x, y) for x, y in zip(lngs, lats)]
+        return [v[0] for v in result], [v[1] for v in result]
+
+    x = np.asarray(lngs, dtype=float) - 0.0065
+    y = np.asarray(lats, dtype=float) - 0.006
+    z = np.sqrt(x * x + y * y) - 0.00002 * np.sin(y * BD_X_PI)
+    theta = np.arctan2(y, x) - 0.000003 * np.cos(x * BD_X_PI)
+    return z * np.cos(theta), z * np.sin(theta)
+
+
+def gcj02_to_wgs84_many(lngs, lats):
+    if np is None:
+        result = [gcj02_to_wgs84(x, y) for x, y in zip(lngs, lats)]
+        return [v[0] for v in result], [v[1] for v in result]
+
+    lng = np.asarray(lngs, dtype=float)
+    lat = np.asarray(lats, dtype=float)
+    dlng, dlat = _gcj02_delta(lng, lat, np)
+    inside = (lng >= 72.004) & (lng <= 137.8347) & (lat >= 0.8293) & (lat <= 55.8271)
+    return np.where(inside, lng - dlng, lng), np.where(inside, lat - dlat, lat)
+
+
+def bd09mc_to_wgs84_many(mxs, mys):
+    """
+    bd09mc_to_wgs84的向量化版本
+    """
+    return gcj02_to_wgs84_many(*bd09_to_gcj02_many(*bd09mc_to_bd09_many(mxs, mys)))
+
+
+class GeoIndex(object):
+    """
+    一组坐标点的最近邻索引，支持k近邻查询和半径查询。
+
+    如果安装了scikit-learn，则使用haversine度量的BallTree；否则使用numpy（或者纯Python）暴力计算。
+    点数少于min_tree_size时，建树的开销比暴力计算更大，也使用暴力计算。
+    """
+
+    min_tree_size = 64
+
+    def __init__(self, lngs, lats):
+        self.lngs = list(lngs)
+        self.lats = list(lats)
+        self._tree = None
+
+        if len(self.lngs) < self.min_tree_size:
+            return
+        try:
+            from sklearn.neighbors import BallTree
+
+            self._tree = BallTree(np.radians(np.column_stack([self.lats, self.lngs])), metric='haversine')
+        except ImportError:
+            pass
+
+    def __len__(self):
+        return len(self.lngs)
+
+    def query(self, lng, lat, k=1):
+        """
+        k近邻查询
+        :return: [(下标, 距离（km）), ...]，按照距离排序
+        """
+        k = min(k, len(self))
+        if not k:
+            return []
+
+        if self._tree is not None:
+            dist, idx = self._tree.query(np.radians([[lat, lng]]), k=k)
+            return [(int(i), float(d) * EARTH_RADIUS) for i, d in zip(idx[0], dist[0])]
+
+        dists = haversine_many(lng, lat, self.lngs, self.lats)
+        return sorted(enumerate(float(d) for d in dists), key=lambda v: v[1])[:k]
+
+    def query_radius(self, lng, lat, radius):
+        """
+        半径查询
+        :param radius: 半径（km）
+        :return: [(下标, 距离（km）), ...]，按照距离排序
+        """
+        if not len(self):
+            return []
+
+        if self._tree is not None:
+            idx, dist = self._tree.query_radius(np.radians([[lat, lng]]), r=radius / EARTH_RADIUS,
+                                                return_distance=True, sort_results=True)
+            return [(int(i), float(d) * EARTH_RADIUS) for i, d in zip(idx[0], dist[0])]
+
+        dists = haversine_many(lng, lat, self.lngs, self.lats)
+        return sorted(((i, float(d)) for i, d in enumerate(dists) if d <= radius), key=lambda v: v[1])
+
+
+class GeoResolver(object):
+    """
+    将geo.Locality和geo.Country加载到内存中，在本地完成以下查询：
+    * 别名查询（相当于{'alias': name}）以及别名前缀查询（相当于{'alias': re.compile('^name')}）
+    * 根据来源id查询（相当于{'source.mafengwo.id': id}）
+    * 指定半径内的最近目的地（相当于$near + $maxDistance）
+
+    数据每隔ttl秒重新加载一次。结果是共享的dict，调用者不应该修改。
+    """
+
+    # 加载的字段
+    fields = ('_id', 'zhName', 'enName', 'alias', 'location', 'source', 'code', 'country')
+
+    __instances = {}
+
+    __instances_lock = BoundedSemaphore(1)
+
+    @classmethod
+    def get_instance(cls, profile='mongo'):
+        if profile not in cls.__instances:
+            try:
+                cls.__instances_lock.acquire()
+                if profile not in cls.__instances:
+                    ttl = load_yaml().get('geo_resolver', {}).get('ttl', 3600)
+                    cls.__instances[profile] = cls(profile, ttl=ttl)
+            finally:
+                cls.__instances_lock.release()
+        return cls.__instances[profile]
+
+    def __init__(self, profile='mongo', ttl=3600):
+        self.profile = profile
+        self.ttl = ttl
+        self.load_ts = None
+        self._lock = BoundedSemaphore(1)
+
+        # kind => 数据。kind为'locality'或者'country'
+        self._alias = {}
+        self._alias_sorted = {}
+        self._source = {}
+        # kind => (有坐标的文档, GeoIndex)
+        self._located = {}
+
+    @staticmethod
+    def _get_coords(doc):
+        try:
+            lng, lat = doc['location']['coordinates']
+            return float(lng), float(lat)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _load_kind(self, col):
+        import pymongo
+
+        alias_map = {}
+        source_map = {}
+        located = []
+
+        cursor = col.find({}, dict((f, 1) for f in self.fields)).sort('_id', pymongo.ASCENDING)
+        for doc in cursor:
+            for a in doc.get('alias') or []:
+                alias_map.setdefault(a, []).append(doc)
+
+            for src_name, src in (doc.get('source') or {}).items():
+                if isinstance(src, dict) and 'id' in src:
+                    source_map.setdefault((src_name, src['id']), doc)
+
+            coords = self._get_coords(doc)
+            if coords:
+                located.append((doc, coords))
+
+        return alias_map, sorted(alias_map.keys()), source_map, self._build_index(located)
+
+    @staticmethod
+    def _build_index(located):
+        """
+        :param located: [(doc, (lng, lat)), ...]
+        :return: ([doc, ...], GeoIndex)
+        """
+        return [v[0] for v in located], GeoIndex([v[1][0] for v in located], [v[1][1] for v in located])
+
+    def load(self):
+        from utils.database import get_mongodb
+
+        for kind, col_name in (('locality', 'Locality'), ('country', 'Country')):
+            alias_map, alias_sorted, source_map, located = self._load_kind(get_mongodb('geo', col_name, self.profile))
+            self._alias[kind] = alias_map
+            self._alias_sorted[kind] = alias_sorted
+            self._source[kind] = source_map
+            self._located[kind] = located
+
+        self.load_ts = time()
+        return self
+
+    def _check(self):
+        if self.load_ts is None or (self.ttl and time() - self.load_ts > self.ttl):
+            try:
+                self._lock.acquire()
+                if self.load_ts is None or (self.ttl and time() - self.load_ts > self.ttl):
+                    self.load()
+            finally:
+                self._lock.release()
+
+    @staticmethod
+    def project(doc, fields=('_id', 'zhName', 'enName')):
+        """
+        返回doc的副本，只包含指定的字段（相当于find_one的projection）
+        """
+        if doc is None:
+            return None
+        return dict((k, doc[k]) for k in fields if k in doc)
+
+    def by_alias(self, alias, kind='locality'):
+        """
+        别名完全匹配，按照_id排序
+        """
+        self._check()
+        return self._alias[kind].get(alias, [])
+
+    def by_alias_prefix(self, prefix, kind='locality'):
+        """
+        别名前缀匹配，按照_id排序
+        """
+        self._check()
+        alias_sorted = self._alias_sorted[kind]
+        result = {}
+        idx = bisect_left(alias_sorted, prefix)
+        while idx < len(alias_sorted) and alias_sorted[idx].startswith(prefix):
+            for doc in self._alias[kind][alias_sorted[idx]]:
+                result[doc['_id']] = doc
+            idx += 1
+        return [result[k] for k in sorted(result.keys())]
+
+    def by_source(self, source, source_id, kind='locality'):
+        """
+        根据来源id查找。比如：by_source('mafengwo', 10065)
+        """
+        self._check()
+        return self._source[kind].get((source, source_id))
+
+    def nearest(self, lng, lat, max_distance, alias=None, kind='locality'):
+        """
+        查找max_distance（米）范围内最近的目的地
+        :param alias: 如果指定，则只在别名匹配的目的地中查找
+        :return: (doc, 距离（米）)。如果没有找到，返回(None, None)
+        """
+        self._check()
+
+        if alias is not None:
+            located = [(doc, self._get_coords(doc)) for doc in self.by_alias(alias, kind)]
+            docs, index = self._build_index([(doc, coords) for doc, coords in located if coords])
+        else:
+            docs, index = self._located[kind]
+
+        for idx, dist in index.query(lng, lat):
+            dist *= 1000
+            if dist <= max_distance:
+                return docs[idx], dist
+        return None, None
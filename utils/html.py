@@ -1,8 +1,117 @@
 # coding=utf-8
+import threading
+
+from lxml import etree
 from lxml.html import HtmlElement
 
 __author__ = 'zephyre'
 
+# 在gevent monkey patch之后，threading.local即为greenlet-local：每个worker greenlet持有自己的parser
+_local = threading.local()
+
+# 表达式 => 预编译的etree.XPath对象
+_xpath_registry = {}
+
+
+def get_parser():
+    """
+    获得当前greenlet（线程）的HTMLParser。parser可以重复使用，但是不能在多个线程之间共享
+    """
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = etree.HTMLParser()
+        _local.parser = parser
+    return parser
+
+
+def parse_html(text):
+    """
+    解析HTML文档，返回根节点。相当于etree.fromstring(text, parser=etree.HTMLParser())，但是复用parser
+    """
+    return etree.fromstring(text, parser=get_parser())
+
+
+def compile_xpath(expr):
+    """
+    从注册表中获得预编译的XPath对象。第一次遇到的表达式会被编译并注册。
+
+    返回的字符串是普通的unicode（smart_strings=False），不持有对文档树的引用，可以被pickle（参见BaseProcessor.offload）
+    """
+    compiled = _xpath_registry.get(expr)
+    if compiled is None:
+        compiled = etree.XPath(expr, smart_strings=False)
+        _xpath_registry[expr] = compiled
+    return compiled
+
+
+def select(node, expr):
+    """
+    在node上执行XPath查询，相当于node.xpath(expr)，但是表达式只会被编译一次
+    """
+    return compile_xpath(expr)(node)
+
+
+def _release(elem):
+    """
+    释放已经处理过的节点，以及它之前的兄弟节点
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def iter_elements(text, matchers, chunk_size=16384):
+    """
+    流式解析HTML（基于HTMLPullParser），在节点闭合时逐个返回匹配的节点，而不是先建立完整的DOM树。
+
+    节点被调用者处理之后（即生成器恢复执行时），会连同它之前的兄弟节点一起被释放。因此：
+    * 调用者不应该保留节点的引用；
+    * 条件中不应该依赖前面的兄弟节点（比如preceding-sibling）。
+    没有匹配的节点不会被释放，所以嵌套在记录内部的同名节点不受影响。
+
+    :param matchers: [(name, tag, condition), ...]。condition为在节点上求值的XPath表达式（比如'self::li[@data-id]'），
+                     可以为None
+    :return: 生成(name, element)
+    """
+    tags = set(m[1] for m in matchers)
+    parser = etree.HTMLPullParser(events=('end',), tag=tags)
+
+    def drain():
+        for event, elem in parser.read_events():
+            for name, tag, condition in matchers:
+                if elem.tag == tag and (condition is None or select(elem, condition)):
+                    yield name, elem
+                    _release(elem)
+                    break
+
+    for offset in xrange(0, len(text), chunk_size):
+        parser.feed(text[offset:offset + chunk_size])
+        for v in drain():
+            yield v
+
+    parser.close()
+    for v in drain():
+        yield v
+
+
+def rewrite_html(text, tag, func, chunk_size=16384):
+    """
+    单次流式解析HTML，在tag节点开始（属性已经解析完毕）时调用func(element)对其进行修改
+    :return: 修改后的根节点
+    """
+    parser = etree.HTMLPullParser(events=('start',), tag=tag)
+    for offset in xrange(0, len(text), chunk_size):
+        parser.feed(text[offset:offset + chunk_size])
+        for event, elem in parser.read_events():
+            func(elem)
+
+    root = parser.close()
+    for event, elem in parser.read_events():
+        func(elem)
+    return root
+
 
 def parse_etree(node, rules):
     """
@@ -45,4 +154,4 @@ def parse_etree(node, rules):
 
         return node
 
-    return func(dom)
\ No newline at end of file
+    return func(dom)
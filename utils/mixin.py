@@ -4,8 +4,10 @@ import re
 from hashlib import md5
 
 from core import ProcessorEngine
-from utils import haversine
+from utils.geo import bd09mc_to_bd09, GeoIndex
+from utils.cache import get_page_cache
 from utils.database import get_mongodb
+from utils.html import parse_html, select
 
 
 __author__ = 'zephyre'
@@ -17,19 +19,13 @@ class BaiduSuggestion(object):
         self.bdurl = 'http://api.map.baidu.com/geoconv/v1/'
         self.bdak = '7P5mAce1fZubQOahgDTCAWHo'
 
-    def bd_mc_to_ll(self, lat, lng):
+    @staticmethod
+    def bd_mc_to_ll(mx, my):
         """
-        百度米制坐标转百度经纬度坐标
+        百度米制坐标转百度经纬度坐标。在本地完成转换，不再调用geoconv接口
+        :return: [lng, lat]
         """
-        mc = 6
-        ll = 5
-        querys = {'ak': self.bdak, 'from': mc, 'to': ll, 'coords': str(lat) + ',' + str(lng)}
-        res = self.request.get(self.bdurl, params=querys).json()
-        latlng = [0, 0]
-        if '0' == str(res['status']):
-            latlngs = res['result'][0]
-            latlng = [float(latlngs['x']), float(latlngs['y'])]
-        return latlng
+        return list(bd09mc_to_bd09(mx, my))
 
     def get_baidu_sug(self, name, location):
 
@@ -40,19 +36,14 @@ class BaiduSuggestion(object):
 
         key = quote(name.encode('utf-8'))
 
-        col = get_mongodb('raw_baidu', 'BaiduSug', 'mongo-raw')
-        ret = col.find_one({'key': key}, {'body': 1})
-        body = None
-        if ret:
-            body = ret['body']
-        else:
+        def retrieve():
             try:
                 response = ProcessorEngine.get_instance().request.get(url)
-                if response:
-                    body = response.text
-                    col.update({'key': key}, {'key': key, 'body': body, 'url': url}, upsert=True)
+                return response.text if response else None
             except IOError:
-                pass
+                return None
+
+        body = get_page_cache('baidu-sug').fetch(key, retrieve, url=url)
         if not body:
             return []
 
@@ -94,20 +85,14 @@ class MfwSuggestion(object):
         url = 'http://www.mafengwo.cn/group/ss.php?callback=j&key=%s' % quote(name.encode('utf-8'))
         key = md5(url).hexdigest()
 
-        col = get_mongodb('raw_mfw', 'MfwSug', 'mongo-raw')
-        ret = col.find_one({'key': key}, {'body': 1})
-        body = None
-        if ret:
-            body = ret['body']
-        else:
+        def retrieve():
             try:
                 response = ProcessorEngine.get_instance().request.get(url)
-                if response:
-                    body = response.text
-                    col.update({'key': key}, {'key': key, 'body': body, 'name': name, 'url': url}, upsert=True)
+                return response.text if response else None
             except IOError:
-                pass
+                return None
 
+        body = get_page_cache('mfw-sug').fetch(key, retrieve, name=name, url=url)
         if not body:
             return []
         rtext = unquote_plus(json.loads(body[2:-2])['data'].encode('utf-8')).decode('utf-8')
@@ -154,7 +139,7 @@ class MfwSuggestion(object):
             type_list = ['vs']
             col_list = [col_mfw_vs]
 
-        results = []
+        candidates = []
         coords = location['coordinates']
 
         for r in filter(lambda val: re.search(r'\|(mdd|scenic)\|', val), re.split(r'search://', rtext)):
@@ -179,10 +164,16 @@ class MfwSuggestion(object):
                     except (KeyError, ValueError, TypeError):
                         continue
 
-                    dist = haversine(lng, lat, coords[0], coords[1])
-                    if dist < 400:
-                        results.append({'id': rid, 'name': name, 'type': type_list[idx], 'lat': lat, 'lng': lng,
-                                        'dist': dist})
+                    candidates.append({'id': rid, 'name': name, 'type': type_list[idx], 'lat': lat, 'lng': lng})
+
+        # 一次性查询400km范围内的候选项，结果保持suggestion的顺序
+        index = GeoIndex([c['lng'] for c in candidates], [c['lat'] for c in candidates])
+        hits = dict(index.query_radius(coords[0], coords[1], 400))
+        results = []
+        for idx, c in enumerate(candidates):
+            if idx in hits:
+                c['dist'] = hits[idx]
+                results.append(c)
         return results
 
     def poi_info(self, poi_id):
@@ -193,20 +184,12 @@ class MfwSuggestion(object):
         :return:
         """
 
-        from lxml import etree
-
         try:
-            body = None
-            col = get_mongodb('raw_mfw', 'MfwPoiBody', 'mongo-raw')
-            ret = col.find_one({'key': poi_id}, {'body': 1})
-            if ret:
-                body = ret['body']
-            else:
-                url = 'http://www.mafengwo.cn/poi/%d.html' % poi_id
-                response = ProcessorEngine.get_instance().request.get(url)
-                if response:
-                    body = response.text
-                    col.update({'key': poi_id}, {'key': poi_id, 'body': body}, upsert=True)
+            def retrieve():
+                response = ProcessorEngine.get_instance().request.get('http://www.mafengwo.cn/poi/%d.html' % poi_id)
+                return response.text if response else None
+
+            body = get_page_cache('mfw-poi').fetch(poi_id, retrieve)
             if not body:
                 return
 
@@ -222,9 +205,9 @@ class MfwSuggestion(object):
             lat = loc_data['lat']
             lng = loc_data['lng']
 
-            tree = etree.fromstring(body, etree.HTMLParser())
-            title = unicode(tree.xpath('//div[@class="col-main"]//div[contains(@class,"title")]'
-                                       '/div[@class="t"]/h1/text()')[0])
+            tree = parse_html(body)
+            title = unicode(select(tree, '//div[@class="col-main"]//div[contains(@class,"title")]'
+                                         '/div[@class="t"]/h1/text()')[0])
             return {'lat': lat, 'lng': lng, 'title': title}
         except IOError:
             return
\ No newline at end of file
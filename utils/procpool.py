@@ -0,0 +1,221 @@
+# coding=utf-8
+import cPickle as pickle
+import os
+import struct
+
+__author__ = 'zephyre'
+
+
+class RemoteError(Exception):
+    """
+    子进程中执行任务时发生的异常（原始异常无法序列化时使用）
+    """
+    pass
+
+
+def _read_exactly(read, fd, size):
+    chunks = []
+    while size > 0:
+        data = read(fd, size)
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def _send(write, fd, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack('!Q', len(data)) + data
+    while data:
+        written = write(fd, data)
+        data = data[written:]
+
+
+def _recv(read, fd):
+    header = _read_exactly(read, fd, 8)
+    if header is None:
+        return None
+    body = _read_exactly(read, fd, struct.unpack('!Q', header)[0])
+    if body is None:
+        return None
+    return pickle.loads(body)
+
+
+def _worker_loop(req_fd, resp_fd):
+    """
+    子进程的主循环：读取任务，执行，返回(是否成功, 结果, 执行耗时)。父进程关闭管道时退出
+    """
+    import traceback
+    from time import time
+
+    while True:
+        msg = _recv(os.read, req_fd)
+        if msg is None:
+            break
+
+        func, args, kwargs = msg
+        ts = time()
+        try:
+            ret = (True, func(*args, **kwargs))
+        except Exception as e:
+            ret = (False, (e, traceback.format_exc()))
+        cost = time() - ts
+
+        try:
+            _send(os.write, resp_fd, ret + (cost,))
+        except (pickle.PicklingError, TypeError):
+            # 结果或者异常无法序列化
+            _send(os.write, resp_fd, (False, (RemoteError(repr(ret[1])), ''), cost))
+
+
+class _Worker(object):
+    def __init__(self, pid, req_fd, resp_fd):
+        self.pid = pid
+        self.req_fd = req_fd
+        self.resp_fd = resp_fd
+
+
+class ProcessPool(object):
+    """
+    和gevent协作的进程池，用于执行CPU密集型的任务（比如HTML解析），避免阻塞gevent的事件循环。
+
+    每个子进程通过一对管道和父进程通信。apply在等待空闲的子进程、以及等待结果的时候，只会阻塞当前的greenlet。
+    func及其参数、返回值需要可以被pickle（func必须是模块级别的函数）。
+
+    子进程在第一次调用apply时才会fork出来。
+
+    统计信息中，排队时间（等待空闲子进程）和执行时间（子进程中func的耗时）分开计算。
+    """
+
+    def __init__(self, processes=None):
+        from multiprocessing import cpu_count
+
+        self.processes = processes or cpu_count()
+        self._workers = []
+        self._idle = None
+
+        # 统计
+        self.completed = 0
+        self.failed = 0
+        self.queue_time = 0
+        self.exec_time = 0
+
+    def _spawn(self):
+        from gevent.os import make_nonblocking
+
+        req_r, req_w = os.pipe()
+        resp_r, resp_w = os.pipe()
+
+        pid = os.fork()
+        if not pid:
+            # 子进程。关闭从父进程继承的、属于其它子进程的管道，否则它们在父进程关闭管道后无法收到EOF
+            os.close(req_w)
+            os.close(resp_r)
+            for other in self._workers:
+                os.close(other.req_fd)
+                os.close(other.resp_fd)
+            exit_code = 0
+            try:
+                _worker_loop(req_r, resp_w)
+            except BaseException:
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        os.close(req_r)
+        os.close(resp_w)
+        make_nonblocking(req_w)
+        make_nonblocking(resp_r)
+        worker = _Worker(pid, req_w, resp_r)
+        self._workers.append(worker)
+        self._idle.put(worker)
+
+    def _start(self):
+        from gevent.queue import Queue
+
+        self._idle = Queue()
+        for idx in xrange(self.processes):
+            self._spawn()
+
+    def apply(self, func, *args, **kwargs):
+        """
+        在子进程中执行func(*args, **kwargs)，返回结果。子进程中的异常会在这里重新抛出
+        """
+        from time import time
+        from gevent.os import nb_read, nb_write
+
+        if self._idle is None:
+            self._start()
+
+        ts = time()
+        worker = self._idle.get()
+        self.queue_time += time() - ts
+        try:
+            _send(nb_write, worker.req_fd, (func, args, kwargs))
+            ret = _recv(nb_read, worker.resp_fd)
+        except BaseException:
+            # 通信中断（比如greenlet被kill），这个子进程的状态已经不可知，替换为新的子进程
+            self._replace(worker)
+            raise
+
+        if ret is None:
+            self.failed += 1
+            self._replace(worker)
+            raise RemoteError('Worker process %d exited unexpectedly' % worker.pid)
+
+        self._idle.put(worker)
+
+        success, result, cost = ret
+        self.exec_time += cost
+        if success:
+            self.completed += 1
+            return result
+
+        self.failed += 1
+        exc, tb = result
+        if tb and isinstance(exc, Exception) and not exc.args:
+            exc.args = (tb,)
+        raise exc
+
+    def _replace(self, worker):
+        self._discard(worker)
+        try:
+            os.kill(worker.pid, 9)
+            os.waitpid(worker.pid, 0)
+        except OSError:
+            pass
+        if self._idle is not None:
+            self._spawn()
+
+    def _discard(self, worker):
+        if worker in self._workers:
+            self._workers.remove(worker)
+        for fd in (worker.req_fd, worker.resp_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        关闭管道，等待所有的子进程退出
+        """
+        for worker in list(self._workers):
+            self._discard(worker)
+            try:
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+        self._idle = None
+
+    def report(self):
+        if self._idle is None:
+            return []
+        lines = ['Process pool: %d processes (%d idle), %d completed, %d failed' % (
+            len(self._workers), self._idle.qsize(), self.completed, self.failed)]
+        total = self.completed + self.failed
+        if total:
+            lines.append('Process pool: avg queue time %.1fms, avg execution time %.1fms' % (
+                self.queue_time / total * 1000, self.exec_time / total * 1000))
+        return lines
@@ -0,0 +1,137 @@
+# coding=utf-8
+from bisect import bisect_left, insort
+from time import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__author__ = 'zephyre'
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class PercentileIndex(object):
+    """
+    数值的排名索引：rank(x)返回小于x的数值个数，相当于count({field: {'$lt': x}})，但是在内存中通过二分查找完成。
+
+    主体数据保存在有序数组中（如果安装了numpy，则为numpy数组）；新增的数值先放入一个小的有序列表，超过merge_threshold后合并。
+    """
+
+    merge_threshold = 1024
+
+    def __init__(self, values=None):
+        self._main = self._sort(values or [])
+        self._delta = []
+
+    @staticmethod
+    def _sort(values):
+        if np is not None:
+            return np.sort(np.asarray(values, dtype=float))
+        return sorted(values)
+
+    def __len__(self):
+        return len(self._main) + len(self._delta)
+
+    def rank(self, x):
+        """
+        小于x的数值个数
+        """
+        if np is not None:
+            main_rank = int(np.searchsorted(self._main, x, side='left'))
+        else:
+            main_rank = bisect_left(self._main, x)
+        return main_rank + bisect_left(self._delta, x)
+
+    def percentile(self, x, total=None):
+        """
+        x所处的百分位（0~1）
+        :param total: 分母。默认为索引中数值的个数
+        """
+        total = total if total is not None else len(self)
+        return self.rank(x) / float(total) if total else 0.0
+
+    def add(self, value):
+        if not is_number(value):
+            return
+        insort(self._delta, value)
+        if len(self._delta) > self.merge_threshold:
+            self._merge()
+
+    def _merge(self):
+        if np is not None:
+            self._main = np.sort(np.concatenate([self._main, np.asarray(self._delta, dtype=float)]))
+        else:
+            self._main = sorted(self._main + self._delta)
+        self._delta = []
+
+    @classmethod
+    def from_mysql(cls, conn, table, field, where=None):
+        """
+        从MySQL表的某一列建立索引
+        """
+        cur = conn.cursor()
+        cur.execute('SELECT %s FROM %s WHERE %s IS NOT NULL%s' % (field, table, field,
+                                                                 ' AND (%s)' % where if where else ''))
+        values = [row[field] for row in cur.fetchall()]
+        cur.close()
+        return cls(filter(is_number, values))
+
+
+class MongoPercentileIndex(PercentileIndex):
+    """
+    基于MongoDB collection中某个字段的索引。refresh只加载_id大于上次记录的文档（增量更新）；
+    如果已有文档的字段发生了变化，需要调用rebuild。
+
+    :param ttl: 如果指定，则在rank时，每隔ttl秒自动refresh一次
+    """
+
+    def __init__(self, col, field, query=None, ttl=None):
+        PercentileIndex.__init__(self)
+        self.col = col
+        self.field = field
+        self.query = query or {}
+        self.ttl = ttl
+
+        self.last_id = None
+        self.refresh_ts = None
+
+    def _fetch(self, last_id=None):
+        import pymongo
+
+        query = {self.field: {'$ne': None}}
+        if self.query:
+            query = {'$and': [query, self.query]}
+        if last_id is not None:
+            query = {'$and': [query, {'_id': {'$gt': last_id}}]}
+
+        values = []
+        for entry in self.col.find(query, {self.field: 1}).sort('_id', pymongo.ASCENDING):
+            self.last_id = entry['_id']
+            if is_number(entry.get(self.field)):
+                values.append(entry[self.field])
+        return values
+
+    def rebuild(self):
+        self.last_id = None
+        self._main = self._sort(self._fetch())
+        self._delta = []
+        self.refresh_ts = time()
+        return self
+
+    def refresh(self):
+        if self.last_id is None:
+            return self.rebuild()
+
+        for value in self._fetch(self.last_id):
+            self.add(value)
+        self.refresh_ts = time()
+        return self
+
+    def rank(self, x):
+        if self.refresh_ts is None or (self.ttl and time() - self.refresh_ts > self.ttl):
+            self.refresh()
+        return PercentileIndex.rank(self, x)
@@ -0,0 +1,401 @@
+# coding=utf-8
+import heapq
+import threading
+from Queue import Empty, Full
+from collections import deque, OrderedDict
+from time import time, sleep
+
+__author__ = 'zephyre'
+
+
+class BaseScheduler(object):
+    """
+    任务调度器的基类。put/get的语义和Queue.Queue相同：队列已满时，put在条件变量上阻塞，直到有任务被取走。
+
+    子类需要实现_init, _qsize, _put和_get。
+    """
+
+    name = None
+
+    # 等待时间直方图的分桶上限（秒）
+    wait_buckets = (0.01, 0.1, 1, 10, 60)
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+        # 统计信息
+        self.max_depth = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.wait_hist = [0] * (len(self.wait_buckets) + 1)
+
+        self._init()
+
+    @classmethod
+    def from_processor(cls, processor, maxsize=0):
+        return cls(maxsize=maxsize)
+
+    def _init(self):
+        raise NotImplementedError
+
+    def _qsize(self):
+        raise NotImplementedError
+
+    def _put(self, item, task):
+        raise NotImplementedError
+
+    def _get(self):
+        raise NotImplementedError
+
+    def qsize(self):
+        with self.mutex:
+            return self._qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, task, block=True, timeout=None, force=False):
+        """
+        添加任务
+        :param force: 忽略maxsize的限制
+        """
+        with self.not_full:
+            if self.maxsize > 0 and not force:
+                if not block:
+                    if self._qsize() >= self.maxsize:
+                        raise Full
+                elif timeout is None:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    deadline = time() + timeout
+                    while self._qsize() >= self.maxsize:
+                        remaining = deadline - time()
+                        if remaining <= 0:
+                            raise Full
+                        self.not_full.wait(remaining)
+
+            self._put((time(), task), task)
+            self.max_depth = max(self.max_depth, self._qsize())
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    self.not_empty.wait()
+            else:
+                deadline = time() + timeout
+                while not self._qsize():
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+
+            ts, task = self._get()
+            self._record_wait(time() - ts)
+            self.not_full.notify()
+            return task
+
+    def task_done(self, task):
+        """
+        任务执行完毕（无论成功与否）。本地调度器不需要确认
+        """
+        pass
+
+    def start_producing(self):
+        """
+        生产者开始添加任务
+        """
+        pass
+
+    def finish_producing(self):
+        """
+        所有的任务都已经添加完毕
+        """
+        pass
+
+    def _record_wait(self, wait):
+        self.dequeued += 1
+        self.total_wait += wait
+        for idx, upper in enumerate(self.wait_buckets):
+            if wait < upper:
+                self.wait_hist[idx] += 1
+                return
+        self.wait_hist[-1] += 1
+
+    def report(self):
+        """
+        Statistics for the heartbeat log
+        """
+        labels = ['<%gs' % v for v in self.wait_buckets] + ['>=%gs' % self.wait_buckets[-1]]
+        hist = ', '.join('%s: %d' % (label, cnt) for label, cnt in zip(labels, self.wait_hist))
+        avg = self.total_wait / self.dequeued if self.dequeued else 0
+        return ['Scheduler [%s]: depth %d (max %d), dequeued %d, avg wait %.3fs, wait histogram: %s' % (
+            self.name, self.qsize(), self.max_depth, self.dequeued, avg, hist)]
+
+
+class FifoScheduler(BaseScheduler):
+    name = 'fifo'
+
+    def _init(self):
+        self.queue = deque()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item, task):
+        self.queue.append(item)
+
+    def _get(self):
+        return self.queue.popleft()
+
+
+class LifoScheduler(FifoScheduler):
+    name = 'lifo'
+
+    def _get(self):
+        return self.queue.pop()
+
+
+class PriorityScheduler(BaseScheduler):
+    """
+    按照任务的priority属性调度，数值越大越优先。相同优先级的任务按照FIFO的顺序
+    """
+    name = 'priority'
+
+    def _init(self):
+        self.queue = []
+        self.seq = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item, task):
+        self.seq += 1
+        heapq.heappush(self.queue, (-getattr(task, 'priority', 0), self.seq, item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+class FairShareScheduler(BaseScheduler):
+    """
+    按照任务的task_host属性，在各个host之间轮转（round-robin）。同一个host内部按照FIFO的顺序
+    """
+    name = 'fair'
+
+    def _init(self):
+        # host => deque
+        self.queues = OrderedDict()
+        self.size = 0
+
+    def _qsize(self):
+        return self.size
+
+    def _put(self, item, task):
+        host = getattr(task, 'task_host', None)
+        if host not in self.queues:
+            self.queues[host] = deque()
+        self.queues[host].append(item)
+        self.size += 1
+
+    def _get(self):
+        host, queue = self.queues.popitem(last=False)
+        item = queue.popleft()
+        if queue:
+            # 放到轮转的末尾
+            self.queues[host] = queue
+        self.size -= 1
+        return item
+
+
+class RedisScheduler(FifoScheduler):
+    """
+    基于Redis的分布式任务队列，可以在多个节点之间分配任务。
+
+    只有带有task_desc属性的任务才会进入Redis。task_desc是一个可以JSON序列化的dict：
+    {'processor': processor名称, 'entry_id': 数据的id, 'action': 动作}。消费者通过processor.build_task(task_desc)重建任务。
+    后续任务（force=True，参见BaseProcessor.add_subtask）总是在本地的队列中执行：它们的父任务在本地等待它们完成。
+    其它没有task_desc的任务无法序列化，也在本地的队列中执行，但和Redis中的任务一样受maxsize的限制。
+
+    任务被取走时，从pending列表移入processing（ZSET，score为超时时间）。任务完成后通过task_done确认；
+    如果消费者在超时之前没有确认（比如进程崩溃），任务会被重新放回pending列表，由其它消费者处理。
+
+    每次生产都有一个run id：生产者开始时写入run，结束时将done设为同一个run id。
+    消费者只加入尚未结束的run（生产者还在添加任务，或者还有未完成的任务）。启动时如果只能看到上一次已经结束的run，
+    则等待新的生产者。消费者只在自己加入的run结束后退出。
+    """
+    name = 'redis'
+
+    # 从pending中取出一个任务，并放入processing
+    claim_script = """
+    local msg = redis.call('RPOP', KEYS[1])
+    if msg then
+        redis.call('ZADD', KEYS[2], ARGV[1], msg)
+    end
+    return msg
+    """
+
+    # 将超时的任务放回pending
+    reap_script = """
+    local msgs = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 100)
+    for _, msg in ipairs(msgs) do
+        redis.call('ZREM', KEYS[2], msg)
+        redis.call('RPUSH', KEYS[1], msg)
+    end
+    return #msgs
+    """
+
+    def __init__(self, maxsize=0, queue_name='default', task_builder=None, profile='engine', visibility_timeout=600,
+                 poll_interval=1, redis_cli=None):
+        from core import RedisClient
+
+        self.redis = (redis_cli or RedisClient(profile)).redis
+        self.task_builder = task_builder
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+
+        prefix = 'dhaulagiri:queue:%s' % queue_name
+        self.pending_key = '%s:pending' % prefix
+        self.processing_key = '%s:processing' % prefix
+        self.run_key = '%s:run' % prefix
+        self.done_key = '%s:done' % prefix
+        # 当前参与的run
+        self.run_id = None
+
+        self._claim = self.redis.register_script(self.claim_script)
+        self._reap = self.redis.register_script(self.reap_script)
+
+        self.reaped = 0
+        self.acked = 0
+
+        FifoScheduler.__init__(self, maxsize)
+
+    @classmethod
+    def from_processor(cls, processor, maxsize=0):
+        from core import dhaulagiri_settings
+
+        section = dhaulagiri_settings.get('redis_queue', {})
+        return cls(maxsize=maxsize, queue_name=processor.name, task_builder=processor.build_task,
+                   profile=section.get('profile', 'engine'),
+                   visibility_timeout=section.get('visibility_timeout', 600),
+                   poll_interval=section.get('poll_interval', 1))
+
+    def qsize(self):
+        with self.mutex:
+            local_size = self._qsize()
+        return local_size + self.redis.llen(self.pending_key)
+
+    def _current_run(self):
+        """
+        获得当前参与的run id。如果还没有加入，则加入正在进行的run（生产者尚未结束，或者还有未完成的任务）；
+        没有正在进行的run时，返回None
+        """
+        if self.run_id is None:
+            pipe = self.redis.pipeline()
+            pipe.mget(self.run_key, self.done_key)
+            pipe.llen(self.pending_key)
+            pipe.zcard(self.processing_key)
+            (run_id, done_id), pending, processing = pipe.execute()
+            if run_id is not None and (run_id != done_id or pending or processing):
+                self.run_id = run_id
+        return self.run_id
+
+    def empty(self):
+        """
+        只有当本次run的生产者已经结束，并且所有的任务都已经被确认，队列才是空的
+        """
+        run_id = self._current_run()
+        if run_id is None:
+            return False
+        return self.qsize() == 0 and not self.redis.zcard(self.processing_key) and \
+               self.redis.get(self.done_key) == run_id
+
+    def put(self, task, block=True, timeout=None, force=False):
+        import json
+        from uuid import uuid4
+
+        desc = getattr(task, 'task_desc', None)
+        if desc is None or force:
+            return FifoScheduler.put(self, task, block=block, timeout=timeout, force=force)
+
+        if self.maxsize > 0:
+            deadline = time() + timeout if timeout is not None else None
+            while self.redis.llen(self.pending_key) >= self.maxsize:
+                if not block or (deadline is not None and time() >= deadline):
+                    raise Full
+                sleep(self.poll_interval)
+
+        msg = dict(desc)
+        msg['id'] = uuid4().hex
+        msg['ts'] = time()
+        self.redis.lpush(self.pending_key, json.dumps(msg))
+
+    def get(self, block=True, timeout=None):
+        import json
+
+        deadline = time() + timeout if timeout is not None else None
+        while True:
+            # 本地任务优先
+            try:
+                return FifoScheduler.get(self, block=False)
+            except Empty:
+                pass
+
+            cts = time()
+            self.reaped += self._reap(keys=[self.pending_key, self.processing_key], args=[cts])
+            msg = self._claim(keys=[self.pending_key, self.processing_key], args=[cts + self.visibility_timeout])
+            if msg:
+                desc = json.loads(msg)
+                self._record_wait(cts - desc.get('ts', cts))
+                task = self.task_builder(desc)
+                setattr(task, 'task_msg', msg)
+                return task
+
+            if not block or (deadline is not None and time() >= deadline):
+                raise Empty
+            sleep(self.poll_interval)
+
+    def task_done(self, task):
+        msg = getattr(task, 'task_msg', None)
+        if msg:
+            self.redis.zrem(self.processing_key, msg)
+            self.acked += 1
+
+    def start_producing(self):
+        from uuid import uuid4
+
+        self.run_id = uuid4().hex
+        pipe = self.redis.pipeline()
+        pipe.delete(self.done_key)
+        pipe.set(self.run_key, self.run_id)
+        pipe.execute()
+
+    def finish_producing(self):
+        self.redis.set(self.done_key, self.run_id)
+
+    def report(self):
+        lines = FifoScheduler.report(self)
+        lines.append('Redis queue: pending %d, processing %d, acked %d, reaped %d' % (
+            self.redis.llen(self.pending_key), self.redis.zcard(self.processing_key), self.acked, self.reaped))
+        return lines
+
+
+schedulers = dict((cls.name, cls) for cls in [FifoScheduler, LifoScheduler, PriorityScheduler, FairShareScheduler,
+                                              RedisScheduler])
+
+
+def get_scheduler(name, maxsize=0, processor=None):
+    try:
+        cls = schedulers[name]
+    except KeyError:
+        raise ValueError('Invalid scheduler: %s' % name)
+    return cls.from_processor(processor, maxsize) if processor else cls(maxsize=maxsize)
@@ -0,0 +1,197 @@
+# coding=utf-8
+import os
+import zlib
+from time import time, sleep
+
+from core import LoggerMixin
+
+__author__ = 'zephyre'
+
+
+def shard_index(value, total):
+    """
+    计算value属于哪个分片。采用crc32，保证不同进程中的结果一致
+    """
+    return (zlib.crc32(str(value)) & 0xffffffff) % total
+
+
+def id_bounds(col, query, total):
+    """
+    将满足query的文档按照_id的取值范围分成total段，返回各段之间的total-1个边界。
+    ObjectId按照其中的时间戳切分，数值按照大小切分。
+    如果没有文档，或者_id既不是ObjectId也不是数值，返回None
+
+    各个分片必须使用同一组边界，否则（比如分片启动期间有新写入的文档）边界附近的文档会被遗漏或者重复处理。
+    所以边界在fork之前由ShardSupervisor计算一次，参见BaseProcessor.plan_shards
+    """
+    import pymongo
+    from datetime import datetime
+    from bson.objectid import ObjectId
+
+    first = col.find_one(query, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)])
+    last = col.find_one(query, {'_id': 1}, sort=[('_id', pymongo.DESCENDING)])
+    if first is None:
+        return None
+    lo, hi = first['_id'], last['_id']
+
+    if isinstance(lo, ObjectId) and isinstance(hi, ObjectId):
+        from calendar import timegm
+
+        lo_ts, hi_ts = timegm(lo.generation_time.utctimetuple()), timegm(hi.generation_time.utctimetuple()) + 1
+        bound = lambda idx: ObjectId.from_datetime(datetime.utcfromtimestamp(lo_ts + (hi_ts - lo_ts) * idx // total))
+    elif isinstance(lo, (int, long, float)) and isinstance(hi, (int, long, float)):
+        bound = lambda idx: lo + (hi - lo + 1) * idx // total
+    else:
+        return None
+
+    return [bound(idx) for idx in xrange(1, total)]
+
+
+def range_cond(bounds, index):
+    """
+    根据id_bounds返回的边界，获得第index段的条件（比如{'$gte': a, '$lt': b}）。
+    第一段和最后一段不设下界/上界，以包含新写入的文档
+    """
+    cond = {}
+    if index > 0:
+        cond['$gte'] = bounds[index - 1]
+    if index < len(bounds):
+        cond['$lt'] = bounds[index]
+    return cond
+
+
+class ShardSupervisor(LoggerMixin):
+    """
+    多进程执行processor：fork出processes个子进程，每个子进程运行一个独立的engine，负责一个分片。
+
+    子进程通过conf.global_conf['shard']获得分片信息：
+    {'index': 分片编号, 'total': 分片数量, 'stats': 共享的统计数组, 'plan': 在fork之前计算的分片方案}。
+    子进程将进度写入共享数组，父进程负责汇总，并输出统一的心跳日志。
+    """
+
+    name = 'shard_supervisor'
+
+    # 每个分片在共享数组中占用的字段
+    stat_fields = ('progress', 'total', 'bypassed', 'ts', 'done')
+
+    def __init__(self, processes, heartbeat_interval=30):
+        LoggerMixin.__init__(self)
+
+        self.processes = processes
+        self.heartbeat_interval = heartbeat_interval
+
+        from multiprocessing.sharedctypes import RawArray
+
+        # 在fork之前创建，父子进程共享同一块内存
+        self.stats = RawArray('d', processes * len(self.stat_fields))
+
+        # pid => 分片编号
+        self.children = {}
+
+        self.init_ts = time()
+        self.checkpoint_ts = None
+        self.checkpoint_prog = None
+
+    def get_stat(self, index):
+        width = len(self.stat_fields)
+        return dict(zip(self.stat_fields, self.stats[index * width:(index + 1) * width]))
+
+    def _spawn(self, index, target, plan):
+        import conf
+
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+
+        # 子进程
+        conf.global_conf['shard'] = {'index': index, 'total': self.processes, 'stats': self.stats, 'plan': plan}
+        exit_code = 0
+        try:
+            target()
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def report(self):
+        stats = [self.get_stat(idx) for idx in xrange(self.processes)]
+        progress = sum(int(s['progress']) for s in stats)
+        total = sum(int(s['total']) for s in stats)
+        bypassed = sum(int(s['bypassed']) for s in stats)
+
+        cts = time()
+        msg = 'Progress: %d / %d (%d bypassed), running shards: %d / %d.' % (progress, total, bypassed,
+                                                                             len(self.children), self.processes)
+        if self.checkpoint_ts is not None:
+            rate = (progress - self.checkpoint_prog) / (cts - self.checkpoint_ts) * 60
+            msg = '%s Processing rate: %d items/min' % (msg, int(rate))
+        self.checkpoint_ts = cts
+        self.checkpoint_prog = progress
+
+        self.log(msg)
+        for idx, s in enumerate(stats):
+            self.log('Shard #%d: %d / %d%s' % (idx, int(s['progress']), int(s['total']),
+                                               ' (done)' if s['done'] else ''))
+
+    def run(self, target, planner=None):
+        """
+        启动所有的子进程，等待它们结束
+        :param target: 子进程中执行的函数
+        :param planner: 在fork之前调用一次：planner(分片数量)，返回的分片方案传给所有的子进程（参见BaseProcessor.plan_shards）
+        :return: 失败的子进程数量
+        """
+        import signal
+
+        plan = None
+        if planner:
+            from utils.database import reset_mongodb_clients
+
+            plan = planner(self.processes)
+            # MongoClient不能跨fork使用，子进程需要建立自己的连接
+            reset_mongodb_clients()
+
+        for idx in xrange(self.processes):
+            self._spawn(idx, target, plan)
+        self.log('Started %d shards: %s' % (self.processes, ', '.join(str(pid) for pid in sorted(self.children))))
+
+        def terminate(signum, frame):
+            for pid in self.children:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+
+        failed = 0
+        last_report = time()
+        while self.children:
+            # 只等待分片进程，不回收其它的子进程
+            exited = False
+            for pid in list(self.children):
+                try:
+                    ret, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    ret, status = pid, 1
+                if ret:
+                    exited = True
+                    index = self.children.pop(pid)
+                    if status:
+                        failed += 1
+                        self.log('Shard #%d (pid %d) exited with status %d' % (index, pid, status))
+            if exited:
+                continue
+
+            if time() - last_report >= self.heartbeat_interval:
+                last_report = time()
+                self.report()
+            sleep(1)
+
+        self.report()
+        self.log('All shards ended in %d minutes, %d failed' % (int((time() - self.init_ts) / 60.0), failed))
+        return failed